@@ -0,0 +1,96 @@
+"""HTTP 接入性能测试脚本
+
+向运行中的服务发送大量纯文本消息请求，统计吞吐量（requests/sec）和延迟分位数，
+用于对比 multipart 表单接口（/api/send）和 JSON 接口（/api/send_json）的性能。
+
+注意：请求会真实进入消息队列，请使用测试用的 chat_id，并在测试环境中运行。
+
+用法:
+    python bench_ingest.py --url http://127.0.0.1:8000 --mode form -n 5000 -c 50
+    python bench_ingest.py --url http://127.0.0.1:8000 --mode json -n 5000 -c 50
+    python bench_ingest.py --url http://127.0.0.1:8000 --mode json -n 5000 -c 50 --api-key <租户 API Key>
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import aiohttp
+
+
+def percentile(sorted_values, percent):
+    """计算分位数（输入需已排序）"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(percent / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+async def run_benchmark(url, mode, total, concurrency, chat_id, text, api_key=None):
+    """并发发送 total 个请求，返回每个请求的延迟（秒）、失败数和总耗时"""
+    endpoint = f"{url.rstrip('/')}/api/send_json" if mode == 'json' else f"{url.rstrip('/')}/api/send"
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+    # 配置了 tenants 的服务需要 API Key
+    headers = {'X-API-Key': api_key} if api_key else {}
+
+    async def worker(session):
+        nonlocal errors
+        for i in counter:
+            body_text = f"{text} #{i}"
+            start = time.perf_counter()
+            try:
+                if mode == 'json':
+                    request = session.post(endpoint, data=json.dumps({'chat_id': chat_id, 'text': body_text}),
+                                           headers={**headers, 'Content-Type': 'application/json'})
+                else:
+                    # 使用 multipart/form-data，与实际调用方式一致
+                    form = aiohttp.MultipartWriter('form-data')
+                    for name, value in (('chat_id', str(chat_id)), ('text', body_text)):
+                        part = form.append(value)
+                        part.set_content_disposition('form-data', name=name)
+                    request = session.post(endpoint, data=form, headers=headers)
+                async with request as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP 接入性能测试')
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='服务地址，默认 http://127.0.0.1:8000')
+    parser.add_argument('--mode', choices=['form', 'json'], default='json', help='form: /api/send，json: /api/send_json')
+    parser.add_argument('-n', '--requests', type=int, default=5000, help='请求总数，默认5000')
+    parser.add_argument('-c', '--concurrency', type=int, default=50, help='并发连接数，默认50')
+    parser.add_argument('--chat-id', default='-1000000000000', help='测试用的 chat_id')
+    parser.add_argument('--text', default='bench message', help='消息文本前缀')
+    parser.add_argument('--api-key', help='租户 API Key（服务配置了 tenants 时需要，通过 X-API-Key 发送）')
+    args = parser.parse_args()
+
+    latencies, errors, elapsed = asyncio.run(
+        run_benchmark(args.url, args.mode, args.requests, args.concurrency, args.chat_id, args.text, args.api_key)
+    )
+    latencies.sort()
+    print(f"模式: {args.mode}，请求数: {len(latencies)}，并发: {args.concurrency}，失败: {errors}")
+    print(f"总耗时: {elapsed:.2f} 秒，吞吐量: {len(latencies) / elapsed:.1f} requests/sec")
+    print(
+        f"延迟: p50={percentile(latencies, 50) * 1000:.2f}ms "
+        f"p90={percentile(latencies, 90) * 1000:.2f}ms "
+        f"p99={percentile(latencies, 99) * 1000:.2f}ms "
+        f"max={latencies[-1] * 1000 if latencies else 0:.2f}ms"
+    )
+
+
+if __name__ == '__main__':
+    main()
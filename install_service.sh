@@ -77,6 +77,7 @@ echo -e "${YELLOW}使用以下命令管理服务:${NC}"
 echo -e "  启动服务: ${GREEN}sudo systemctl start clienttguserbot${NC}"
 echo -e "  停止服务: ${GREEN}sudo systemctl stop clienttguserbot${NC}"
 echo -e "  重启服务: ${GREEN}sudo systemctl restart clienttguserbot${NC}"
+echo -e "  重载配置: ${GREEN}sudo systemctl reload clienttguserbot${NC}"
 echo -e "  查看状态: ${GREEN}sudo systemctl status clienttguserbot${NC}"
 echo -e "  查看日志: ${GREEN}sudo journalctl -u clienttguserbot -f${NC}"
 echo -e "\n${YELLOW}注意: 如果首次运行需要登录，请先手动运行一次脚本完成登录${NC}"
@@ -1,3 +1,8 @@
+from __future__ import annotations
+
+import time
+# 导入模块的开始时间，用于统计启动耗时（startup_timings）
+_module_load_started = time.perf_counter()
 import logging
 import sys
 import os
@@ -5,714 +10,3582 @@ import json
 import asyncio
 import random
 import io
-from datetime import datetime, timezone
-from typing import List, Dict, Optional, Union
-from collections import defaultdict
+import hashlib
+import hmac
+import base64
+import tempfile
+import bisect
+import re
+import shutil
+import signal
+import socket
+import heapq
+import gc
+import threading
+import tracemalloc
+import sqlite3
+import struct
+import importlib.util
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Optional, Set, Union
+from collections import defaultdict, OrderedDict, deque
+from itertools import islice
 from urllib.parse import urlparse
-from pyrogram import Client
-from pyrogram.errors import SessionPasswordNeeded, FloodWait, RPCError
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
-from fastapi.responses import JSONResponse
-import uvicorn
-import aiohttp
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse, PlainTextResponse
+try:
+    import orjson  # 可选依赖，安装后 JSON 编解码更快
+except ImportError:
+    orjson = None
 
-# 加载配置文件
-def load_config():
-    """加载配置文件"""
-    config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-    
+# Pyrogram、FastAPI、uvicorn、aiohttp 导入较慢（合计约1秒），在第一次用到时才导入：
+# Pyrogram 在创建客户端时导入（load_pyrogram），FastAPI 在创建应用时导入（build_app），
+# uvicorn 和 aiohttp 在启动 HTTP 服务器和下载图片时导入
+class _PyrogramNotLoaded(Exception):
+    """Pyrogram 导入之前异常类型的占位（不会被抛出，except 子句可以正常使用）"""
+
+Client = raw = types = utils = get_input_peer = None
+SessionPasswordNeeded = FloodWait = RPCError = FilePartMissing = _PyrogramNotLoaded
+
+def load_pyrogram():
+    """导入 Pyrogram（只在第一次调用时导入），替换上面的占位名称"""
+    global Client, raw, types, utils, get_input_peer, SessionPasswordNeeded, FloodWait, RPCError, FilePartMissing
+    if Client is None:
+        from pyrogram import Client, raw, types, utils
+        from pyrogram.storage.sqlite_storage import get_input_peer
+        from pyrogram.errors import SessionPasswordNeeded, FloodWait, RPCError, FilePartMissing
+
+def json_loads(data: Union[bytes, str]):
+    """解析 JSON（安装了 orjson 时使用 orjson）"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def json_dumps(data) -> bytes:
+    """序列化为 JSON（安装了 orjson 时使用 orjson），返回 UTF-8 字节"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# Telegram 图片（photo）限制：文件不超过10MB，宽高之和不超过10000，宽高比不超过20
+TELEGRAM_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+TELEGRAM_PHOTO_MAX_DIMENSION_SUM = 10000
+TELEGRAM_PHOTO_MAX_RATIO = 20
+
+# 发送加速：队列超过此数量时按比例缩短各项延迟，批量延迟最多增加 MAX_BATCH_DELAY 秒
+SPEED_UP_THRESHOLD = 100
+MAX_BATCH_DELAY = 10.0
+
+# 配置文件路径（与脚本在同一目录）
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+class ConfigError(Exception):
+    """配置文件无效"""
+
+def read_config(config_path: str = CONFIG_PATH) -> dict:
+    """读取并验证配置文件，配置无效时抛出 ConfigError（启动和热重载共用）"""
     if not os.path.exists(config_path):
-        print(f"错误: 配置文件不存在: {config_path}")
-        print("请复制 config.json.example 为 config.json 并填写配置信息")
-        sys.exit(1)
+        raise ConfigError(f"配置文件不存在: {config_path}")
     
     try:
         with open(config_path, 'r', encoding='utf-8') as f:
             config = json.load(f)
-        
-        # 验证必需的配置项
-        if 'accounts' not in config:
-            # 兼容旧格式：单个 api_id/api_hash
-            if 'api_id' in config and 'api_hash' in config:
-                # 转换为新格式
-                config['accounts'] = [{
-                    'api_id': config['api_id'],
-                    'api_hash': config['api_hash'],
-                    'name': f"account_{config['api_id']}"
-                }]
-            else:
-                print("错误: 配置文件缺少必需的配置项: accounts 或 api_id/api_hash")
-                sys.exit(1)
-        
-        # 验证每个账户配置
-        for i, account in enumerate(config['accounts']):
-            if 'api_id' not in account or 'api_hash' not in account:
-                print(f"错误: 账户 {i+1} 缺少 api_id 或 api_hash")
-                sys.exit(1)
-            if 'name' not in account:
-                account['name'] = f"account_{account['api_id']}"
-        
-        return config
     except json.JSONDecodeError as e:
-        print(f"错误: 配置文件格式错误: {str(e)}")
+        raise ConfigError(f"配置文件格式错误: {str(e)}")
+    except OSError as e:
+        raise ConfigError(f"读取配置文件失败: {str(e)}")
+    
+    return validate_config(config)
+
+def validate_config(config: dict) -> dict:
+    """验证配置（读取配置文件和 create_app() 直接传入配置时共用），配置无效时抛出 ConfigError"""
+    if not isinstance(config, dict):
+        raise ConfigError("配置文件格式错误: 顶层必须是 JSON 对象")
+    
+    # 验证必需的配置项
+    if 'accounts' not in config:
+        # 兼容旧格式：单个 api_id/api_hash
+        if 'api_id' in config and 'api_hash' in config:
+            # 转换为新格式
+            config['accounts'] = [{
+                'api_id': config['api_id'],
+                'api_hash': config['api_hash'],
+                'name': f"account_{config['api_id']}"
+            }]
+        else:
+            raise ConfigError("配置文件缺少必需的配置项: accounts 或 api_id/api_hash")
+    
+    # 验证每个账户配置
+    for i, account in enumerate(config['accounts']):
+        if 'api_id' not in account or 'api_hash' not in account:
+            raise ConfigError(f"账户 {i+1} 缺少 api_id 或 api_hash")
+        if 'name' not in account:
+            account['name'] = f"account_{account['api_id']}"
+    
+    return config
+
+# 加载配置文件
+def load_config():
+    """加载配置文件（启动时调用，配置无效时退出程序）"""
+    try:
+        return read_config(CONFIG_PATH)
+    except ConfigError as e:
+        print(f"错误: {str(e)}")
+        if not os.path.exists(CONFIG_PATH):
+            print("请复制 config.json.example 为 config.json 并填写配置信息")
         sys.exit(1)
     except Exception as e:
         print(f"错误: 加载配置文件失败: {str(e)}")
         sys.exit(1)
 
-# 加载配置
-config = load_config()
-accounts = config['accounts']
-distribution_strategy = config.get('distribution_strategy', 'round_robin')  # round_robin 或 random
-# 支持 "round" 作为 "round_robin" 的别名
-if distribution_strategy == 'round':
-    distribution_strategy = 'round_robin'
-
-# 消息发送配置（防止风控）
-send_interval = config.get('send_interval', 2.0)  # 发送间隔（秒），默认2秒
-send_jitter = config.get('send_jitter', 1.0)  # 抖动时间（秒），默认1秒，会在0到send_jitter之间随机
-
-# 模拟真人操作的配置
-think_time_min = config.get('think_time_min', 0.5)  # 最小思考时间（秒），默认0.5秒，模拟看到消息后的反应时间
-think_time_max = config.get('think_time_max', 3.0)  # 最大思考时间（秒），默认3秒
-operation_delay_min = config.get('operation_delay_min', 0.3)  # 操作前最小延迟（秒），默认0.3秒，模拟点击、选择等操作时间
-operation_delay_max = config.get('operation_delay_max', 1.0)  # 操作前最大延迟（秒），默认1秒
-batch_delay_factor = config.get('batch_delay_factor', 0.5)  # 批量消息延迟因子，队列中每多一条消息，额外延迟（秒），默认0.5秒
-rest_probability = config.get('rest_probability', 0.05)  # 休息概率，每次发送后有5%概率休息，默认0.05（5%）
-rest_time_min = config.get('rest_time_min', 10)  # 最小休息时间（秒），默认10秒
-rest_time_max = config.get('rest_time_max', 60)  # 最大休息时间（秒），默认60秒
-
-# 自动清除未读标记配置
-auto_mark_read = config.get('auto_mark_read', True)  # 是否自动标记消息为已读，默认 True
-mark_read_interval = config.get('mark_read_interval', 300)  # 定期清除未读标记的间隔（秒），默认300秒（5分钟）
-# mark_read_on_receive 已废弃（不再监听消息，所以不需要收到消息时立即标记为已读）
-mark_read_delay = config.get('mark_read_delay', 0.5)  # 清除每个群组未读标记的延迟（秒），默认0.5秒，避免触发限流
-
-# 验证配置合理性
-if send_interval < 0:
-    logger.warning(f"send_interval 配置值 {send_interval} 无效，使用默认值 2.0")
-    send_interval = 2.0
-if send_jitter < 0:
-    logger.warning(f"send_jitter 配置值 {send_jitter} 无效，使用默认值 1.0")
-    send_jitter = 1.0
-if mark_read_delay < 0:
-    logger.warning(f"mark_read_delay 配置值 {mark_read_delay} 无效，使用默认值 0.5")
-    mark_read_delay = 0.5
-if mark_read_interval < 0:
-    logger.warning(f"mark_read_interval 配置值 {mark_read_interval} 无效，使用默认值 300")
-    mark_read_interval = 300
-if think_time_min < 0 or think_time_max < think_time_min:
-    logger.warning(f"think_time 配置无效，使用默认值: min=0.5, max=3.0")
-    think_time_min, think_time_max = 0.5, 3.0
-if operation_delay_min < 0 or operation_delay_max < operation_delay_min:
-    logger.warning(f"operation_delay 配置无效，使用默认值: min=0.3, max=1.0")
-    operation_delay_min, operation_delay_max = 0.3, 1.0
-if batch_delay_factor < 0:
-    logger.warning(f"batch_delay_factor 配置值 {batch_delay_factor} 无效，使用默认值 0.5")
-    batch_delay_factor = 0.5
-if rest_probability < 0 or rest_probability > 1:
-    logger.warning(f"rest_probability 配置值 {rest_probability} 无效，使用默认值 0.05")
-    rest_probability = 0.05
-if rest_time_min < 0 or rest_time_max < rest_time_min:
-    logger.warning(f"rest_time 配置无效，使用默认值: min=10, max=60")
-    rest_time_min, rest_time_max = 10, 60
-
-# HTTP API 配置（现在只支持 HTTP API，所以总是启用）
-http_host = '0.0.0.0'  # HTTP服务器监听地址（固定为0.0.0.0，监听所有接口）
-http_port = config.get('http_port', 8000)  # HTTP服务器端口，默认8000
-
-# 验证HTTP配置
-if http_port < 1 or http_port > 65535:
-    logger.warning(f"http_port 配置值 {http_port} 无效，使用默认值 8000")
-    http_port = 8000
-
-# 配置日志路径（支持相对路径和绝对路径）
-log_dir_config = config.get('log_dir', 'logs')
-if os.path.isabs(log_dir_config):
-    # 绝对路径
-    log_dir = log_dir_config
-else:
-    # 相对路径，相对于脚本目录
-    log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), log_dir_config)
-
-os.makedirs(log_dir, exist_ok=True)
-# 使用基础日志文件名（不包含日期，TimedRotatingFileHandler会自动添加日期后缀）
-log_file_base = os.path.join(log_dir, 'client_tguserbot.log')
-
-# 配置日志格式
-# 从环境变量或配置中读取日志级别，默认为 INFO
-log_level = config.get('log_level', 'INFO').upper()
-
-# 使用 TimedRotatingFileHandler 实现按天自动轮转日志文件
-from logging.handlers import TimedRotatingFileHandler
-
-# 创建按天轮转的文件处理器（每天午夜轮转）
-file_handler = TimedRotatingFileHandler(
-    filename=log_file_base,
-    when='midnight',  # 每天午夜轮转
-    interval=1,  # 每1天
-    backupCount=0,  # 保留所有历史日志文件（不自动删除）
-    encoding='utf-8'
-)
+def get_distribution_strategy(config: dict) -> str:
+    """读取分配策略，支持 "round" 作为 "round_robin" 的别名，"sticky" 作为 "consistent_hash" 的别名"""
+    strategy = config.get('distribution_strategy', 'round_robin')
+    if strategy == 'round':
+        return 'round_robin'
+    if strategy == 'sticky':
+        return 'consistent_hash'
+    return strategy
+
+class PacingConfig:
+    """发送和清除未读标记的节奏参数（防止风控、模拟真人操作）
+
+    热重载时整体替换为新对象；发送任务每处理一条消息前取一次引用，同一条消息使用的参数始终一致
+    """
+
+    def __init__(self, **values):
+        # 消息发送配置（防止风控）
+        self.send_interval = values.get('send_interval', 2.0)  # 发送间隔（秒），默认2秒
+        self.send_jitter = values.get('send_jitter', 1.0)  # 抖动时间（秒），默认1秒，会在0到send_jitter之间随机
+        
+        # 模拟真人操作的配置
+        self.think_time_min = values.get('think_time_min', 0.5)  # 最小思考时间（秒），默认0.5秒，模拟看到消息后的反应时间
+        self.think_time_max = values.get('think_time_max', 3.0)  # 最大思考时间（秒），默认3秒
+        self.operation_delay_min = values.get('operation_delay_min', 0.3)  # 操作前最小延迟（秒），默认0.3秒，模拟点击、选择等操作时间
+        self.operation_delay_max = values.get('operation_delay_max', 1.0)  # 操作前最大延迟（秒），默认1秒
+        self.batch_delay_factor = values.get('batch_delay_factor', 0.5)  # 批量消息延迟因子，队列中每多一条消息，额外延迟（秒），默认0.5秒
+        self.rest_probability = values.get('rest_probability', 0.05)  # 休息概率，每次发送后有5%概率休息，默认0.05（5%）
+        self.rest_time_min = values.get('rest_time_min', 10)  # 最小休息时间（秒），默认10秒
+        self.rest_time_max = values.get('rest_time_max', 60)  # 最大休息时间（秒），默认60秒
+        
+        # 自动清除未读标记的节奏
+        self.mark_read_interval = values.get('mark_read_interval', 300)  # 定期清除未读标记的间隔（秒），默认300秒（5分钟）
+        self.mark_read_delay = values.get('mark_read_delay', 0.5)  # 清除每个群组未读标记的延迟（秒），默认0.5秒，避免触发限流
+        self.mark_read_budget = values.get('mark_read_budget', 50)  # incremental 模式下每个账户每轮最多清除的群组数，默认50
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'PacingConfig':
+        """从配置中读取节奏参数，无效的值使用默认值并记录警告"""
+        pacing = cls(**config)
+        
+        # 验证配置合理性
+        if pacing.send_interval < 0:
+            logger.warning(f"send_interval 配置值 {pacing.send_interval} 无效，使用默认值 2.0")
+            pacing.send_interval = 2.0
+        if pacing.send_jitter < 0:
+            logger.warning(f"send_jitter 配置值 {pacing.send_jitter} 无效，使用默认值 1.0")
+            pacing.send_jitter = 1.0
+        if pacing.mark_read_delay < 0:
+            logger.warning(f"mark_read_delay 配置值 {pacing.mark_read_delay} 无效，使用默认值 0.5")
+            pacing.mark_read_delay = 0.5
+        if pacing.mark_read_interval < 0:
+            logger.warning(f"mark_read_interval 配置值 {pacing.mark_read_interval} 无效，使用默认值 300")
+            pacing.mark_read_interval = 300
+        if pacing.mark_read_budget < 1:
+            logger.warning(f"mark_read_budget 配置值 {pacing.mark_read_budget} 无效，使用默认值 50")
+            pacing.mark_read_budget = 50
+        if pacing.think_time_min < 0 or pacing.think_time_max < pacing.think_time_min:
+            logger.warning(f"think_time 配置无效，使用默认值: min=0.5, max=3.0")
+            pacing.think_time_min, pacing.think_time_max = 0.5, 3.0
+        if pacing.operation_delay_min < 0 or pacing.operation_delay_max < pacing.operation_delay_min:
+            logger.warning(f"operation_delay 配置无效，使用默认值: min=0.3, max=1.0")
+            pacing.operation_delay_min, pacing.operation_delay_max = 0.3, 1.0
+        if pacing.batch_delay_factor < 0:
+            logger.warning(f"batch_delay_factor 配置值 {pacing.batch_delay_factor} 无效，使用默认值 0.5")
+            pacing.batch_delay_factor = 0.5
+        if pacing.rest_probability < 0 or pacing.rest_probability > 1:
+            logger.warning(f"rest_probability 配置值 {pacing.rest_probability} 无效，使用默认值 0.05")
+            pacing.rest_probability = 0.05
+        if pacing.rest_time_min < 0 or pacing.rest_time_max < pacing.rest_time_min:
+            logger.warning(f"rest_time 配置无效，使用默认值: min=10, max=60")
+            pacing.rest_time_min, pacing.rest_time_max = 10, 60
+        return pacing
+
+    def send_delays(self, queue_size: int, rng=random) -> Dict[str, float]:
+        """计算发送一条消息前的各项延迟（秒），queue_size 为取出本条消息后队列中剩余的消息数
+
+        发送任务和 simulate.py 共用，rng 需要提供 gauss / betavariate / uniform 方法
+        """
+        # 当队列数量很大时，动态减少延迟以加快发送速度
+        if queue_size > SPEED_UP_THRESHOLD:
+            # 计算加速因子（队列越大，加速越多，但不会完全取消延迟）
+            # 当队列为100时，加速因子为1.0（不加速）
+            # 当队列为1000时，加速因子约为0.1（加速10倍）
+            speed_factor = max(0.1, 1.0 / (1.0 + (queue_size - SPEED_UP_THRESHOLD) / 200.0))
+        else:
+            speed_factor = 1.0
+        
+        # 1. 思考时间：模拟看到消息后的反应时间（使用正态分布，更自然），队列大时减少思考时间
+        think_min = self.think_time_min * speed_factor
+        think_max = self.think_time_max * speed_factor
+        think_time = max(think_min, min(think_max, rng.gauss((think_min + think_max) / 2, (think_max - think_min) / 4)))
+        
+        # 2. 基础发送间隔 + 随机抖动：使用 Beta(2,2) 分布，让延迟更集中在中间值，但偶尔会有较大波动
+        send_interval = self.send_interval * speed_factor
+        jitter = self.send_jitter * speed_factor * rng.betavariate(2, 2)
+        
+        # 3. 批量消息额外延迟：如果队列中有多条消息，增加延迟（模拟真人不会立即处理所有消息）
+        # 队列大时，批量延迟设置上限，避免延迟过长
+        if queue_size > SPEED_UP_THRESHOLD:
+            batch_delay = min(queue_size * self.batch_delay_factor * speed_factor, MAX_BATCH_DELAY)
+        else:
+            batch_delay = queue_size * self.batch_delay_factor
+        
+        # 4. 操作前延迟：模拟点击、选择等操作时间，队列大时减少操作延迟
+        operation_delay = rng.uniform(self.operation_delay_min * speed_factor, self.operation_delay_max * speed_factor)
+        
+        return {
+            'speed_factor': speed_factor,
+            'think_time': think_time,
+            'send_interval': send_interval,
+            'jitter': jitter,
+            'batch_delay': batch_delay,
+            'operation_delay': operation_delay,
+        }
+
+    def rest_time(self, rng=random) -> float:
+        """发送完成后的随机休息时间（秒），不休息时返回0"""
+        if rng.random() < self.rest_probability:
+            return rng.uniform(self.rest_time_min, self.rest_time_max)
+        return 0.0
+
+    def diff(self, other: 'PacingConfig') -> Dict[str, tuple]:
+        """比较两组参数，返回 {参数名: (旧值, 新值)}"""
+        return {
+            name: (value, getattr(other, name))
+            for name, value in vars(self).items()
+            if getattr(other, name) != value
+        }
+
+logger = logging.getLogger(__name__)
+
+# ========== 配置部分 ==========
+# 导入模块时不读取配置、不配置日志、不创建客户端；配置和运行状态由 create_app() 创建（见"应用工厂部分"）
+config: dict = {}
+accounts: List[dict] = []
+
+def apply_config(new_config: dict):
+    """读取并验证各配置项（无效的值使用默认值并记录警告），保存为模块级变量"""
+    global config, accounts, distribution_strategy, routing_state_max_chats, consistent_hash_vnodes
+    global supervisor_interval, supervisor_ping_timeout, pacing, config_watch_interval, auto_mark_read
+    global mark_read_mode, mark_read_fallback_browse, browse_state_file, image_preprocess
+    global image_preprocess_workers, image_max_side, image_target_bytes, image_cache_size, max_upload_size
+    global upload_spool_threshold, photo_prefetch_workers, task_status_max, event_buffer_size
+    global shutdown_drain_timeout, checkpoint_file, campaign_dir, campaign_window, trace_buffer_size
+    global trace_export_file, admin_token, loop_lag_monitor, loop_lag_threshold, use_uvloop, http_host
+    global http_port, shared_queue_file, instance_name, shared_queue_lease, shared_queue_poll_interval
+    global ledger_dir, ledger_flush_interval, sender_workers, chat_order_window, mark_read_rpc_rate
+    config = new_config
+    accounts = config['accounts']
+    distribution_strategy = get_distribution_strategy(config)  # round_robin、random、consistent_hash 或 least_loaded
+    routing_state_max_chats = config.get('routing_state_max_chats', 10000)  # 分配状态最多保存的群组数（LRU），默认10000
+    consistent_hash_vnodes = config.get('consistent_hash_vnodes', 160)  # 一致性哈希每个账户的虚拟节点数，默认160
+    supervisor_interval = config.get('supervisor_interval', 30)  # 检查每个账户连接的间隔（秒），连接断开时自动重连，默认30，0表示不检查
+    supervisor_ping_timeout = config.get('supervisor_ping_timeout', 10)  # 连接检查（Ping）的超时时间（秒），默认10
+
+    # 发送和清除未读标记的节奏参数（可热重载）
+    pacing = PacingConfig.from_config(config)
+
+    # 配置热重载：修改 config.json 后发送 SIGHUP 信号（systemctl reload）即可生效，
+    # 或设置 config_watch_interval 定期检查配置文件是否被修改（秒），默认0表示不检查
+    config_watch_interval = config.get('config_watch_interval', 0)
+
+    # 自动清除未读标记配置
+    auto_mark_read = config.get('auto_mark_read', True)  # 是否自动标记消息为已读，默认 True
+    # mark_read_interval / mark_read_delay 属于节奏参数，见 PacingConfig
+    mark_read_mode = config.get('mark_read_mode', 'incremental')  # incremental: 只清除有新消息的群组；sweep: 每次遍历清除所有群组
+    mark_read_fallback_browse = config.get('mark_read_fallback_browse', False)  # "Read All" 之后是否再模拟浏览消息（备用方法），默认 False
+    browse_state_file = config.get('browse_state_file', 'browse_state.db')  # 备用浏览方法的浏览进度文件（SQLite），相对路径相对于程序目录
+    mark_read_rpc_rate = config.get('mark_read_rpc_rate', 10)  # 所有账户合计每秒最多发送多少个清除未读标记的请求，0表示不限制，默认10
+    # mark_read_on_receive 已废弃（不再监听消息，所以不需要收到消息时立即标记为已读）
+
+    # 图片预处理配置（上传前在进程池中校验、缩放、重新编码图片，需要安装 Pillow）
+    image_preprocess = config.get('image_preprocess', False)  # 是否启用图片预处理，默认 False
+    image_preprocess_workers = config.get('image_preprocess_workers', 2)  # 预处理进程池大小，默认2
+    image_max_side = config.get('image_max_side', 2560)  # 图片最长边（像素），超过则等比缩小，默认2560（Telegram 会压缩到此尺寸）
+    image_target_bytes = config.get('image_target_bytes', 1024 * 1024)  # 重新编码的目标大小（字节），默认1MB
+    image_cache_size = config.get('image_cache_size', 128)  # 预处理结果缓存条数（按内容哈希），默认128
+
+    # 上传限制配置（/api/send 请求体流式解析）
+    max_upload_size = config.get('max_upload_size', 20 * 1024 * 1024)  # 单个请求体/图片的最大字节数，超过返回 413，默认20MB
+    upload_spool_threshold = config.get('upload_spool_threshold', 1024 * 1024)  # 图片超过此大小（字节）后转存到临时文件，默认1MB
+    photo_prefetch_workers = config.get('photo_prefetch_workers', 4)  # 后台同时下载图片 URL 的数量，默认4
+    task_status_max = config.get('task_status_max', 10000)  # 最多保存多少条消息的状态（LRU），供 /api/tasks/{task_id} 查询，默认10000
+
+    # 并发发送配置：多个发送任务同时从队列取消息，同一群组的消息按入队顺序发送
+    sender_workers = config.get('sender_workers', 1)  # 同时发送消息的任务数，每个任务独立执行模拟操作的节奏延迟，默认1（逐条发送）
+    chat_order_window = config.get('chat_order_window', 1)  # 同一群组最多同时发送的消息数（按入队顺序开始发送），默认1
+
+    # 事件流配置（/api/events）
+    event_buffer_size = config.get('event_buffer_size', 1000)  # 事件环形缓冲区大小（条），订阅者落后超过此数量时跳过旧事件，默认1000
+
+    # 停止程序配置：停止接收新消息，等待正在发送的消息完成，剩余消息保存到检查点文件，下次启动时恢复
+    shutdown_drain_timeout = config.get('shutdown_drain_timeout', 20)  # 停止时等待正在进行的请求和发送完成的最长时间（秒），默认20秒
+    checkpoint_file = config.get('checkpoint_file', 'queue_checkpoint.json')  # 检查点文件，相对路径相对于程序目录
+
+    # 群发任务配置（/api/campaigns）
+    campaign_dir = config.get('campaign_dir', 'campaigns')  # 群发任务的目标列表、图片和进度保存目录，相对路径相对于程序目录
+    campaign_window = config.get('campaign_window', 10)  # 每个群发任务同时放入队列的最大消息数，其余目标按需从文件读取，默认10
+
+    # 链路追踪配置：记录每条消息在接收、排队、节奏延迟、发送请求等阶段的耗时
+    trace_buffer_size = config.get('trace_buffer_size', 1000)  # 保留最近多少条消息的追踪记录（/api/admin/traces），0表示不保留，默认1000
+    trace_export_file = config.get('trace_export_file', '')  # 追踪记录导出文件（OTLP JSON，每行一条），相对路径相对于程序目录，默认为空（不导出）
+
+    # 发送记录配置（/api/ledger/*）：每次发送的结果追加到按天分段的二进制文件，用于按账户、群组统计
+    ledger_dir = config.get('ledger_dir', 'ledger')  # 发送记录目录，相对路径相对于程序目录，为空表示不记录，默认 ledger
+    ledger_flush_interval = config.get('ledger_flush_interval', 1.0)  # 批量写入发送记录的间隔（秒），默认1秒
+
+    # 诊断配置（/api/admin/*），admin_token 为空时诊断接口返回 404，不产生任何开销
+    admin_token = config.get('admin_token', '')  # 诊断接口的访问令牌（请求头 X-Admin-Token 或 Authorization: Bearer），默认为空（禁用）
+    loop_lag_monitor = config.get('loop_lag_monitor', False)  # 是否监控事件循环延迟并记录阻塞事件循环的调用栈，默认 False
+    loop_lag_threshold = config.get('loop_lag_threshold', 0.1)  # 事件循环被阻塞超过此时间（秒）时记录调用栈，默认0.1秒
+
+    # 验证配置合理性
+    if config_watch_interval < 0:
+        logger.warning(f"config_watch_interval 配置值 {config_watch_interval} 无效，使用默认值 0")
+        config_watch_interval = 0
+    if mark_read_mode not in ('incremental', 'sweep'):
+        logger.warning(f"mark_read_mode 配置值 {mark_read_mode} 无效，使用默认值 incremental")
+        mark_read_mode = 'incremental'
+    if not isinstance(mark_read_rpc_rate, (int, float)) or mark_read_rpc_rate < 0:
+        logger.warning(f"mark_read_rpc_rate 配置值 {mark_read_rpc_rate} 无效，使用默认值 10")
+        mark_read_rpc_rate = 10
+    if not isinstance(browse_state_file, str) or not browse_state_file:
+        logger.warning(f"browse_state_file 配置值 {browse_state_file} 无效，使用默认值 browse_state.db")
+        browse_state_file = 'browse_state.db'
+    if not os.path.isabs(browse_state_file):
+        browse_state_file = os.path.join(os.path.dirname(CONFIG_PATH), browse_state_file)
+    if not isinstance(admin_token, str):
+        logger.warning("admin_token 配置值无效（必须是字符串），诊断接口已禁用")
+        admin_token = ''
+    if loop_lag_threshold <= 0:
+        logger.warning(f"loop_lag_threshold 配置值 {loop_lag_threshold} 无效，使用默认值 0.1")
+        loop_lag_threshold = 0.1
+    if not isinstance(sender_workers, int) or sender_workers < 1:
+        logger.warning(f"sender_workers 配置值 {sender_workers} 无效，使用默认值 1")
+        sender_workers = 1
+    if not isinstance(chat_order_window, int) or chat_order_window < 1:
+        logger.warning(f"chat_order_window 配置值 {chat_order_window} 无效，使用默认值 1")
+        chat_order_window = 1
+    if shutdown_drain_timeout < 0:
+        logger.warning(f"shutdown_drain_timeout 配置值 {shutdown_drain_timeout} 无效，使用默认值 20")
+        shutdown_drain_timeout = 20
+    if not isinstance(checkpoint_file, str) or not checkpoint_file:
+        logger.warning(f"checkpoint_file 配置值 {checkpoint_file} 无效，使用默认值 queue_checkpoint.json")
+        checkpoint_file = 'queue_checkpoint.json'
+    if not os.path.isabs(checkpoint_file):
+        checkpoint_file = os.path.join(os.path.dirname(CONFIG_PATH), checkpoint_file)
+    if not isinstance(campaign_dir, str) or not campaign_dir:
+        logger.warning(f"campaign_dir 配置值 {campaign_dir} 无效，使用默认值 campaigns")
+        campaign_dir = 'campaigns'
+    if not os.path.isabs(campaign_dir):
+        campaign_dir = os.path.join(os.path.dirname(CONFIG_PATH), campaign_dir)
+    if campaign_window < 1:
+        logger.warning(f"campaign_window 配置值 {campaign_window} 无效，使用默认值 10")
+        campaign_window = 10
+    if trace_buffer_size < 0:
+        logger.warning(f"trace_buffer_size 配置值 {trace_buffer_size} 无效，使用默认值 1000")
+        trace_buffer_size = 1000
+    if not isinstance(trace_export_file, str):
+        logger.warning("trace_export_file 配置值无效（必须是字符串），不导出追踪记录")
+        trace_export_file = ''
+    if trace_export_file and not os.path.isabs(trace_export_file):
+        trace_export_file = os.path.join(os.path.dirname(CONFIG_PATH), trace_export_file)
+    if not isinstance(ledger_dir, str):
+        logger.warning("ledger_dir 配置值无效（必须是字符串），使用默认值 ledger")
+        ledger_dir = 'ledger'
+    if ledger_dir and not os.path.isabs(ledger_dir):
+        ledger_dir = os.path.join(os.path.dirname(CONFIG_PATH), ledger_dir)
+    if ledger_flush_interval <= 0:
+        logger.warning(f"ledger_flush_interval 配置值 {ledger_flush_interval} 无效，使用默认值 1.0")
+        ledger_flush_interval = 1.0
+    if event_buffer_size < 1:
+        logger.warning(f"event_buffer_size 配置值 {event_buffer_size} 无效，使用默认值 1000")
+        event_buffer_size = 1000
+    if routing_state_max_chats < 1:
+        logger.warning(f"routing_state_max_chats 配置值 {routing_state_max_chats} 无效，使用默认值 10000")
+        routing_state_max_chats = 10000
+    if consistent_hash_vnodes < 1:
+        logger.warning(f"consistent_hash_vnodes 配置值 {consistent_hash_vnodes} 无效，使用默认值 160")
+        consistent_hash_vnodes = 160
+    if supervisor_interval < 0:
+        logger.warning(f"supervisor_interval 配置值 {supervisor_interval} 无效，使用默认值 30")
+        supervisor_interval = 30
+    if supervisor_ping_timeout <= 0:
+        logger.warning(f"supervisor_ping_timeout 配置值 {supervisor_ping_timeout} 无效，使用默认值 10")
+        supervisor_ping_timeout = 10
+    if image_preprocess_workers < 1:
+        logger.warning(f"image_preprocess_workers 配置值 {image_preprocess_workers} 无效，使用默认值 2")
+        image_preprocess_workers = 2
+    if image_max_side < 320 or image_max_side > 10000:
+        logger.warning(f"image_max_side 配置值 {image_max_side} 无效，使用默认值 2560")
+        image_max_side = 2560
+    if image_target_bytes < 32 * 1024 or image_target_bytes > TELEGRAM_PHOTO_MAX_BYTES:
+        logger.warning(f"image_target_bytes 配置值 {image_target_bytes} 无效，使用默认值 {1024 * 1024}")
+        image_target_bytes = 1024 * 1024
+    if image_cache_size < 0:
+        logger.warning(f"image_cache_size 配置值 {image_cache_size} 无效，使用默认值 128")
+        image_cache_size = 128
+    if max_upload_size <= 0:
+        logger.warning(f"max_upload_size 配置值 {max_upload_size} 无效，使用默认值 {20 * 1024 * 1024}")
+        max_upload_size = 20 * 1024 * 1024
+    if upload_spool_threshold < 0:
+        logger.warning(f"upload_spool_threshold 配置值 {upload_spool_threshold} 无效，使用默认值 {1024 * 1024}")
+        upload_spool_threshold = 1024 * 1024
+    if photo_prefetch_workers < 1:
+        logger.warning(f"photo_prefetch_workers 配置值 {photo_prefetch_workers} 无效，使用默认值 4")
+        photo_prefetch_workers = 4
+    if task_status_max < 1:
+        logger.warning(f"task_status_max 配置值 {task_status_max} 无效，使用默认值 10000")
+        task_status_max = 10000
+    if image_preprocess:
+        try:
+            import PIL  # noqa: F401  仅检查是否安装，真正的导入在预处理子进程中进行
+        except ImportError:
+            logger.warning("image_preprocess 已启用，但未安装 Pillow（pip install Pillow），图片预处理已禁用")
+            image_preprocess = False
+
+    # 事件循环配置：启用后使用 uvloop（需要安装 uvloop，仅支持 Linux/macOS），在 setup_event_loop() 中设置
+    use_uvloop = config.get('use_uvloop', False)
+
+    # HTTP API 配置（现在只支持 HTTP API，所以总是启用）
+    http_host = '0.0.0.0'  # HTTP服务器监听地址（固定为0.0.0.0，监听所有接口）
+    http_port = config.get('http_port', 8000)  # HTTP服务器端口，默认8000
+
+    # 验证HTTP配置
+    if http_port < 1 or http_port > 65535:
+        logger.warning(f"http_port 配置值 {http_port} 无效，使用默认值 8000")
+        http_port = 8000
+
+    # 多实例共享队列配置：同一台机器上的多个实例（各自使用不同的账户和端口）共用一个 SQLite 队列文件，
+    # Nginx 可以把请求分发到任意实例，每个实例只领取自己的账户能访问的群组的消息
+    shared_queue_file = config.get('shared_queue_file', '')  # 共享队列文件（SQLite），相对路径相对于程序目录，默认为空（使用进程内队列）
+    instance_name = config.get('instance_name', '') or f"{socket.gethostname()}:{http_port}"  # 实例名称，默认为 主机名:端口
+    shared_queue_lease = config.get('shared_queue_lease', 60)  # 领取消息的租约时间（秒），实例异常退出后超过此时间消息可被其他实例重新领取，默认60
+    shared_queue_poll_interval = config.get('shared_queue_poll_interval', 0.5)  # 队列为空时检查其他实例放入的新消息的间隔（秒），默认0.5
+
+    if not isinstance(shared_queue_file, str):
+        logger.warning("shared_queue_file 配置值无效（必须是字符串），使用进程内队列")
+        shared_queue_file = ''
+    if shared_queue_file and not os.path.isabs(shared_queue_file):
+        shared_queue_file = os.path.join(os.path.dirname(CONFIG_PATH), shared_queue_file)
+    if shared_queue_lease < 10:
+        logger.warning(f"shared_queue_lease 配置值 {shared_queue_lease} 无效（最小10秒），使用默认值 60")
+        shared_queue_lease = 60
+    if shared_queue_poll_interval <= 0:
+        logger.warning(f"shared_queue_poll_interval 配置值 {shared_queue_poll_interval} 无效，使用默认值 0.5")
+        shared_queue_poll_interval = 0.5
+
+def setup_event_loop():
+    """启用 use_uvloop 时设置 uvloop 事件循环（必须在创建客户端之前调用）"""
+    global use_uvloop
+    if use_uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            # Pyrogram 在创建客户端时通过 get_event_loop() 获取事件循环，这里预先创建
+            asyncio.set_event_loop(asyncio.new_event_loop())
+        except ImportError:
+            logger.warning("use_uvloop 已启用，但未安装 uvloop（pip install uvloop），使用默认事件循环")
+            use_uvloop = False
+
+# ========== 日志部分 ==========
+# 自定义文件名格式：将 client_tguserbot.log.YYYY-MM-DD 转换为 client_tguserbot_YYYYMMDD.log
+def namer(name):
+    """自定义日志文件名格式"""
+    # TimedRotatingFileHandler 默认格式是：client_tguserbot.log.YYYY-MM-DD
+    # 我们需要转换为：client_tguserbot_YYYYMMDD.log
+    base_name = os.path.basename(name)
+    dir_name = os.path.dirname(name)
+    
+    if '.' in base_name:
+        parts = base_name.split('.')
+        if len(parts) >= 3:
+            # 提取日期部分（最后一个部分，格式为 YYYY-MM-DD）
+            date_str = parts[-1]
+            # 转换为 YYYYMMDD 格式
+            date_formatted = date_str.replace('-', '')
+            # 返回新格式：client_tguserbot_YYYYMMDD.log
+            return os.path.join(dir_name, f'client_tguserbot_{date_formatted}.log')
+    
+    # 如果格式不符合预期，返回原文件名
+    return name
+
+def setup_logging():
+    """配置日志：按天轮转的日志文件和控制台输出（run() 调用；测试中使用 create_app() 时不写日志文件）"""
+    # 配置日志路径（支持相对路径和绝对路径）
+    log_dir_config = config.get('log_dir', 'logs')
+    if os.path.isabs(log_dir_config):
+        # 绝对路径
+        log_dir = log_dir_config
+    else:
+        # 相对路径，相对于脚本目录
+        log_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), log_dir_config)
+    
+    os.makedirs(log_dir, exist_ok=True)
+    # 使用基础日志文件名（不包含日期，TimedRotatingFileHandler会自动添加日期后缀）
+    log_file_base = os.path.join(log_dir, 'client_tguserbot.log')
+    
+    # 配置日志格式
+    # 从环境变量或配置中读取日志级别，默认为 INFO
+    log_level = config.get('log_level', 'INFO').upper()
+    
+    # 使用 TimedRotatingFileHandler 实现按天自动轮转日志文件
+    from logging.handlers import TimedRotatingFileHandler
+    
+    # 创建按天轮转的文件处理器（每天午夜轮转）
+    file_handler = TimedRotatingFileHandler(
+        filename=log_file_base,
+        when='midnight',  # 每天午夜轮转
+        interval=1,  # 每1天
+        backupCount=0,  # 保留所有历史日志文件（不自动删除）
+        encoding='utf-8'
+    )
+    file_handler.namer = namer
+    
+    # 创建控制台处理器
+    console_handler = logging.StreamHandler(sys.stdout)
+    
+    # 设置日志格式
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler.setFormatter(formatter)
+    console_handler.setFormatter(formatter)
+    
+    # 配置根日志记录器
+    root_logger = logging.getLogger()
+    root_logger.setLevel(getattr(logging, log_level, logging.INFO))
+    root_logger.addHandler(file_handler)
+    root_logger.addHandler(console_handler)
+    
+    # 获取当前日志文件名（用于显示）
+    # 使用当前日期生成日志文件名
+    current_log_file = os.path.join(log_dir, f'client_tguserbot_{datetime.now().strftime("%Y%m%d")}.log')
+    
+    logger.info(f"日志文件路径: {current_log_file}")
+    logger.info(f"配置了 {len(accounts)} 个账户")
+    logger.info(f"分配策略: {distribution_strategy}")
+# ========== 客户端部分 ==========
+# Pyrogram 客户端列表（run() 中调用 create_clients() 创建）
+clients: List[Client] = []
+workdir = os.path.dirname(os.path.abspath(__file__))
+
+def create_client(account: dict) -> Client:
+    """根据账户配置创建 Pyrogram 客户端（不连接）"""
+    load_pyrogram()
+    api_id = account['api_id']
+    api_hash = account['api_hash']
+    name = account['name']
+    session_name = f'session_{name}_{api_id}'
+    
+    client = Client(
+        session_name,
+        api_id=api_id,
+        api_hash=api_hash,
+        workdir=workdir
+    )
+    logger.info(f"创建客户端: {name} (api_id: {api_id}, session: {session_name})")
+    return client
+
+def create_clients():
+    """为每个账户创建 Pyrogram 客户端（不连接）"""
+    global clients
+    clients = [create_client(account) for account in accounts]
+
+# 记录启动时间，用于过滤历史消息
+start_time = None
+
+# ========== 多租户部分 ==========
+# 配置 tenants 后，发送接口需要 API Key（X-API-Key 或 Authorization: Bearer），
+# 每个租户有独立的速率限制和排队上限，队列按权重在租户之间公平调度（加权公平队列）
+
+# 未配置 tenants 时所有请求属于默认租户
+DEFAULT_TENANT = 'default'
+
+class TokenBucket:
+    """令牌桶：平均每秒 rate 个令牌，最多积累 burst 个"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """取一个令牌，成功返回0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class Tenant:
+    """租户配置、限流状态和统计数据"""
+
+    def __init__(self, name: str, api_key: Optional[str] = None, weight: float = 1.0,
+                 rate_limit: float = 0, burst: Optional[float] = None, max_queued: int = 0):
+        self.name = name
+        self.api_key = api_key
+        self.weight = weight  # 调度权重，队列中都有消息时按权重比例分配发送机会
+        self.rate_limit = rate_limit  # 每秒最多接收的消息数，0表示不限制
+        self.max_queued = max_queued  # 队列中最多排队的消息数，0表示不限制
+        self.bucket = TokenBucket(rate_limit, burst or max(1.0, rate_limit)) if rate_limit > 0 else None
+        # 统计数据
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.rejected_rate = 0
+        self.rejected_quota = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_count = 0
+        self.recent_sent: "deque[float]" = deque()  # 最近60秒内发送完成的时间，用于计算吞吐量
+
+    def apply(self, other: 'Tenant'):
+        """热重载时使用新配置，保留统计数据（限流参数变化时重建令牌桶）"""
+        if (other.rate_limit, other.bucket.burst if other.bucket else None) != (self.rate_limit, self.bucket.burst if self.bucket else None):
+            self.bucket = other.bucket
+        self.api_key = other.api_key
+        self.weight = other.weight
+        self.rate_limit = other.rate_limit
+        self.max_queued = other.max_queued
+
+    def record_sent(self, ok: bool):
+        now = time.monotonic()
+        if ok:
+            self.sent += 1
+            self.recent_sent.append(now)
+        else:
+            self.failed += 1
+        while self.recent_sent and self.recent_sent[0] < now - 60:
+            self.recent_sent.popleft()
+
+    def record_wait(self, seconds: float):
+        self.wait_total += seconds
+        self.wait_count += 1
+        self.wait_max = max(self.wait_max, seconds)
+
+    def get_stats(self, queued: int) -> dict:
+        now = time.monotonic()
+        return {
+            "weight": self.weight,
+            "rate_limit": self.rate_limit,
+            "max_queued": self.max_queued,
+            "queued": queued,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "rejected_rate_limit": self.rejected_rate,
+            "rejected_quota": self.rejected_quota,
+            "sent_last_minute": sum(1 for t in self.recent_sent if t >= now - 60),
+            "avg_queue_wait_seconds": round(self.wait_total / self.wait_count, 3) if self.wait_count else 0.0,
+            "max_queue_wait_seconds": round(self.wait_max, 3),
+        }
+
+def parse_tenants(config: dict) -> Dict[str, Tenant]:
+    """读取 tenants 配置，返回 {租户名称: Tenant}，无效的租户记录警告后跳过"""
+    tenants: Dict[str, Tenant] = {}
+    api_keys = set()
+    for item in config.get('tenants', []) or []:
+        name = item.get('name') if isinstance(item, dict) else None
+        api_key = item.get('api_key') if isinstance(item, dict) else None
+        if not name or not isinstance(api_key, str) or not api_key:
+            logger.warning(f"租户配置无效（必须包含 name 和 api_key），已跳过: {name or item}")
+            continue
+        if name in tenants or api_key in api_keys:
+            logger.warning(f"租户 {name} 的名称或 api_key 重复，已跳过")
+            continue
+        weight = item.get('weight', 1)
+        rate_limit = item.get('rate_limit', 0)
+        burst = item.get('burst')
+        max_queued = item.get('max_queued', 0)
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            logger.warning(f"租户 {name} 的 weight 配置值 {weight} 无效，使用默认值 1")
+            weight = 1
+        if not isinstance(rate_limit, (int, float)) or rate_limit < 0:
+            logger.warning(f"租户 {name} 的 rate_limit 配置值 {rate_limit} 无效，使用默认值 0（不限制）")
+            rate_limit = 0
+        if burst is not None and (not isinstance(burst, (int, float)) or burst < 1):
+            logger.warning(f"租户 {name} 的 burst 配置值 {burst} 无效，使用默认值")
+            burst = None
+        if not isinstance(max_queued, int) or max_queued < 0:
+            logger.warning(f"租户 {name} 的 max_queued 配置值 {max_queued} 无效，使用默认值 0（不限制）")
+            max_queued = 0
+        tenants[name] = Tenant(name, api_key, weight, rate_limit, burst, max_queued)
+        api_keys.add(api_key)
+    return tenants
+
+class FairQueue:
+    """按租户加权公平调度的消息队列，接口与 asyncio.Queue 相同（put/get/qsize/empty/task_done/join）
+
+    每条消息入队时计算虚拟完成时间：max(当前虚拟时间, 该租户上一条消息的完成时间) + 1/权重，
+    出队时取各租户队首中虚拟完成时间最小的消息。所有租户都有积压时，发送机会按权重比例分配；
+    某个租户突发大量消息只会拉长它自己的排队时间，不会推迟其他租户的消息
+
+    同一群组的有序消息（ordered 为 True）入队时分配递增的序号（chat_seq），只有序号在该群组未完成的消息中
+    排前 order_window 位的消息才能取出；取出时还不能发送的消息先暂存，前面的消息完成（task_done）后
+    放回所在租户队列的最前面。多个发送任务并发时，不同群组的消息同时发送，同一群组的消息按入队顺序发送
+    """
+
+    def __init__(self, order_window: int = 1):
+        self._queues: Dict[str, "deque[tuple]"] = {}  # 租户名称 -> deque[(虚拟完成时间, 消息)]
+        self._last_finish: Dict[str, float] = {}
+        self._weights: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._size = 0  # 可以取出的消息数（不含暂存的消息）
+        self._unfinished = 0
+        self._not_empty = asyncio.Event()
+        self._finished = asyncio.Event()
+        self._finished.set()
+        self.order_window = order_window  # 同一群组最多同时取出（正在发送）的有序消息数
+        # 群组键 -> [下一个序号, 未完成的序号（升序）, {序号: 暂存的消息}]
+        self._chats: Dict[str, list] = {}
+        self._parked = 0
+
+    def set_weight(self, tenant: str, weight: float):
+        self._weights[tenant] = weight
+
+    def put_nowait(self, task):
+        tenant = getattr(task, 'tenant', DEFAULT_TENANT)
+        finish = max(self._virtual_time, self._last_finish.get(tenant, 0.0)) + 1.0 / self._weights.get(tenant, 1.0)
+        self._last_finish[tenant] = finish
+        self._queues.setdefault(tenant, deque()).append((finish, task))
+        task.queue_order = finish  # 图片预取按此顺序下载
+        if getattr(task, 'ordered', False) and task.chat_seq is None:
+            state = self._chats.setdefault(chat_key(task.chat_id), [0, [], {}])
+            task.chat_seq = state[0]
+            state[0] += 1
+            state[1].append(task.chat_seq)
+        self._size += 1
+        self._unfinished += 1
+        self._finished.clear()
+        self._not_empty.set()
+
+    async def put(self, task):
+        self.put_nowait(task)
+
+    def requeue(self, task):
+        """把已取出但未发送的消息放回所在租户队列的最前面（不重复计入未完成数，保留群组内的序号）"""
+        tenant = getattr(task, 'tenant', DEFAULT_TENANT)
+        self._queues.setdefault(tenant, deque()).appendleft((self._virtual_time, task))
+        self._size += 1
+        self._not_empty.set()
+
+    def _may_start(self, task) -> bool:
+        """有序消息的序号是否在该群组未完成的消息中排前 order_window 位"""
+        if getattr(task, 'chat_seq', None) is None:
+            return True
+        pending = self._chats[chat_key(task.chat_id)][1]
+        return bisect.bisect_left(pending, task.chat_seq) < self.order_window
+
+    def get_nowait(self):
+        while True:
+            best = None
+            for tenant, queue in self._queues.items():
+                if queue and (best is None or queue[0][0] < self._queues[best][0][0]):
+                    best = tenant
+            if best is None:
+                raise asyncio.QueueEmpty
+            finish, task = self._queues[best].popleft()
+            if not self._queues[best]:
+                del self._queues[best]
+            self._virtual_time = finish
+            self._size -= 1
+            if self._may_start(task):
+                return task
+            # 同一群组前面的消息还没有发送完成，暂存到前面的消息完成后再放回队列
+            self._chats[chat_key(task.chat_id)][2][task.chat_seq] = task
+            self._parked += 1
+
+    async def get(self):
+        while True:
+            while self._size == 0:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            try:
+                return self.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+
+    def qsize(self) -> int:
+        return self._size + self._parked
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def qsize_of(self, tenant: str) -> int:
+        """某个租户正在排队的消息数（不含暂存的消息）"""
+        queue = self._queues.get(tenant)
+        return len(queue) if queue else 0
+
+    def items(self) -> list:
+        """队列中所有消息（按入队顺序分租户排列，用于统计和保存检查点）
+
+        暂存的消息排在最后；同一群组的有序消息在它们所占的位置上按序号重新排列
+        （放回队列、暂存的消息可能不在原来的位置），恢复检查点时仍按原来的顺序发送
+        """
+        tasks = [task for queue in self._queues.values() for _, task in queue]
+        tasks += [task for state in self._chats.values() for task in state[2].values()]
+        positions = defaultdict(list)
+        for index, task in enumerate(tasks):
+            if getattr(task, 'chat_seq', None) is not None:
+                positions[chat_key(task.chat_id)].append(index)
+        for indexes in positions.values():
+            for index, task in zip(indexes, sorted((tasks[i] for i in indexes), key=lambda t: t.chat_seq)):
+                tasks[index] = task
+        return tasks
+
+    def _finish_ordered(self, task):
+        """有序消息完成：从所在群组未完成的序号中移除，可以发送的暂存消息按序号放回队列的最前面"""
+        key = chat_key(task.chat_id)
+        state = self._chats.get(key)
+        if state is None:
+            return
+        pending, parked = state[1], state[2]
+        index = bisect.bisect_left(pending, task.chat_seq)
+        if index < len(pending) and pending[index] == task.chat_seq:
+            del pending[index]
+        ready = [seq for seq in sorted(parked) if bisect.bisect_left(pending, seq) < self.order_window]
+        for seq in reversed(ready):
+            parked_task = parked.pop(seq)
+            self._queues.setdefault(getattr(parked_task, 'tenant', DEFAULT_TENANT), deque()).appendleft((self._virtual_time, parked_task))
+        if ready:
+            self._size += len(ready)
+            self._parked -= len(ready)
+            self._not_empty.set()
+        if not pending and not parked:
+            del self._chats[key]
+
+    def get_order_stats(self) -> dict:
+        """群组顺序发送的统计信息"""
+        return {"window": self.order_window, "chats": len(self._chats), "parked": self._parked}
+
+    def task_done(self, task=None):
+        if self._unfinished <= 0:
+            raise ValueError('task_done() called too many times')
+        if task is not None and getattr(task, 'chat_seq', None) is not None:
+            self._finish_ordered(task)
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._finished.set()
+
+    async def join(self):
+        if self._unfinished:
+            await self._finished.wait()
+
+def chat_key(chat_id: Union[int, str]) -> str:
+    """群组在共享队列中的键：数字ID转换为字符串，用户名去掉 @ 并转换为小写"""
+    if isinstance(chat_id, int):
+        return str(chat_id)
+    return chat_id.lstrip('@').lower()
+
+class SharedQueue:
+    """多个实例共用的消息队列（SQLite，WAL 模式），接口与 FairQueue 相同
+
+    - 取出消息时加租约（shared_queue_lease 秒），发送过程中由 run() 定期续约；发送完成（task_done）后删除，
+      放回队列（requeue）时释放租约。实例异常退出后租约过期，消息会被其他实例重新领取（至少发送一次）
+    - 每个实例定期登记自己的账户能访问的群组（Pyrogram session 中已知的群组和频道），只领取这些群组的消息；
+      没有任何在线实例能访问的群组的消息，任何实例都可以领取
+    - 群发任务的消息只由创建该群发任务的实例领取（进度保存在该实例中）
+    - 租户加权公平调度与 FairQueue 相同，虚拟时间和每个租户上一条消息的完成时间保存在数据库中
+    - 有序消息以队列中的消息ID作为群组内的序号：同一群组前面还有 order_window 条未完成的有序消息时不领取，
+      所有实例之间都按入队顺序发送
+
+    所有数据库操作在同一个连接上串行执行（线程锁），put/get 在线程池中执行，不阻塞事件循环；
+    task_done/requeue 在线程池中后台执行，关闭数据库之前由 flush() 等待完成
+    """
+
+    def __init__(self, path: str, instance: str, lease: float, poll_interval: float, order_window: int = 1):
+        self.path = path
+        self.instance = instance
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.order_window = order_window
+        self._weights: Dict[str, float] = {}
+        self._claimed: Dict[int, MessageTask] = {}  # 本实例已领取、尚未完成的消息，key: 队列中的消息ID
+        self._not_empty = asyncio.Event()
+        self._lock = threading.Lock()
+        self._size_cache = (0.0, 0)  # (查询时间, 等待中的消息数)
+        self._tenant_size_cache: Dict[str, tuple] = {}  # key: 租户名称，value: (查询时间, 该租户等待中的消息数)
+        self._pending: Set[asyncio.Future] = set()  # 后台执行中的 task_done/requeue 数据库操作
+        self._db = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_key TEXT NOT NULL, tenant TEXT NOT NULL, finish REAL NOT NULL, "
+            "data BLOB NOT NULL, photo BLOB, owner TEXT, lease_until REAL NOT NULL DEFAULT 0, attempts INTEGER NOT NULL DEFAULT 0, "
+            "pinned TEXT, ordered INTEGER NOT NULL DEFAULT 1);"
+            "CREATE INDEX IF NOT EXISTS messages_finish ON messages (finish);"
+            "CREATE INDEX IF NOT EXISTS messages_tenant ON messages (tenant, lease_until);"
+            "CREATE TABLE IF NOT EXISTS tenant_finish (tenant TEXT PRIMARY KEY, finish REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS virtual_time (id INTEGER PRIMARY KEY CHECK (id = 0), value REAL NOT NULL);"
+            "INSERT OR IGNORE INTO virtual_time (id, value) VALUES (0, 0);"
+            "CREATE TABLE IF NOT EXISTS instances (instance TEXT PRIMARY KEY, heartbeat REAL NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS instance_chats ("
+            "instance TEXT NOT NULL, chat_key TEXT NOT NULL, PRIMARY KEY (instance, chat_key)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS instance_chats_chat ON instance_chats (chat_key);"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(messages)")}
+        if 'pinned' not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN pinned TEXT")
+        if 'ordered' not in columns:
+            self._db.execute("ALTER TABLE messages ADD COLUMN ordered INTEGER NOT NULL DEFAULT 1")
+        self._db.execute("CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat_key, ordered, id)")
+        # 本实例上次退出时未完成的消息（正常退出时已释放）立即释放
+        self._db.execute("UPDATE messages SET owner = NULL, lease_until = 0 WHERE owner = ?", (instance,))
+        self._heartbeat()
+
+    def set_weight(self, tenant: str, weight: float):
+        self._weights[tenant] = weight
+
+    def _execute_write(self, func, *args):
+        """在事务中执行写操作（BEGIN IMMEDIATE，多个实例之间串行）"""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def _insert(self, task: 'MessageTask'):
+        tenant = task.tenant
+        (virtual_time,) = self._db.execute("SELECT value FROM virtual_time WHERE id = 0").fetchone()
+        row = self._db.execute("SELECT finish FROM tenant_finish WHERE tenant = ?", (tenant,)).fetchone()
+        finish = max(virtual_time, row[0] if row else 0.0) + 1.0 / self._weights.get(tenant, 1.0)
+        self._db.execute("INSERT OR REPLACE INTO tenant_finish (tenant, finish) VALUES (?, ?)", (tenant, finish))
+        # 图片以 BLOB 保存，不在 JSON 中重复保存
+        photo = task.photo
+        if photo is not None and not isinstance(photo, bytes):
+            photo = task.read_photo()
+        saved_photo, task.photo = task.photo, None
+        try:
+            data = task.to_checkpoint()
+        finally:
+            task.photo = saved_photo
+        if task.trace.enqueued_at is None:
+            # 排队时间从写入共享队列时开始计算
+            data["trace"]["enqueued_at"] = time.perf_counter() - task.trace.start
+        # 群发任务的进度保存在创建它的实例中，消息只由该实例发送
+        pinned = self.instance if task.campaign_id is not None else None
+        self._db.execute(
+            "INSERT INTO messages (chat_key, tenant, finish, data, photo, pinned, ordered) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (chat_key(task.chat_id), tenant, finish, json_dumps(data), photo, pinned, 1 if task.ordered else 0)
+        )
+
+    def put_nowait(self, task: 'MessageTask'):
+        try:
+            self._execute_write(self._insert, task)
+        finally:
+            task.close()
+        self._size_cache = (self._size_cache[0], self._size_cache[1] + 1)
+        checked_at, size = self._tenant_size_cache.get(task.tenant, (0.0, 0))
+        self._tenant_size_cache[task.tenant] = (checked_at, size + 1)
+        self._not_empty.set()
+
+    async def put(self, task: 'MessageTask'):
+        await asyncio.to_thread(self.put_nowait, task)
+
+    def _claim(self) -> Optional['MessageTask']:
+        now = time.time()
+        row = self._db.execute(
+            "SELECT id, data, photo, finish, attempts FROM messages m WHERE lease_until < ? AND (pinned = ? OR (pinned IS NULL AND ("
+            "EXISTS (SELECT 1 FROM instance_chats WHERE instance = ? AND chat_key = m.chat_key) "
+            "OR NOT EXISTS (SELECT 1 FROM instance_chats c JOIN instances i ON i.instance = c.instance "
+            "WHERE c.chat_key = m.chat_key AND i.heartbeat > ?)))) "
+            # 有序消息：同一群组前面未完成（排队中或正在发送）的有序消息少于 order_window 条
+            "AND (m.ordered = 0 OR (SELECT COUNT(*) FROM (SELECT 1 FROM messages p WHERE p.chat_key = m.chat_key "
+            "AND p.ordered = 1 AND p.id < m.id LIMIT ?)) < ?) "
+            "ORDER BY finish LIMIT 1",
+            (now, self.instance, self.instance, now - self.lease, self.order_window, self.order_window)
+        ).fetchone()
+        if row is None:
+            return None
+        queue_id, data, photo, finish, attempts = row
+        self._db.execute(
+            "UPDATE messages SET owner = ?, lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+            (self.instance, now + self.lease, queue_id)
+        )
+        self._db.execute("UPDATE virtual_time SET value = MAX(value, ?) WHERE id = 0", (finish,))
+        task = MessageTask.from_state(json_loads(data), photo)
+        task.queue_id = queue_id
+        if task.ordered:
+            task.chat_seq = queue_id
+        if attempts:
+            logger.warning(f"共享队列中的消息 {queue_id}（群组 {task.chat_id}）租约过期后被重新领取（第 {attempts + 1} 次），可能重复发送")
+        return task
+
+    def get_nowait(self) -> 'MessageTask':
+        task = self._execute_write(self._claim)
+        if task is None:
+            raise asyncio.QueueEmpty
+        self._claimed[task.queue_id] = task
+        return task
+
+    async def get(self) -> 'MessageTask':
+        while True:
+            self._not_empty.clear()
+            claim = asyncio.ensure_future(asyncio.to_thread(self.get_nowait))
+            try:
+                return await asyncio.shield(claim)
+            except asyncio.QueueEmpty:
+                pass
+            except asyncio.CancelledError:
+                # 取消时数据库操作仍在线程中执行，领取到的消息立即释放
+                claim.add_done_callback(
+                    lambda f: self.requeue(f.result()) if not f.cancelled() and f.exception() is None else None
+                )
+                raise
+            # 本实例放入的消息立即唤醒，其他实例放入的消息按 poll_interval 检查
+            try:
+                await asyncio.wait_for(self._not_empty.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _in_background(self, func, *args):
+        """在线程池中执行数据库操作，不等待结果；完成后唤醒等待领取的发送任务（同一群组的下一条有序消息可以领取了）"""
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        self._pending.add(future)
+        future.add_done_callback(self._background_done)
+
+    def _background_done(self, future: asyncio.Future):
+        self._pending.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"共享队列数据库操作失败: {str(future.exception())}")
+        self._not_empty.set()
+
+    def _release(self, queue_id: int):
+        with self._lock:
+            self._db.execute(
+                "UPDATE messages SET owner = NULL, lease_until = 0, attempts = attempts - 1 WHERE id = ? AND owner = ?",
+                (queue_id, self.instance)
+            )
+
+    def _delete(self, queue_id: int):
+        with self._lock:
+            deleted = self._db.execute(
+                "DELETE FROM messages WHERE id = ? AND owner = ?", (queue_id, self.instance)
+            ).rowcount
+        if not deleted:
+            logger.warning(f"共享队列中的消息 {queue_id} 的租约已被其他实例领取，可能已重复发送")
+
+    def requeue(self, task: 'MessageTask'):
+        """释放租约，消息按原来的顺序重新等待发送（任意实例都可以领取）"""
+        self._claimed.pop(task.queue_id, None)
+        self._in_background(self._release, task.queue_id)
+
+    def task_done(self, task: Optional['MessageTask'] = None):
+        """消息已处理完成（发送成功或放弃），从共享队列中删除"""
+        if task is None:
+            raise ValueError('SharedQueue.task_done() 需要传入已完成的消息')
+        self._claimed.pop(task.queue_id, None)
+        self._in_background(self._delete, task.queue_id)
+
+    async def flush(self):
+        """等待后台执行中的 task_done/requeue 完成（关闭数据库之前调用）"""
+        while self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    def qsize(self) -> int:
+        """所有实例等待发送的消息数（结果缓存 poll_interval 秒，避免每个请求都统计整个队列）"""
+        checked_at, size = self._size_cache
+        now = time.monotonic()
+        if now - checked_at >= self.poll_interval:
+            with self._lock:
+                (size,) = self._db.execute("SELECT COUNT(*) FROM messages WHERE lease_until < ?", (time.time(),)).fetchone()
+            self._size_cache = (now, size)
+        return size
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def qsize_of(self, tenant: str) -> int:
+        """某个租户在所有实例中排队的消息数（结果缓存 poll_interval 秒，与 qsize 相同）"""
+        checked_at, size = self._tenant_size_cache.get(tenant, (0.0, 0))
+        now = time.monotonic()
+        if now - checked_at >= self.poll_interval:
+            with self._lock:
+                (size,) = self._db.execute(
+                    "SELECT COUNT(*) FROM messages WHERE tenant = ? AND lease_until < ?", (tenant, time.time())
+                ).fetchone()
+            self._tenant_size_cache[tenant] = (now, size)
+        return size
+
+    def campaign_offsets(self) -> Dict[str, List[int]]:
+        """本实例的群发任务在队列中的消息的目标位置（启动时用于恢复群发进度）"""
+        offsets = defaultdict(list)
+        with self._lock:
+            for (data,) in self._db.execute("SELECT data FROM messages WHERE pinned = ?", (self.instance,)):
+                data = json_loads(data)
+                if data.get("campaign_id") is not None:
+                    offsets[data["campaign_id"]].append(data.get("campaign_offset"))
+        return offsets
+
+    def items(self) -> list:
+        """消息保存在数据库中，进程内不持有等待发送的消息（停止程序时不需要保存检查点）"""
+        return []
+
+    def _heartbeat(self):
+        """更新本实例的在线时间，并为正在处理的消息续约"""
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO instances (instance, heartbeat) VALUES (?, ?)", (self.instance, now))
+            if self._claimed:
+                self._db.executemany(
+                    "UPDATE messages SET lease_until = ? WHERE id = ? AND owner = ?",
+                    [(now + self.lease, queue_id, self.instance) for queue_id in self._claimed]
+                )
+
+    def _set_chats(self, keys: set):
+        current = {key for (key,) in self._db.execute("SELECT chat_key FROM instance_chats WHERE instance = ?", (self.instance,))}
+        self._db.executemany("DELETE FROM instance_chats WHERE instance = ? AND chat_key = ?", [(self.instance, key) for key in current - keys])
+        self._db.executemany("INSERT INTO instance_chats (instance, chat_key) VALUES (?, ?)", [(self.instance, key) for key in keys - current])
+        return len(keys - current), len(current - keys)
+
+    async def set_chats(self, keys: set):
+        """登记本实例的账户能访问的群组（只写入变化的部分）"""
+        added, removed = await asyncio.to_thread(self._execute_write, self._set_chats, keys)
+        if added or removed:
+            logger.info(f"共享队列: 本实例可访问的群组已更新（新增 {added} 个，移除 {removed} 个，共 {len(keys)} 个）")
+
+    async def run(self, get_chats, chats_interval: float = 60):
+        """定期续约和发送心跳（每 lease/3 秒），并每 chats_interval 秒重新登记可访问的群组（get_chats 在线程中调用）"""
+        next_chats = 0.0
+        while True:
+            try:
+                await asyncio.to_thread(self._heartbeat)
+                if time.monotonic() >= next_chats:
+                    await self.set_chats(await asyncio.to_thread(get_chats))
+                    next_chats = time.monotonic() + chats_interval
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"共享队列心跳失败: {str(e)}", exc_info=True)
+            await asyncio.sleep(self.lease / 3)
+
+    def close(self):
+        """释放本实例领取但未完成的消息，注销实例并关闭数据库"""
+        with self._lock:
+            self._db.execute("UPDATE messages SET owner = NULL, lease_until = 0 WHERE owner = ?", (self.instance,))
+            self._db.execute("DELETE FROM instance_chats WHERE instance = ?", (self.instance,))
+            self._db.execute("DELETE FROM instances WHERE instance = ?", (self.instance,))
+            self._db.close()
+
+    def get_order_stats(self) -> dict:
+        """群组顺序发送的统计信息（顺序由领取条件保证，本实例不暂存消息）"""
+        return {"window": self.order_window}
+
+    def get_stats(self) -> dict:
+        """共享队列的统计信息"""
+        now = time.time()
+        with self._lock:
+            (pending,) = self._db.execute("SELECT COUNT(*) FROM messages WHERE lease_until < ?", (now,)).fetchone()
+            (leased,) = self._db.execute("SELECT COUNT(*) FROM messages WHERE lease_until >= ?", (now,)).fetchone()
+            instances = [
+                {"instance": instance, "chats": chats, "last_heartbeat": round(now - heartbeat, 1)}
+                for instance, heartbeat, chats in self._db.execute(
+                    "SELECT i.instance, i.heartbeat, (SELECT COUNT(*) FROM instance_chats c WHERE c.instance = i.instance) "
+                    "FROM instances i WHERE i.heartbeat > ? ORDER BY i.instance", (now - self.lease,)
+                )
+            ]
+        return {
+            "instance": self.instance,
+            "pending": pending,
+            "leased": leased,
+            "claimed_here": len(self._claimed),
+            "instances": instances,
+        }
+
+class TenantRegistry:
+    """租户列表：按 API Key 认证、准入检查（速率限制和排队上限）和统计"""
+
+    def __init__(self, config: dict, queue: FairQueue):
+        self.queue = queue
+        self.tenants: Dict[str, Tenant] = {DEFAULT_TENANT: Tenant(DEFAULT_TENANT)}
+        self.by_key: Dict[str, Tenant] = {}
+        self.load(config)
+
+    @property
+    def enabled(self) -> bool:
+        """是否配置了租户（未配置时发送接口不需要 API Key）"""
+        return bool(self.by_key)
+
+    def load(self, config: dict):
+        """加载（或热重载）租户配置，已有租户保留统计数据"""
+        tenants = {DEFAULT_TENANT: self.tenants[DEFAULT_TENANT]}
+        for name, tenant in parse_tenants(config).items():
+            if name in self.tenants:
+                self.tenants[name].apply(tenant)
+                tenant = self.tenants[name]
+            tenants[name] = tenant
+        self.tenants = tenants
+        self.by_key = {tenant.api_key: tenant for tenant in tenants.values() if tenant.api_key}
+        for name, tenant in tenants.items():
+            self.queue.set_weight(name, tenant.weight)
+
+    def authenticate(self, request: Request) -> Tenant:
+        """根据请求头中的 API Key 确定租户，未配置租户时返回默认租户"""
+        if not self.by_key:
+            return self.tenants[DEFAULT_TENANT]
+        api_key = request.headers.get('x-api-key')
+        if api_key is None:
+            authorization = request.headers.get('authorization', '')
+            if authorization.lower().startswith('bearer '):
+                api_key = authorization[7:].strip()
+        tenant = self.by_key.get(api_key) if api_key else None
+        if tenant is None:
+            raise HTTPException(status_code=401, detail="需要有效的 API Key（X-API-Key 或 Authorization: Bearer）")
+        return tenant
+
+    def admit(self, tenant: Tenant):
+        """检查租户的排队上限和速率限制，超过时返回 429"""
+        if tenant.max_queued and self.queue.qsize_of(tenant.name) >= tenant.max_queued:
+            tenant.rejected_quota += 1
+            raise HTTPException(status_code=429, detail=f"租户 {tenant.name} 排队的消息已达到上限 {tenant.max_queued} 条")
+        if tenant.bucket is not None:
+            wait = tenant.bucket.try_acquire()
+            if wait > 0:
+                tenant.rejected_rate += 1
+                raise HTTPException(
+                    status_code=429,
+                    detail=f"租户 {tenant.name} 超过速率限制（每秒 {tenant.rate_limit} 条）",
+                    headers={"Retry-After": str(max(1, int(wait + 0.999)))},
+                )
+
+    def get(self, name: str) -> Tenant:
+        """按名称获取租户（租户已被删除时返回默认租户，用于统计）"""
+        return self.tenants.get(name) or self.tenants[DEFAULT_TENANT]
+
+    def get_stats(self) -> Dict[str, dict]:
+        return {
+            name: tenant.get_stats(self.queue.qsize_of(name))
+            for name, tenant in self.tenants.items()
+            if name != DEFAULT_TENANT or not self.enabled or tenant.enqueued
+        }
+
+# 消息队列，用于排队发送（按租户加权公平调度，未配置租户时等同于先进先出队列）；
+# 配置了 shared_queue_file 时使用多个实例共用的队列（create_app() 中创建）
+message_queue: Optional[Union[FairQueue, SharedQueue]] = None
+
+# 租户列表（create_app() 中创建）
+tenant_registry: Optional[TenantRegistry] = None
+
+# ========== 消息分配部分 ==========
+class LRUDict(OrderedDict):
+    """有容量上限的字典，超过上限时淘汰最久未使用的条目"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get_or_create(self, key, factory):
+        """获取 key 对应的值（不存在时用 factory() 创建），并标记为最近使用"""
+        if key in self:
+            self.move_to_end(key)
+            return self[key]
+        value = factory()
+        self[key] = value
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+        return value
+
+class HashRing:
+    """一致性哈希环：每个账户按名称映射到多个虚拟节点，增删账户时只有约 1/N 的群组会换账户"""
+
+    def __init__(self, names: List[str], vnodes: int):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[int] = []
+        points = []
+        for index, name in enumerate(names):
+            for replica in range(vnodes):
+                points.append((self._hash(f"{name}#{replica}"), index))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._owners = [owner for _, owner in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def candidates(self, key):
+        """按环上顺时针顺序依次返回 key 对应的账户索引（不重复）"""
+        if not self._points:
+            return
+        start = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        seen = set()
+        for offset in range(len(self._points)):
+            owner = self._owners[(start + offset) % len(self._points)]
+            if owner not in seen:
+                seen.add(owner)
+                yield owner
+
+# least_loaded 策略中账户分配负载的半衰期（秒）：较早分配的消息对负载的影响逐渐减小
+ROUTER_LOAD_HALF_LIFE = 300
+
+class ChatRouter:
+    """根据分配策略为群组选择发送账户
+
+    每个群组的分配状态保存在有上限的 LRU 中，内存占用不会随群组数量无限增长
+    """
+
+    def __init__(self, strategy: str, account_names: List[str], max_chats: int, vnodes: int):
+        self.strategy = strategy
+        self.max_chats = max_chats
+        self.vnodes = vnodes
+        # 每个群组的客户端轮询索引（用于 round_robin 策略）
+        self.chat_client_index: "LRUDict[Union[int, str], int]" = LRUDict(max_chats)
+        # 每个群组每个客户端的使用计数（用于 random 策略，确保更均匀的分配）
+        self.chat_client_usage: "LRUDict[Union[int, str], Dict[int, int]]" = LRUDict(max_chats)
+        self.set_accounts(account_names)
+
+    def set_accounts(self, account_names: List[str]):
+        """设置账户列表（账户增删后调用），按索引保存的使用计数随之清空"""
+        self.account_names = list(account_names)
+        self.hash_ring = HashRing(self.account_names, self.vnodes)
+        self.chat_client_usage.clear()
+        # 每个账户最近分配的消息数（按 ROUTER_LOAD_HALF_LIFE 衰减，用于 least_loaded 策略）
+        self.loads: List[float] = [0.0] * len(self.account_names)
+        self.load_updated: List[float] = [time.monotonic()] * len(self.account_names)
+
+    def _load(self, index: int, now: float) -> float:
+        """账户最近的分配负载（按时间指数衰减）"""
+        return self.loads[index] * 0.5 ** ((now - self.load_updated[index]) / ROUTER_LOAD_HALF_LIFE)
+
+    def select(self, chat_id: Union[int, str], is_available=None, score=None) -> int:
+        """为群组选择账户，返回账户索引
+
+        is_available(index) 用于判断账户当前是否可用（连接断开、检查失败或正在限流等待），各策略都优先选择可用账户，
+        全部不可用时按原策略选择；score(index) 返回账户的健康分（0~1，least_loaded 策略使用，默认都为1）
+        """
+        count = len(self.account_names)
+        if count == 0:
+            raise ValueError("没有可用的客户端")
+        available = [i for i in range(count) if is_available is None or is_available(i)]
+        
+        if self.strategy == 'round_robin':
+            # 轮询策略：每个群组按顺序使用不同的客户端，跳过不可用的客户端
+            counter = self.chat_client_index.get_or_create(chat_id, int)
+            index = counter % count
+            if available and index not in available:
+                while (counter % count) not in available:
+                    counter += 1
+                logger.debug(f"轮询分配：群组 {chat_id} 的客户端 {self.account_names[index]} 不可用，顺延到 {self.account_names[counter % count]}")
+                index = counter % count
+            self.chat_client_index[chat_id] = counter + 1
+            logger.debug(f"轮询分配：群组 {chat_id} 使用客户端 {self.account_names[index]} (索引: {index})")
+            return index
+        elif self.strategy == 'random':
+            # 随机策略：使用加权随机分配，确保更均匀
+            # 优先选择使用次数较少的客户端，但仍然保持随机性
+            usage = self.chat_client_usage.get_or_create(chat_id, dict)
+            
+            # 计算每个可用客户端的使用次数
+            candidates = available or list(range(count))
+            usage_counts = [usage.get(i, 0) for i in candidates]
+            min_usage = min(usage_counts)
+            
+            # 找出使用次数最少的客户端（可能有多个），有多个时随机选择一个
+            # 这样可以确保均匀分配，同时保持随机性
+            least_used_indices = [i for i, used in zip(candidates, usage_counts) if used == min_usage]
+            index = random.choice(least_used_indices)
+            
+            # 更新使用计数
+            usage[index] = usage.get(index, 0) + 1
+            logger.debug(f"随机分配（加权）：群组 {chat_id} 使用客户端 {self.account_names[index]} (索引: {index}, 使用次数: {usage[index]})")
+            return index
+        elif self.strategy == 'consistent_hash':
+            # 一致性哈希策略：同一个群组固定由哈希环上的账户发送，不需要保存每个群组的状态
+            # 主账户不可用时沿哈希环顺延到下一个可用账户
+            primary = None
+            for index in self.hash_ring.candidates(chat_id):
+                if primary is None:
+                    primary = index
+                if is_available is None or is_available(index):
+                    if index != primary:
+                        logger.debug(f"一致性哈希分配：群组 {chat_id} 的主账户 {self.account_names[primary]} 不可用，顺延到 {self.account_names[index]}")
+                    else:
+                        logger.debug(f"一致性哈希分配：群组 {chat_id} 使用客户端 {self.account_names[index]} (索引: {index})")
+                    return index
+            logger.warning(f"一致性哈希分配：群组 {chat_id} 没有可用账户，使用主账户 {self.account_names[primary]}")
+            return primary
+        elif self.strategy == 'least_loaded':
+            # 最小负载策略：选择 (最近分配负载 + 1) / 健康分 最小的账户，
+            # 延迟升高、出错或限流的账户健康分下降，分到的消息随之减少
+            now = time.monotonic()
+            costs = {}
+            for i in available or range(count):
+                health = score(i) if score is not None else 1.0
+                costs[i] = (self._load(i, now) + 1) / max(health, HEALTH_MIN_SCORE)
+            min_cost = min(costs.values())
+            index = random.choice([i for i, cost in costs.items() if cost == min_cost])
+            self.loads[index] = self._load(index, now) + 1
+            self.load_updated[index] = now
+            logger.debug(f"最小负载分配：群组 {chat_id} 使用客户端 {self.account_names[index]} (索引: {index}, 负载: {self.loads[index]:.2f})")
+            return index
+        else:
+            # 默认使用第一个客户端
+            logger.warning(f"未知的分配策略: {self.strategy}，使用第一个客户端")
+            return 0
+
+    def export_state(self) -> dict:
+        """导出每个群组的分配状态（按最近使用顺序），用于检查点文件"""
+        return {
+            "strategy": self.strategy,
+            "accounts": self.account_names,
+            "round_robin": [[chat_id, counter] for chat_id, counter in self.chat_client_index.items()],
+            "random": [[chat_id, list(usage.items())] for chat_id, usage in self.chat_client_usage.items()],
+        }
+
+    def import_state(self, state: dict):
+        """恢复 export_state 导出的分配状态（账户列表变化时 random 策略的计数不再有效，不恢复）"""
+        for chat_id, counter in state.get("round_robin", []):
+            self.chat_client_index[chat_id] = counter
+        if state.get("accounts") == self.account_names:
+            for chat_id, usage in state.get("random", []):
+                self.chat_client_usage[chat_id] = {int(index): count for index, count in usage}
+        for table in (self.chat_client_index, self.chat_client_usage):
+            while len(table) > self.max_chats:
+                table.popitem(last=False)
+
+    def get_stats(self) -> dict:
+        """获取分配状态的统计信息"""
+        stats = {
+            "strategy": self.strategy,
+            "tracked_chats": len(self.chat_client_index) + len(self.chat_client_usage),
+            "max_chats": self.max_chats,
+        }
+        if self.strategy == 'least_loaded':
+            now = time.monotonic()
+            stats["loads"] = {name: round(self._load(i, now), 2) for i, name in enumerate(self.account_names)}
+        return stats
+
+# 发送任务当前正在使用的客户端，key: 发送任务名称
+busy_clients: Dict[str, Client] = {}
+
+# 每个账户的发送锁，key: 账户名称。发送任务选定账户后一直占用到本条消息的模拟操作、发送和发送后休息结束，
+# 多个发送任务并发时同一账户不会同时执行两条消息，账户的发送间隔不会因为发送任务增多而缩短
+account_send_locks: Dict[str, asyncio.Lock] = {}
+
+# 发送任务当前所处的阶段，key: 发送任务名称，value: idle（等待消息）、pacing（模拟真人延迟）、
+# sending（请求 Telegram 发送中）、rest（本条消息已完成）；停止程序时据此决定等待还是立即取消
+sender_phases: Dict[str, str] = {}
+
+# 停止程序时设置：发送任务不再开始新消息（取出的消息和还在模拟延迟的消息放回队列），只等待已在 sending 阶段的发送完成
+sender_stopping = False
+
+class SenderStopped(Exception):
+    """sender_stopping 已设置，发送任务放回当前消息后退出"""
+
+# 消息分配器（保存每个群组的分配状态，create_app() 中创建）
+router: Optional[ChatRouter] = None
+
+# ========== 账户健康部分 ==========
+# 每个账户的健康分（0~1）由最近的请求耗时、错误率和限流历史计算，least_loaded 策略据此把消息从状态变差的账户移走；
+# 连接断开、连续检查失败或正在限流等待的账户所有策略都会跳过
+
+HEALTH_MIN_SCORE = 0.01  # 健康分下限，避免 least_loaded 策略计算时除以0
+HEALTH_LATENCY_REFERENCE = 1.0  # 请求耗时（指数移动平均）达到此值（秒）时健康分减半
+HEALTH_RESULT_WINDOW = 50  # 按最近多少次请求的结果计算错误率
+HEALTH_FLOOD_WINDOW = 3600  # 统计最近多少秒内的限流等待
+HEALTH_FLOOD_REFERENCE = 600  # 最近的限流等待累计达到此值（秒）时健康分减半
+SUPERVISOR_FAILURE_THRESHOLD = 2  # 连续多少次连接检查失败后认为账户不可用并重新连接
+SUPERVISOR_MIN_BACKOFF = 5  # 重新连接失败后的最短等待时间（秒），之后每次失败翻倍
+SUPERVISOR_MAX_BACKOFF = 300  # 重新连接失败后的最长等待时间（秒）
+SUPERVISOR_CONNECT_TIMEOUT = 60  # 重新连接（断开并重新启动客户端）的超时时间（秒）
+SENDER_MAX_REROUTES = 3  # 一条消息因连接异常最多重新分配账户的次数，超过后按发送失败处理
+
+class AccountHealth:
+    """一个账户的健康状况：请求耗时、最近请求的成败、限流历史和连接检查结果"""
+
+    def __init__(self):
+        self.alive = True  # 连接检查是否正常（连续失败或发送时连接出错后为 False，重新连接成功后恢复）
+        self.latency: Optional[float] = None  # 请求耗时的指数移动平均（秒）
+        self.results: "deque[bool]" = deque(maxlen=HEALTH_RESULT_WINDOW)  # 最近请求是否成功
+        self.floods: "deque[tuple]" = deque()  # 最近的限流 (时间, 等待秒数)
+        self.flood_until = 0.0  # 正在限流等待时为等待结束的时间
+        self.failures = 0  # 连续的连接检查失败次数
+        self.backoff = 0.0  # 当前的重新连接等待时间（秒）
+        self.reconnects = 0  # 重新连接成功的次数
+        self.next_check = 0.0  # 下次连接检查（或重新连接）的时间，设为0时连接监控立即检查
+        self.last_error: Optional[str] = None
+
+    def record_latency(self, seconds: float):
+        """记录一次请求耗时"""
+        self.latency = seconds if self.latency is None else self.latency * 0.8 + seconds * 0.2
+
+    def record_result(self, ok: bool, error: Optional[str] = None):
+        """记录一次请求的结果"""
+        self.results.append(ok)
+        if not ok and error:
+            self.last_error = error
+
+    def record_flood(self, seconds: float):
+        """记录一次限流（FloodWait），等待期间账户视为不可用"""
+        now = time.monotonic()
+        self.floods.append((now, seconds))
+        self.flood_until = max(self.flood_until, now + seconds)
+
+    def flood_seconds(self) -> float:
+        """最近 HEALTH_FLOOD_WINDOW 秒内累计的限流等待时间"""
+        cutoff = time.monotonic() - HEALTH_FLOOD_WINDOW
+        while self.floods and self.floods[0][0] < cutoff:
+            self.floods.popleft()
+        return sum(seconds for _, seconds in self.floods)
+
+    def error_rate(self) -> float:
+        if not self.results:
+            return 0.0
+        return self.results.count(False) / len(self.results)
+
+    def is_available(self) -> bool:
+        return self.alive and time.monotonic() >= self.flood_until
+
+    def score(self) -> float:
+        """健康分（0~1）：连接不可用时为0，否则为耗时、错误率、限流三个因子的乘积"""
+        if not self.alive:
+            return 0.0
+        latency_factor = 1.0 / (1.0 + (self.latency or 0.0) / HEALTH_LATENCY_REFERENCE)
+        flood_factor = 1.0 / (1.0 + self.flood_seconds() / HEALTH_FLOOD_REFERENCE)
+        return latency_factor * (1.0 - self.error_rate()) * flood_factor
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "alive": self.alive,
+            "score": round(self.score(), 3),
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "error_rate": round(self.error_rate(), 3),
+            "flood_seconds_last_hour": round(self.flood_seconds(), 1),
+            "flood_wait_remaining": round(max(0.0, self.flood_until - now), 1),
+            "reconnects": self.reconnects,
+            "last_error": self.last_error,
+        }
+
+# 每个账户的健康状况，key: 账户名称（热重载增删账户时不需要调整索引）
+account_health: Dict[str, AccountHealth] = defaultdict(AccountHealth)
+
+# ========== 事件流部分 ==========
+# 发送和清除未读标记过程中的结构化事件，通过 /api/events（SSE）推送给订阅者
+
+# SSE 心跳间隔（秒），没有事件时定期发送注释行，避免代理断开空闲连接
+EVENT_HEARTBEAT_INTERVAL = 15
+
+class EventBus:
+    """事件环形缓冲区：发布不阻塞，每个订阅者按自己的偏移量读取
+
+    每个事件有递增的 ID（偏移量），发布时只序列化一次，所有订阅者共享；
+    订阅者读取慢时不会阻塞发送任务，落后超过缓冲区大小时跳过被覆盖的事件（收到 dropped 事件），
+    断开后可以通过 Last-Event-ID 或 since 参数从指定偏移量继续读取；
+    与消息和群发任务有关的事件带有 tenant 字段，订阅时可以只读取某个租户的事件
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.buffer: "deque[tuple]" = deque(maxlen=capacity)  # (事件ID, 事件类型, JSON 数据, 租户名称)
+        self.next_id = 0
+        self.subscribers = 0
+        self._waiter: Optional[asyncio.Event] = None
+
+    def publish(self, event_type: str, **fields):
+        """发布事件（同步调用，不会等待订阅者）"""
+        event_id = self.next_id
+        self.next_id += 1
+        fields['id'] = event_id
+        fields['type'] = event_type
+        fields['ts'] = time.time()
+        self.buffer.append((event_id, event_type, json_dumps(fields), fields.get('tenant')))
+        if self._waiter is not None:
+            # 唤醒所有等待新事件的订阅者
+            self._waiter.set()
+            self._waiter = None
+
+    def read(self, offset: int) -> tuple:
+        """从 offset 开始读取事件，返回 (事件列表, 下一个偏移量, 被覆盖而跳过的事件数)"""
+        first_id = self.next_id - len(self.buffer)
+        dropped = 0
+        if offset < first_id:
+            dropped = first_id - offset
+            offset = first_id
+        if offset >= self.next_id:
+            # 偏移量超出当前范围（如程序重启后事件ID重新计数）时从最新事件开始
+            return [], self.next_id, dropped
+        events = list(islice(self.buffer, offset - first_id, None))
+        return events, self.next_id, dropped
+
+    async def wait(self, timeout: float) -> bool:
+        """等待新事件，超时返回 False"""
+        if self._waiter is None:
+            self._waiter = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._waiter.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def stream(self, offset: int, types: Optional[set] = None, tenant: Optional[str] = None):
+        """按 SSE 格式输出从 offset 开始的事件，没有事件时输出心跳；指定 tenant 时只输出该租户的事件"""
+        self.subscribers += 1
+        try:
+            yield b"retry: 3000\n\n"
+            while True:
+                events, offset, dropped = self.read(offset)
+                if dropped:
+                    # 订阅者落后太多，旧事件已被覆盖
+                    data = json_dumps({'type': 'dropped', 'count': dropped, 'ts': time.time()})
+                    yield b"event: dropped\ndata: " + data + b"\n\n"
+                for event_id, event_type, data, event_tenant in events:
+                    if types and event_type not in types:
+                        continue
+                    if tenant is not None and event_tenant != tenant:
+                        continue
+                    yield f"id: {event_id}\nevent: {event_type}\n".encode() + b"data: " + data + b"\n\n"
+                if not events and not await self.wait(EVENT_HEARTBEAT_INTERVAL):
+                    yield b": heartbeat\n\n"
+        finally:
+            self.subscribers -= 1
+
+    def get_stats(self) -> dict:
+        """获取事件流的统计信息"""
+        return {
+            "next_id": self.next_id,
+            "buffered": len(self.buffer),
+            "capacity": self.capacity,
+            "subscribers": self.subscribers,
+        }
+
+# 事件流（create_app() 中创建）
+event_bus: Optional[EventBus] = None
+
+# ========== 链路追踪部分 ==========
+# 每条消息一个 Trace，按阶段记录耗时；完成后放入固定大小的缓冲区，可选导出为 OpenTelemetry（OTLP JSON）格式
+
+class TraceSpan:
+    """记录一个阶段耗时的上下文管理器"""
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace: 'Trace', name: str):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.name, self.start, time.perf_counter(), exc_type.__name__ if exc_type else None)
+        return False
+
+class Trace:
+    """一条消息从收到请求到发送完成的各阶段耗时（时间使用 perf_counter，导出时换算为系统时间）"""
+
+    def __init__(self, source: str):
+        self.trace_id = os.urandom(16).hex()
+        self.source = source  # 接收消息的接口，如 /api/send
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.enqueued_at: Optional[float] = None
+        self.spans: List[tuple] = []  # (阶段名称, 开始时间, 结束时间, 错误类型)
+        self.attributes: Dict[str, Union[int, str, bool]] = {}
+
+    def span(self, name: str) -> TraceSpan:
+        return TraceSpan(self, name)
+
+    def add(self, name: str, start: float, end: float, error: Optional[str] = None):
+        self.spans.append((name, start, end, error))
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "source": self.source,
+            "start": datetime.fromtimestamp(self.wall_start).isoformat(timespec='milliseconds'),
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "spans": [
+                {
+                    "name": name,
+                    "offset_ms": round((start - self.start) * 1000, 3),
+                    "duration_ms": round((end - start) * 1000, 3),
+                    **({"error": error} if error else {}),
+                }
+                for name, start, end, error in self.spans
+            ],
+        }
+
+    def to_state(self) -> dict:
+        """导出为可跨进程保存的字典（阶段时间保存为相对开始时间的偏移），用于检查点文件和共享队列"""
+        state = {
+            "trace_id": self.trace_id,
+            "source": self.source,
+            "wall_start": self.wall_start,
+            "spans": [[name, start - self.start, end - self.start, error] for name, start, end, error in self.spans],
+        }
+        if self.enqueued_at is not None:
+            state["enqueued_at"] = self.enqueued_at - self.start
+        return state
+
+    @classmethod
+    def from_state(cls, state: dict) -> 'Trace':
+        """恢复 to_state 导出的追踪记录，按系统时间换算到当前进程的 perf_counter"""
+        trace = cls(state["source"])
+        trace.trace_id = state["trace_id"]
+        trace.wall_start = state["wall_start"]
+        trace.start = time.perf_counter() - (time.time() - trace.wall_start)
+        trace.spans = [(name, trace.start + start, trace.start + end, error) for name, start, end, error in state["spans"]]
+        if state.get("enqueued_at") is not None:
+            trace.enqueued_at = trace.start + state["enqueued_at"]
+        return trace
+
+    def to_otlp(self) -> dict:
+        """转换为 OTLP JSON（ExportTraceServiceRequest），可被 OpenTelemetry Collector 的 otlpjsonfile 接收器读取"""
+        def nanos(t: float) -> str:
+            return str(int((self.wall_start + t - self.start) * 1e9))
+
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {"key": key, "value": {"boolValue": value}}
+            if isinstance(value, int):
+                return {"key": key, "value": {"intValue": str(value)}}
+            return {"key": key, "value": {"stringValue": str(value)}}
+
+        root_id = os.urandom(8).hex()
+        failed = self.attributes.get("status") == "failed"
+        spans = [{
+            "traceId": self.trace_id,
+            "spanId": root_id,
+            "name": f"message {self.source}",
+            "kind": 2,  # SPAN_KIND_SERVER
+            "startTimeUnixNano": nanos(self.start),
+            "endTimeUnixNano": nanos(self.start + self.duration),
+            "attributes": [attribute(key, value) for key, value in self.attributes.items()],
+            "status": {"code": 2 if failed else 1},
+        }]
+        for name, start, end, error in self.spans:
+            span = {
+                "traceId": self.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": nanos(start),
+                "endTimeUnixNano": nanos(end),
+            }
+            if error:
+                span["status"] = {"code": 2, "message": error}
+            spans.append(span)
+        return {"resourceSpans": [{
+            "resource": {"attributes": [attribute("service.name", "clienttguserbot")]},
+            "scopeSpans": [{"scope": {"name": "clienttguserbot"}, "spans": spans}],
+        }]}
+
+# 追踪记录批量写入导出文件的间隔（秒）
+TRACE_EXPORT_INTERVAL = 1.0
+
+class TraceRecorder:
+    """保存最近 capacity 条已完成的追踪记录；配置了导出文件时先放入缓冲区，由后台任务定期在线程中批量追加到导出文件"""
+
+    def __init__(self, capacity: int, export_path: str = ''):
+        self.traces: "deque[Trace]" = deque(maxlen=capacity)
+        self.export_path = export_path
+        self._export_file = None
+        self._pending: List[Trace] = []  # 尚未写入导出文件的追踪记录
+        self.stopping = False  # 停止程序时设置，后台任务写入剩余的记录后结束
+
+    def finish(self, trace: Optional[Trace], status: str, **attributes):
+        """结束追踪（同一条记录只处理一次）"""
+        if trace is None or trace.end is not None:
+            return
+        trace.end = time.perf_counter()
+        trace.attributes["status"] = status
+        trace.attributes.update(attributes)
+        self.traces.append(trace)
+        if self.export_path:
+            self._pending.append(trace)
+
+    def _write(self, traces: List[Trace]):
+        """把一批追踪记录追加到导出文件（在线程中执行）"""
+        if self._export_file is None:
+            self._export_file = open(self.export_path, 'a', encoding='utf-8')
+        self._export_file.write(''.join(json_dumps(trace.to_otlp()).decode('utf-8') + '\n' for trace in traces))
+        self._export_file.flush()
+
+    async def flush(self):
+        """把缓冲区中的追踪记录批量写入导出文件，写入失败时停止导出"""
+        if not self._pending or not self.export_path:
+            return
+        traces, self._pending = self._pending, []
+        try:
+            await asyncio.to_thread(self._write, traces)
+        except OSError as e:
+            logger.warning(f"导出追踪记录失败，已停止导出: {str(e)}")
+            self.export_path = ''
+
+    async def run(self):
+        """后台任务：每 TRACE_EXPORT_INTERVAL 秒批量写入一次；停止程序时设置 stopping 后等待它写入剩余的记录"""
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await self.flush()
+            if self.stopping:
+                return
+
+    def query(self, limit: int, order: str = 'slowest') -> List[dict]:
+        """按耗时从长到短（slowest）或按时间从新到旧（recent）返回追踪记录"""
+        if order == 'recent':
+            traces = list(reversed(self.traces))[:limit]
+        else:
+            traces = heapq.nlargest(limit, self.traces, key=lambda trace: trace.duration)
+        return [trace.to_dict() for trace in traces]
+
+    def stage_summary(self) -> Dict[str, dict]:
+        """各阶段在缓冲区内所有记录中的次数、平均和最大耗时"""
+        summary: Dict[str, dict] = {}
+        for trace in self.traces:
+            for name, start, end, _ in trace.spans:
+                item = summary.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+                duration_ms = (end - start) * 1000
+                item["count"] += 1
+                item["total_ms"] += duration_ms
+                item["max_ms"] = max(item["max_ms"], duration_ms)
+        for item in summary.values():
+            item["avg_ms"] = round(item["total_ms"] / item["count"], 3)
+            item["total_ms"] = round(item["total_ms"], 3)
+            item["max_ms"] = round(item["max_ms"], 3)
+        return summary
+
+    def close(self):
+        """写入后台任务结束后才完成的追踪记录并关闭导出文件"""
+        if self._pending and self.export_path:
+            try:
+                self._write(self._pending)
+            except OSError as e:
+                logger.warning(f"导出追踪记录失败: {str(e)}")
+        self._pending = []
+        if self._export_file is not None:
+            self._export_file.close()
+            self._export_file = None
+
+# 链路追踪记录（create_app() 中创建）
+trace_recorder: Optional[TraceRecorder] = None
+
+# ========== 发送记录部分 ==========
+# 每次发送的结果追加到按天分段的二进制记录文件 {ledger_dir}/YYYYMMDD.bin（每条记录固定长度），
+# 账户名、租户名和 @username 形式的 chat_id 保存在 names.txt 中，记录中只保存序号；
+# 内存中按 (日期, 账户, 群组, 结果) 汇总次数和耗时，统计接口只查询内存中的汇总，不读取记录文件；
+# 已结束的分段的汇总保存在同名的 .idx 文件中，重启时不需要重新扫描记录文件
+LEDGER_OUTCOMES = ('sent', 'failed', 'flood_wait', 'rerouted')
+LEDGER_GROUPS = ('account', 'chat', 'day', 'outcome')
+# 时间、task_id、chat_id、账户序号、租户序号、结果序号、标志、消息ID、
+# 排队等待、发送请求耗时、从收到请求到得到结果的总耗时、限流等待时间（秒）
+LEDGER_RECORD = struct.Struct('<dQqHHBBIffff')
+LEDGER_CHAT_NAME = 1  # 标志：chat_id 保存的是 names.txt 中的序号
+
+class SendLedger:
+    """发送记录（只追加）：发送结果先放入内存缓冲区，后台任务定期在线程中批量写入当天的分段文件"""
+
+    def __init__(self, directory: str, flush_interval: float):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.names: List[str] = []
+        self.name_ids: Dict[str, int] = {}
+        self._new_names: List[str] = []  # 尚未写入 names.txt 的名称
+        self._pending: Dict[str, List[bytes]] = defaultdict(list)  # 日期 -> 尚未写入的记录
+        # 日期 -> {(账户, chat_id, 结果): [次数, 排队等待合计, 发送耗时合计, 总耗时合计, 限流等待合计]}
+        self.days: Dict[str, Dict[tuple, list]] = {}
+        self._saved_days: set = set()  # 已保存 .idx 的分段
+        self.stopping = False  # 停止程序时设置，后台任务写入剩余的记录后结束
+        self.written = 0
+        self.write_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def _segment_path(self, day: str, suffix: str = '.bin') -> str:
+        return os.path.join(self.directory, day + suffix)
+
+    def _name_id(self, name: str) -> int:
+        index = self.name_ids.get(name)
+        if index is None:
+            index = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            self._new_names.append(name)
+        return index
+
+    def _name(self, index: int) -> str:
+        return self.names[index] if index < len(self.names) else f"#{index}"
+
+    @staticmethod
+    def _add(entries: Dict[tuple, list], key: tuple, values: tuple):
+        entry = entries.get(key)
+        if entry is None:
+            entry = entries[key] = [0, 0.0, 0.0, 0.0, 0.0]
+        entry[0] += 1
+        for i, value in enumerate(values, 1):
+            entry[i] += value
+
+    def record(self, task: MessageTask, outcome: str, account: Optional[str], message_id: int = 0, flood_wait: float = 0.0):
+        """记录一次发送结果（outcome 为 LEDGER_OUTCOMES 之一），只写入内存缓冲区"""
+        if not self.enabled:
+            return
+        now = time.time()
+        day = datetime.fromtimestamp(now).strftime('%Y%m%d')
+        queue_wait = send = 0.0
+        for name, start, end, _ in task.trace.spans:
+            if name == 'queue_wait':
+                queue_wait += end - start
+            elif name in ('send', 'retry_send'):
+                send += end - start
+        total = time.perf_counter() - task.trace.start
+        account = account or ''
+        chat, flags = task.chat_id, 0
+        if not isinstance(chat, int):
+            chat, flags = self._name_id(str(chat)), LEDGER_CHAT_NAME
+        try:
+            task_key = int(task.task_id[:16], 16)
+        except ValueError:
+            task_key = 0
+        self._pending[day].append(LEDGER_RECORD.pack(
+            now, task_key, chat, self._name_id(account), self._name_id(task.tenant), LEDGER_OUTCOMES.index(outcome),
+            flags, message_id or 0, queue_wait, send, total, flood_wait
+        ))
+        self._add(self.days.setdefault(day, {}), (account, task.chat_id, outcome), (queue_wait, send, total, flood_wait))
+
+    def _write(self, pending: Dict[str, List[bytes]], names: List[str]):
+        """写入名称和记录（在线程中执行），写入成功的部分从参数中移除"""
+        os.makedirs(self.directory, exist_ok=True)
+        if names:
+            with open(os.path.join(self.directory, 'names.txt'), 'a', encoding='utf-8') as f:
+                f.write(''.join(name + '\n' for name in names))
+            names.clear()
+        for day in list(pending):
+            with open(self._segment_path(day), 'ab') as f:
+                f.write(b''.join(pending[day]))
+            self.written += len(pending.pop(day))
+
+    async def flush(self):
+        """把缓冲区中的记录批量写入分段文件，写入失败的记录留到下次重试"""
+        if not self._pending and not self._new_names:
+            return
+        pending, self._pending = self._pending, defaultdict(list)
+        names, self._new_names = self._new_names, []
+        try:
+            await asyncio.to_thread(self._write, pending, names)
+        except OSError as e:
+            self.write_errors += 1
+            logger.warning(f"写入发送记录失败，稍后重试: {str(e)}")
+            self._new_names[:0] = names
+            for day, records in pending.items():
+                self._pending[day][:0] = records
+
+    def _save_index(self, day: str, entries: Dict[tuple, list]):
+        """保存已结束的分段的汇总（记录文件大小用于判断汇总是否过期）"""
+        data = {
+            "size": os.path.getsize(self._segment_path(day)),
+            "entries": [[*key, *values] for key, values in entries.items()],
+        }
+        with open(self._segment_path(day, '.idx'), 'wb') as f:
+            f.write(json_dumps(data))
+
+    def _load_index(self, day: str, size: int) -> Optional[Dict[tuple, list]]:
+        try:
+            with open(self._segment_path(day, '.idx'), 'rb') as f:
+                data = json_loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if data.get("size") != size:
+            return None
+        return {tuple(item[:3]): item[3:] for item in data["entries"]}
+
+    def _scan(self, day: str) -> Dict[tuple, list]:
+        """扫描分段文件重新计算汇总"""
+        entries: Dict[tuple, list] = {}
+        with open(self._segment_path(day), 'rb') as f:
+            data = f.read()
+        for (_, _, chat, account, _, outcome, flags, _, queue_wait, send, total, flood_wait) in LEDGER_RECORD.iter_unpack(data):
+            if flags & LEDGER_CHAT_NAME:
+                chat = self._name(chat)
+            self._add(entries, (self._name(account), chat, LEDGER_OUTCOMES[outcome]), (queue_wait, send, total, flood_wait))
+        return entries
+
+    def load(self):
+        """启动时读取名称表和各分段的汇总（在线程中调用，需要在发送任务启动之前完成）"""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(os.path.join(self.directory, 'names.txt'), 'r', encoding='utf-8') as f:
+                self.names = f.read().splitlines()
+        except FileNotFoundError:
+            self.names = []
+        self.name_ids = {}
+        for index, name in enumerate(self.names):
+            self.name_ids.setdefault(name, index)
+        today = datetime.now().strftime('%Y%m%d')
+        for file_name in sorted(os.listdir(self.directory)):
+            if not re.fullmatch(r'\d{8}\.bin', file_name):
+                continue
+            day = file_name[:8]
+            path = self._segment_path(day)
+            size = os.path.getsize(path)
+            if size % LEDGER_RECORD.size:
+                # 上次写入中断留下的不完整记录
+                size -= size % LEDGER_RECORD.size
+                os.truncate(path, size)
+                logger.warning(f"发送记录 {file_name} 末尾有不完整的记录，已截断")
+            entries = self._load_index(day, size)
+            if entries is None:
+                entries = self._scan(day)
+                if day < today:
+                    self._save_index(day, entries)
+            self.days[day] = entries
+            if day < today:
+                self._saved_days.add(day)
+        logger.info(f"已加载发送记录: {len(self.days)} 天，目录: {self.directory}")
+
+    async def run(self):
+        """后台任务：每 flush_interval 秒批量写入一次，并保存已结束的分段的汇总"""
+        # 写入在线程中进行，无法中途取消；停止程序时不取消本任务，设置 stopping 后等待它写入剩余的记录
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self.stopping:
+                return
+            today = datetime.now().strftime('%Y%m%d')
+            for day in [day for day in self.days if day < today and day not in self._saved_days]:
+                if day in self._pending:
+                    continue
+                try:
+                    await asyncio.to_thread(self._save_index, day, self.days[day])
+                except OSError as e:
+                    logger.warning(f"保存发送记录汇总 {day} 失败: {str(e)}")
+                self._saved_days.add(day)
+
+    def stats(self, since: str, until: str, account: Optional[str], chat_id: Optional[Union[int, str]], group_by: str) -> List[dict]:
+        """按 group_by 分组统计 since 到 until（YYYYMMDD，含两端）之间的发送结果"""
+        groups: Dict[Union[int, str], list] = {}
+        for day, entries in self.days.items():
+            if day < since or day > until:
+                continue
+            for (entry_account, chat, outcome), values in entries.items():
+                if account is not None and entry_account != account:
+                    continue
+                if chat_id is not None and chat != chat_id:
+                    continue
+                key = {'account': entry_account, 'chat': chat, 'day': day, 'outcome': outcome}[group_by]
+                group = groups.get(key)
+                if group is None:
+                    # 各结果的次数，成功发送的排队等待、发送耗时、总耗时合计，限流等待合计
+                    group = groups[key] = [dict.fromkeys(LEDGER_OUTCOMES, 0), 0.0, 0.0, 0.0, 0.0]
+                group[0][outcome] += values[0]
+                if outcome == 'sent':
+                    group[1] += values[1]
+                    group[2] += values[2]
+                    group[3] += values[3]
+                group[4] += values[4]
+        result = []
+        for key, (counts, queue_wait, send, total, flood_wait) in groups.items():
+            sent = counts['sent']
+            result.append({
+                "key": key if group_by != 'day' else f"{key[:4]}-{key[4:6]}-{key[6:]}",
+                **counts,
+                "flood_wait_seconds": round(flood_wait, 1),
+                "avg_queue_wait_ms": round(queue_wait / sent * 1000, 1) if sent else None,
+                "avg_send_ms": round(send / sent * 1000, 1) if sent else None,
+                "avg_total_ms": round(total / sent * 1000, 1) if sent else None,
+            })
+        if group_by == 'day':
+            result.sort(key=lambda item: item["key"])
+        else:
+            result.sort(key=lambda item: item["sent"], reverse=True)
+        return result
+
+    def _read_records(self, day: str) -> list:
+        try:
+            with open(self._segment_path(day), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        return list(LEDGER_RECORD.iter_unpack(data[:len(data) - len(data) % LEDGER_RECORD.size]))
+
+    async def records(self, day: str, account: Optional[str], chat_id: Optional[Union[int, str]],
+                      outcome: Optional[str], limit: int) -> List[dict]:
+        """读取某一天已写入文件的记录（从新到旧，最近 flush_interval 秒内的记录可能还未写入），按账户、群组和结果过滤"""
+        result = []
+        for (timestamp, task_key, chat, account_id, tenant_id, outcome_id, flags, message_id,
+             queue_wait, send, total, flood_wait) in reversed(await asyncio.to_thread(self._read_records, day)):
+            if flags & LEDGER_CHAT_NAME:
+                chat = self._name(chat)
+            record_account = self._name(account_id)
+            if ((account is not None and record_account != account) or (chat_id is not None and chat != chat_id)
+                    or (outcome is not None and LEDGER_OUTCOMES[outcome_id] != outcome)):
+                continue
+            result.append({
+                "time": datetime.fromtimestamp(timestamp).isoformat(timespec='milliseconds'),
+                "task_id": f"{task_key:016x}",
+                "chat_id": chat,
+                "account": record_account,
+                "tenant": self._name(tenant_id),
+                "outcome": LEDGER_OUTCOMES[outcome_id],
+                "message_id": message_id,
+                "queue_wait_ms": round(queue_wait * 1000, 1),
+                "send_ms": round(send * 1000, 1),
+                "total_ms": round(total * 1000, 1),
+                "flood_wait_seconds": round(flood_wait, 1),
+            })
+            if len(result) >= limit:
+                break
+        return result
+
+    def get_stats(self) -> dict:
+        return {
+            "days": len(self.days),
+            "written": self.written,
+            "pending": sum(len(records) for records in self._pending.values()),
+            "write_errors": self.write_errors,
+        }
+
+# 发送记录（create_app() 中创建）
+send_ledger: Optional[SendLedger] = None
+
+class BrowseStateStore:
+    """备用浏览方法的浏览进度：每个账户每个群组只保存一个已浏览到的最大消息ID（高水位）
+
+    内存中每个账户使用两个按 chat_id 排序的定长整数数组（array('q')）二分查找，
+    每条记录固定16字节；持久化到 SQLite（WAL 模式），重启后可以继续增量浏览。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._chat_ids: Dict[str, array] = {}
+        self._high_waters: Dict[str, array] = {}
+
+    def _open(self):
+        """首次使用时打开数据库并加载所有记录"""
+        if self._db is not None:
+            return
+        self._db = sqlite3.connect(self.path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS browse_state ("
+            "account TEXT NOT NULL, chat_id INTEGER NOT NULL, high_water INTEGER NOT NULL, "
+            "PRIMARY KEY (account, chat_id)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        for account, chat_id, high_water in self._db.execute(
+            "SELECT account, chat_id, high_water FROM browse_state ORDER BY account, chat_id"
+        ):
+            self._chat_ids.setdefault(account, array('q')).append(chat_id)
+            self._high_waters.setdefault(account, array('q')).append(high_water)
+        logger.debug(f"已加载浏览进度 {sum(len(ids) for ids in self._chat_ids.values())} 条: {self.path}")
+
+    def get(self, account: str, chat_id: int) -> int:
+        """返回已浏览到的最大消息ID，没有记录时返回0"""
+        self._open()
+        chat_ids = self._chat_ids.get(account)
+        if not chat_ids:
+            return 0
+        pos = bisect.bisect_left(chat_ids, chat_id)
+        if pos < len(chat_ids) and chat_ids[pos] == chat_id:
+            return self._high_waters[account][pos]
+        return 0
+
+    def update(self, account: str, chat_id: int, high_water: int):
+        """更新高水位（只会向前移动），并写入数据库"""
+        self._open()
+        chat_ids = self._chat_ids.setdefault(account, array('q'))
+        high_waters = self._high_waters.setdefault(account, array('q'))
+        pos = bisect.bisect_left(chat_ids, chat_id)
+        if pos < len(chat_ids) and chat_ids[pos] == chat_id:
+            if high_water <= high_waters[pos]:
+                return
+            high_waters[pos] = high_water
+        else:
+            chat_ids.insert(pos, chat_id)
+            high_waters.insert(pos, high_water)
+        self._db.execute(
+            "INSERT INTO browse_state (account, chat_id, high_water) VALUES (?, ?, ?) "
+            "ON CONFLICT(account, chat_id) DO UPDATE SET high_water = excluded.high_water",
+            (account, chat_id, high_water)
+        )
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+# 备用浏览方法的浏览进度（只在 mark_read_fallback_browse 启用时才会打开数据库文件，create_app() 中创建）
+browse_store: Optional[BrowseStateStore] = None
+
+# 每个账户每个群组已清除到的最新消息ID（incremental 模式使用）
+# key: 账户名称, value: {chat_id: 清除时的 top_message ID}，条目数不超过账户加入的群组数
+chat_read_state: Dict[str, Dict[int, int]] = {}
+
+# incremental 模式中被@提及的权重：有提及的群组优先于只有普通未读消息的群组
+MENTION_PRIORITY_WEIGHT = 1000
+
+# Pyrogram get_dialogs 每次请求获取的对话数
+DIALOGS_PAGE_SIZE = 100
+
+# Pyrogram get_chat_history 每次请求获取的消息数
+HISTORY_PAGE_SIZE = 100
+
+# 本实例正在发送消息时，清除未读标记暂停后再次检查的最长间隔（秒）
+MARK_READ_MAX_BACKOFF = 10.0
+
+# 每个账户的群组 InputPeer 缓存，key: 账户名称，value: {chat_id: InputPeer}
+# 第一次使用时从 session 数据库一次读取所有群组，之后不再为每个群组调用 resolve_peer
+chat_input_peers: Dict[str, dict] = {}
+
+class MarkReadRpcBudget:
+    """清除未读标记的全局请求预算，所有账户共用
+
+    - 令牌桶限制所有账户合计每秒最多 mark_read_rpc_rate 个请求（0表示不限制）
+    - 本实例有发送任务正在处理消息（sender_phases 不是 idle）时暂停（0.5秒起、每次翻倍、最长 MARK_READ_MAX_BACKOFF 秒检查一次），
+      所有发送任务都在等待消息时才继续，清除未读标记不与发送消息争用账户的请求频率；
+      只看本实例的发送任务：暂存等待前面消息的有序消息、共享队列中其他实例的消息都不会让清除未读标记一直暂停
+    """
+
+    def __init__(self, rate: float):
+        self.bucket = TokenBucket(rate, max(1.0, rate)) if rate > 0 else None
+        self.requests = 0
+        self.backoffs = 0
+        self.backoff_seconds = 0.0
+        self.throttled_seconds = 0.0
+        self.paused = 0  # 正在因发送消息而暂停的账户数
+
+    async def acquire(self):
+        """每个清除未读标记的请求之前调用，等待到可以发送请求"""
+        delay = 0.5
+        paused = False
+        try:
+            while True:
+                if any(phase != 'idle' for phase in sender_phases.values()):
+                    if not paused:
+                        paused = True
+                        self.paused += 1
+                        self.backoffs += 1
+                    await asyncio.sleep(delay)
+                    self.backoff_seconds += delay
+                    delay = min(delay * 2, MARK_READ_MAX_BACKOFF)
+                    continue
+                wait = self.bucket.try_acquire() if self.bucket is not None else 0.0
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+                self.throttled_seconds += wait
+        finally:
+            if paused:
+                self.paused -= 1
+        self.requests += 1
+
+    def get_stats(self) -> dict:
+        return {
+            "rpc_rate": self.bucket.rate if self.bucket is not None else 0,
+            "requests": self.requests,
+            "backoffs": self.backoffs,
+            "backoff_seconds": round(self.backoff_seconds, 1),
+            "throttled_seconds": round(self.throttled_seconds, 1),
+            "paused": self.paused,
+        }
+
+# 清除未读标记的请求预算（create_app() 中创建）
+mark_read_rpc_budget: Optional[MarkReadRpcBudget] = None
+
+def load_input_peers(client: Client, client_name: str) -> dict:
+    """从账户的 session 数据库一次读取所有群组的 InputPeer（不发起网络请求），读取失败时返回空字典"""
+    peers = {}
+    try:
+        for peer_id, access_hash, peer_type in client.storage.conn.execute(
+            "SELECT id, access_hash, type FROM peers WHERE type IN ('group', 'supergroup', 'channel')"
+        ):
+            peers[peer_id] = get_input_peer(peer_id, access_hash, peer_type)
+    except Exception as e:
+        logger.warning(f"[{client_name}] 读取 session 中的群组列表失败，逐个解析群组: {str(e)}")
+    return peers
+
+async def get_chat_peer(client: Client, client_name: str, chat_id: int):
+    """从缓存中取群组的 InputPeer，缓存中没有（新加入的群组）时调用 resolve_peer 并缓存"""
+    peers = chat_input_peers.get(client_name)
+    if peers is None:
+        peers = chat_input_peers[client_name] = load_input_peers(client, client_name)
+    peer = peers.get(chat_id)
+    if peer is None:
+        peer = peers[chat_id] = await client.resolve_peer(chat_id)
+    return peer
+
+async def read_chat(client: Client, peer, max_id: int = 0):
+    """标记群组消息为已读（与 client.read_chat_history 相同，但使用已缓存的 InputPeer），max_id 为0表示全部已读"""
+    await mark_read_rpc_budget.acquire()
+    if isinstance(peer, raw.types.InputPeerChannel):
+        await client.invoke(raw.functions.channels.ReadHistory(channel=peer, max_id=max_id))
+    else:
+        await client.invoke(raw.functions.messages.ReadHistory(peer=peer, max_id=max_id))
+
+async def iter_dialogs(client: Client):
+    """遍历账户的对话列表，每请求一页对话列表之前取一次请求预算"""
+    count = 0
+    await mark_read_rpc_budget.acquire()
+    async for dialog in client.get_dialogs():
+        yield dialog
+        count += 1
+        if count % DIALOGS_PAGE_SIZE == 0:
+            # 下一次迭代会请求下一页
+            await mark_read_rpc_budget.acquire()
+
+async def iter_chat_history(client: Client, chat_id: int, **kwargs):
+    """遍历群组的消息历史（参数与 get_chat_history 相同），每请求一页消息之前取一次请求预算"""
+    count = 0
+    await mark_read_rpc_budget.acquire()
+    async for message in client.get_chat_history(chat_id, **kwargs):
+        yield message
+        count += 1
+        if count % HISTORY_PAGE_SIZE == 0:
+            await mark_read_rpc_budget.acquire()
+
+async def fallback_browse_chat(i: int, client: Client, client_name: str, chat_id: int, latest_message_id: Optional[int]):
+    """备用方法：模拟用户打开群组并慢慢滚动浏览消息，逐步标记为已读，清除被@标记
+
+    所有请求（获取群组信息、消息历史、标记已读、ReadMentions）都经过 mark_read_rpc_budget
+    """
+    try:
+        max_msg_id = latest_message_id if latest_message_id else 0
+        if max_msg_id > 0:
+            logger.debug(f"[{client_name}] 开始模拟浏览群组 {chat_id} 信息清除被@标记（备用方法）...")
+        
+        # 1. 获取群组信息（模拟打开群组）
+        peer = await get_chat_peer(client, client_name, chat_id)
+        try:
+            await mark_read_rpc_budget.acquire()
+            chat_info = await client.get_chat(chat_id)
+            chat_title = chat_info.title if hasattr(chat_info, 'title') else 'N/A'
+            logger.debug(f"[{client_name}] 已获取群组信息: {chat_title}")
+            await asyncio.sleep(0.2)  # 模拟用户打开群组的延迟
+        except Exception as e_chat:
+            logger.debug(f"[{client_name}] 获取群组信息时出错: {str(e_chat)}")
+        
+        # 2. 模拟浏览消息历史（增量浏览：从上次浏览位置到最新消息）
+        # 浏览进度按账户名称保存（客户端索引在配置热重载后可能变化），重启后从数据库恢复
+        min_last_id = browse_store.get(client_name, chat_id)  # 上次浏览到的最大消息ID，0表示没有记录
+        
+        # 确定浏览范围
+        is_first_browse = min_last_id == 0
+        
+        if not is_first_browse:
+            # 有上次浏览记录：从上次浏览到的消息ID开始，到最新消息ID结束
+            logger.debug(f"[{client_name}] 群组 {chat_id} 增量浏览：从消息ID {min_last_id} 到 {max_msg_id}")
+            if max_msg_id and max_msg_id <= min_last_id:
+                # 没有新消息，不需要再获取消息历史
+                logger.debug(f"[{client_name}] 群组 {chat_id} 没有新消息（已浏览到消息ID {min_last_id}），跳过浏览")
+                return
+        else:
+            # 第一次浏览：获取最新的消息
+            logger.debug(f"[{client_name}] 群组 {chat_id} 首次浏览：获取最新消息")
+        
+        browse_count = 0
+        last_read_id = 0
+        high_water = min_last_id  # 本次浏览到的最大消息ID（用于更新浏览进度）
+        
+        # 浏览消息：从上次的最小ID到最新消息（如果 max_msg_id 存在）
+        max_browse_id = max_msg_id if max_msg_id and max_msg_id > 0 else None
+        if max_browse_id:
+            logger.debug(f"[{client_name}] 浏览范围：从消息ID {min_last_id if not is_first_browse else '最新'} 到 {max_browse_id}")
+        else:
+            logger.debug(f"[{client_name}] 浏览范围：从消息ID {min_last_id if not is_first_browse else '最新'} 到最新消息（无限制）")
+        
+        # 第一次浏览时，至少浏览最新的10条消息，确保有消息被处理
+        min_browse_count = 10 if is_first_browse else 1
+        
+        logger.debug(f"[{client_name}] 开始浏览，is_first_browse={is_first_browse}, min_last_id={min_last_id}, min_browse_count={min_browse_count}, max_browse_id={max_browse_id}")
+        
+        # 增量浏览：从最新消息开始，获取从 min_last_id 到 max_browse_id 之间的消息
+        # 使用 offset_id=0 从最新消息开始，然后过滤
+        # 模拟客户端慢慢滚动查看消息
+        
+        async for message in iter_chat_history(client, chat_id, limit=0, offset_id=0):
+            if message:
+                # 如果有上次浏览记录，只处理从上次最小ID开始的消息（增量浏览）
+                if not is_first_browse and message.id <= min_last_id:
+                    # 已经到达上次浏览到的消息ID，停止浏览
+                    logger.debug(f"[{client_name}] 已到达上次浏览到的消息ID {min_last_id}，停止浏览")
+                    break
+                
+                # 如果设置了 max_browse_id 且已经超过，停止浏览
+                if max_browse_id and message.id > max_browse_id:
+                    logger.debug(f"[{client_name}] 消息ID {message.id} 超过 max_browse_id {max_browse_id}，停止浏览")
+                    break
+                
+                browse_count += 1
+                high_water = max(high_water, message.id)
+                logger.debug(f"[{client_name}] 浏览消息ID {message.id}（第 {browse_count} 条）")
+                
+                # 模拟用户慢慢滚动查看消息：每条消息后添加随机延迟
+                scroll_delay = random.uniform(pacing.operation_delay_min, pacing.operation_delay_max)
+                await asyncio.sleep(scroll_delay)
+                
+                # 每浏览5-10条消息，标记一次为已读（模拟用户停下来查看）
+                # 随机选择标记间隔，让行为更像真实用户
+                mark_interval = random.randint(5, 10)
+                if browse_count % mark_interval == 0:
+                    try:
+                        await read_chat(client, peer, message.id)
+                        last_read_id = message.id
+                        # 标记为已读后，模拟用户停下来查看的延迟
+                        view_delay = random.uniform(0.5, 1.5)
+                        await asyncio.sleep(view_delay)
+                        logger.debug(f"[{client_name}] 已标记消息ID {message.id} 为已读（浏览了 {browse_count} 条）")
+                    except Exception as e:
+                        logger.debug(f"[{client_name}] 标记消息为已读时出错: {str(e)}")
+                
+                # 随机添加"停下来仔细查看"的延迟（模拟用户对某些消息感兴趣）
+                if random.random() < 0.1:  # 10% 的概率
+                    pause_delay = random.uniform(1.0, 3.0)
+                    await asyncio.sleep(pause_delay)
+                    logger.debug(f"[{client_name}] 模拟停下来仔细查看消息（暂停 {pause_delay:.2f} 秒）")
+                
+                # 如果设置了 max_browse_id 且已经到达，检查是否已经浏览了足够多的消息
+                if max_browse_id and message.id >= max_browse_id:
+                    # 如果还没有浏览足够多的消息，继续浏览（但不会再有消息了，因为已经到达最新）
+                    if browse_count < min_browse_count:
+                        logger.debug(f"[{client_name}] 已到达最新消息ID {max_browse_id}，但还需要浏览 {min_browse_count - browse_count} 条消息")
+                        # 继续尝试浏览，虽然可能没有更多消息了
+                    else:
+                        logger.debug(f"[{client_name}] 已到达最新消息ID {max_browse_id}，已浏览 {browse_count} 条，停止浏览")
+                        break
+                
+                # 限制单次浏览数量，避免一次性浏览过多（最多1000条）
+                if browse_count >= 1000:
+                    logger.debug(f"[{client_name}] 已达到单次浏览上限（1000条），停止浏览")
+                    break
+        
+        # 如果第一次浏览时没有浏览到任何消息，尝试直接获取最新10条
+        if is_first_browse and browse_count == 0:
+            logger.debug(f"[{client_name}] 首次浏览未获取到消息，尝试直接获取最新10条消息")
+            try:
+                async for message in iter_chat_history(client, chat_id, limit=10):
+                    if message:
+                        browse_count += 1
+                        high_water = max(high_water, message.id)
+                        logger.debug(f"[{client_name}] 备用方案浏览消息ID {message.id}（第 {browse_count} 条）")
+                        # 模拟用户慢慢滚动查看消息
+                        scroll_delay = random.uniform(pacing.operation_delay_min, pacing.operation_delay_max)
+                        await asyncio.sleep(scroll_delay)
+                        # 每浏览5-10条消息，标记一次为已读
+                        mark_interval = random.randint(5, 10)
+                        if browse_count % mark_interval == 0:
+                            try:
+                                await read_chat(client, peer, message.id)
+                                last_read_id = message.id
+                                view_delay = random.uniform(0.5, 1.5)
+                                await asyncio.sleep(view_delay)
+                            except Exception:
+                                pass
+            except Exception as e_fallback:
+                logger.warning(f"[{client_name}] 获取最新10条消息失败: {str(e_fallback)}")
+        
+        # 如果增量浏览时没有浏览到任何消息，记录日志
+        if not is_first_browse and browse_count == 0:
+            logger.debug(f"[{client_name}] 增量浏览未获取到新消息（上次浏览到的ID: {min_last_id}, 当前最新ID: {max_browse_id}）")
+        
+        # 更新浏览进度：直接使用本次浏览过的消息ID，不需要再获取一次消息历史
+        if high_water > min_last_id:
+            browse_store.update(client_name, chat_id, high_water)
+            logger.debug(f"[{client_name}] 已更新浏览进度：群组 {chat_id} 浏览到消息ID {high_water}")
+        
+        logger.debug(f"[{client_name}] 已模拟浏览 {browse_count} 条消息，最后标记到消息ID: {last_read_id}")
+        await asyncio.sleep(0.3)  # 模拟用户浏览完成后的延迟
+        
+        # 3. 标记到最新消息为已读（max_msg_id 为0时标记所有消息）
+        await read_chat(client, peer, max_msg_id)
+        
+        # 4. 如果是超级群组，尝试调用 ReadMentions API 作为额外保障
+        try:
+            if isinstance(peer, raw.types.InputPeerChannel):
+                await mark_read_rpc_budget.acquire()
+                await client.invoke(
+                    raw.functions.messages.ReadMentions(
+                        peer=peer,
+                        top_msg_id=max_msg_id if max_msg_id else None
+                    )
+                )
+                logger.debug(f"[{client_name}] 已调用 ReadMentions API 作为额外保障")
+                await asyncio.sleep(0.3)
+        except Exception as e_read_mentions:
+            logger.debug(f"[{client_name}] 调用 ReadMentions API 时出错（不影响主流程）: {str(e_read_mentions)}")
+        
+        logger.info(f"[{client_name}] ✓ 已通过备用方法（模拟浏览）清除群组 {chat_id} 的被@标记（标记到消息ID: {max_msg_id}，浏览了 {browse_count} 条消息）")
+    except Exception as e_mentions:
+        logger.warning(f"[{client_name}] 备用方法（模拟浏览）清除群组 {chat_id} 被@标记时出错: {str(e_mentions)}")
+
+async def mark_chat_read(i: int, client: Client, client_name: str, dialog) -> bool:
+    """清除单个群组的未读消息标记和被@标记（模拟点击"Read All"），ReadHistory 成功时返回 True"""
+    chat_id = dialog.chat.id
+    cleared = False
+    
+    # 1. 从 dialog 中获取未读数（仅用于日志记录）和@提及数（为0时不需要 ReadMentions）
+    unread_count = dialog.unread_messages_count or 0
+    mentions_count = dialog.unread_mentions_count or 0
+    
+    # 2. 获取最新消息ID，用于标记所有消息为已读（包括被回复/被提及的消息）
+    # 方法1：从对话中获取最新消息ID（最可靠）
+    latest_message_id = dialog.top_message.id if dialog.top_message else None
+    
+    # 方法2：如果方法1失败，尝试从消息历史获取
+    if latest_message_id is None:
+        try:
+            await mark_read_rpc_budget.acquire()
+            async for message in client.get_chat_history(chat_id, limit=1):
+                if message:
+                    latest_message_id = message.id
+                    logger.debug(f"[{client_name}] 从消息历史获取群组 {chat_id} 最新消息ID: {latest_message_id}")
+                    break
+        except Exception as e_history:
+            logger.debug(f"[{client_name}] 从消息历史获取最新消息ID失败: {str(e_history)}")
+    
+    # 如果仍然获取失败，记录警告
+    if latest_message_id is None:
+        logger.warning(f"[{client_name}] 无法获取群组 {chat_id} 的最新消息ID，将使用增量浏览方式")
+    else:
+        logger.debug(f"[{client_name}] 群组 {chat_id} 最新消息ID: {latest_message_id}")
+    
+    # 3. 直接模拟点击"Read All"：一次性清除所有未读消息和@标记
+    # ReadHistory 的 max_id 为0，会标记所有消息为已读（类似"Read All"功能）
+    try:
+        # 方法1：标记所有消息为已读（InputPeer 从缓存中获取，不需要每次 resolve_peer）
+        peer = await get_chat_peer(client, client_name, chat_id)
+        await read_chat(client, peer)
+        cleared = True
+        logger.debug(f"[{client_name}] 已标记群组 {chat_id} 所有消息为已读")
+        
+        # 方法2：如果是超级群组且有未读的@提及，调用 ReadMentions API 清除所有@标记
+        if mentions_count > 0 and isinstance(peer, raw.types.InputPeerChannel):
+            try:
+                # 调用 ReadMentions 不指定 top_msg_id，清除所有@标记
+                await mark_read_rpc_budget.acquire()
+                await client.invoke(raw.functions.messages.ReadMentions(peer=peer, top_msg_id=None))
+                logger.debug(f"[{client_name}] 已调用 ReadMentions API 清除群组 {chat_id} 的 {mentions_count} 个@标记")
+            except FloodWait:
+                raise
+            except Exception as e_mentions:
+                logger.debug(f"[{client_name}] 调用 ReadMentions API 时出错（不影响主流程）: {str(e_mentions)}")
+        elif mentions_count > 0:
+            # 普通群组，ReadHistory 已经清除了@标记
+            logger.debug(f"[{client_name}] 群组 {chat_id} 是普通群组，ReadHistory 已清除@标记")
+        
+        if unread_count > 0:
+            logger.info(f"[{client_name}] ✓ 已通过'Read All'方式清除群组 {chat_id} 的所有未读消息和@标记（清除 {unread_count} 条未读）")
+    except FloodWait:
+        raise
+    except Exception as e_read:
+        logger.warning(f"[{client_name}] 调用'Read All'清除群组 {chat_id} 未读标记时出错: {str(e_read)}")
+    
+    # 4. 验证清除结果：等待服务器处理
+    if unread_count > 0:
+        # 等待服务器更新状态
+        await asyncio.sleep(1.0)  # 等待1秒，给服务器时间处理
+        logger.debug(f"[{client_name}] 已等待服务器处理群组 {chat_id} 的清除操作")
+    
+    if mark_read_fallback_browse:
+        await fallback_browse_chat(i, client, client_name, chat_id, latest_message_id)
+    
+    return cleared
+
+async def mark_chat_read_with_retry(i: int, client: Client, client_name: str, dialog) -> bool:
+    """清除单个群组的未读标记并处理限流（FloodWait 时等待后重试一次），成功返回 True"""
+    chat_id = dialog.chat.id
+    try:
+        # 检查客户端是否连接
+        if not client.is_connected:
+            logger.warning(f"[{client_name}] 客户端未连接，跳过群组 {chat_id}")
+            return False
+        
+        cleared = await mark_chat_read(i, client, client_name, dialog)
+        
+        # 添加延迟，避免触发限流
+        if pacing.mark_read_delay > 0:
+            await asyncio.sleep(pacing.mark_read_delay)
+        # ReadHistory 失败时返回 False，增量模式不更新该群组的已读位置，下一轮重新清除
+        return cleared
+    except FloodWait as e:
+        # 处理限流错误，等待指定时间
+        wait_time = e.value
+        logger.warning(f"[{client_name}] 触发限流，等待 {wait_time} 秒后继续...")
+        account_health[client_name].record_flood(wait_time)
+        event_bus.publish('flood_wait_start', source='mark_read', account=client_name, chat_id=chat_id, seconds=wait_time)
+        await asyncio.sleep(wait_time)
+        event_bus.publish('flood_wait_end', source='mark_read', account=client_name, chat_id=chat_id, seconds=wait_time)
+        # 重试一次
+        try:
+            await read_chat(client, await get_chat_peer(client, client_name, chat_id))
+            logger.debug(f"[{client_name}] 重试后已清除群组 {chat_id} 的未读消息标记")
+            return True
+        except Exception as e2:
+            logger.warning(f"[{client_name}] 重试清除群组 {chat_id} 未读标记时出错: {str(e2)}")
+    except Exception as e:
+        logger.warning(f"[{client_name}] 清除群组 {chat_id} 未读标记时出错: {str(e)}")
+    return False
+
+async def sweep_account_mark_read(i: int, client: Client, client_name: str):
+    """完整清除（sweep 模式）：遍历账户的所有群组，逐个清除未读标记"""
+    processed_chats = set()
+    chat_count = 0
+    cleared_count = 0
+    async for dialog in iter_dialogs(client):
+        chat = dialog.chat
+        
+        # 只处理群组和超级群组，跳过私聊
+        if chat.type.name not in ['GROUP', 'SUPERGROUP']:
+            continue
+        
+        # 避免重复处理同一个群组
+        if chat.id in processed_chats:
+            continue
+        processed_chats.add(chat.id)
+        chat_count += 1
+        
+        if await mark_chat_read_with_retry(i, client, client_name, dialog):
+            cleared_count += 1
+    
+    logger.info(f"[{client_name}] 完成清除未读标记，共处理 {len(processed_chats)} 个群组（遍历了 {chat_count} 个群组）")
+    event_bus.publish('mark_read_progress', mode='sweep', account=client_name, chats=len(processed_chats), cleared=cleared_count)
+
+async def incremental_account_mark_read(i: int, client: Client, client_name: str):
+    """增量清除（incremental 模式）：只清除有新未读消息或被@的群组
+
+    通过一次 get_dialogs 遍历读取每个群组的未读数、@提及数和 top_message，
+    与上次清除时记录的消息ID比较，没有新消息的群组不做任何请求；
+    需要清除的群组按 @提及数和未读数排序，每轮最多清除 mark_read_budget 个，其余留到下一轮
+    """
+    read_state = chat_read_state.setdefault(client_name, {})
+    pending = []
+    processed_chats = set()
+    
+    async for dialog in iter_dialogs(client):
+        chat = dialog.chat
+        
+        # 只处理群组和超级群组，跳过私聊
+        if chat.type.name not in ['GROUP', 'SUPERGROUP']:
+            continue
+        
+        # 避免重复处理同一个群组
+        if chat.id in processed_chats:
+            continue
+        processed_chats.add(chat.id)
+        
+        top_message_id = dialog.top_message.id if dialog.top_message else 0
+        unread_count = dialog.unread_messages_count or 0
+        mentions_count = dialog.unread_mentions_count or 0
+        
+        if unread_count == 0 and mentions_count == 0 and not dialog.unread_mark:
+            # 没有未读消息，记录当前位置
+            read_state[chat.id] = top_message_id
+            continue
+        
+        last_read_id = read_state.get(chat.id)
+        if last_read_id is not None and top_message_id <= last_read_id and mentions_count == 0:
+            # 上次清除后没有新消息（服务器的未读数可能尚未更新），跳过
+            continue
+        
+        priority = mentions_count * MENTION_PRIORITY_WEIGHT + unread_count
+        heapq.heappush(pending, (-priority, len(processed_chats), dialog))
+    
+    need_count = len(pending)
+    cleared_count = 0
+    attempts = 0
+    budget = pacing.mark_read_budget
+    while pending and attempts < budget:
+        _, _, dialog = heapq.heappop(pending)
+        attempts += 1
+        if await mark_chat_read_with_retry(i, client, client_name, dialog):
+            read_state[dialog.chat.id] = dialog.top_message.id if dialog.top_message else 0
+            cleared_count += 1
+    
+    # 已退出的群组不再保留状态
+    for chat_id in [chat_id for chat_id in read_state if chat_id not in processed_chats]:
+        del read_state[chat_id]
+    peers = chat_input_peers.get(client_name)
+    if peers:
+        for chat_id in [chat_id for chat_id in peers if chat_id not in processed_chats]:
+            del peers[chat_id]
+    
+    event_bus.publish(
+        'mark_read_progress', mode='incremental', account=client_name, chats=len(processed_chats),
+        pending=need_count, cleared=cleared_count, deferred=len(pending)
+    )
+    
+    if need_count or cleared_count:
+        logger.info(
+            f"[{client_name}] 完成增量清除未读标记：遍历 {len(processed_chats)} 个群组，{need_count} 个有新未读，"
+            f"本轮清除 {cleared_count} 个，推迟到下一轮 {len(pending)} 个"
+        )
+    else:
+        logger.debug(f"[{client_name}] 增量清除未读标记：遍历 {len(processed_chats)} 个群组，没有新的未读消息")
+
+async def account_mark_read(i: int, client: Client, client_name: str):
+    """清除一个账户的未读标记（按 mark_read_mode），出错时记录日志，不影响其他账户"""
+    try:
+        # 检查客户端是否连接
+        if not client.is_connected:
+            logger.warning(f"[{client_name}] 客户端未连接，跳过清除未读标记")
+            return
+        
+        if mark_read_mode == 'sweep':
+            await sweep_account_mark_read(i, client, client_name)
+        else:
+            await incremental_account_mark_read(i, client, client_name)
+    except Exception as e:
+        logger.error(f"[{client_name}] 定期清除未读标记任务出错: {str(e)}", exc_info=True)
+
+# 自动标记消息为已读的任务（定期清除所有群组的未读标记）
+async def auto_mark_read_task():
+    """定期清除群组的未读消息标记和被回复标记（incremental 模式只处理有新消息的群组，sweep 模式处理所有群组）
+
+    所有账户同时处理，请求频率由所有账户共用的 mark_read_rpc_budget 控制（正在发送消息时暂停）
+    """
+    if not auto_mark_read:
+        return
+    
+    while True:
+        try:
+            await asyncio.sleep(pacing.mark_read_interval)
+            if mark_read_mode == 'sweep':
+                logger.info(f"开始定期清除所有群组的未读消息标记...")
+            else:
+                logger.debug(f"开始增量清除有新消息群组的未读消息标记...")
+            
+            # 遍历客户端列表的快照，热重载替换列表时不影响本轮处理
+            snapshot = list(zip(clients, accounts))
+            event_bus.publish('mark_read_started', mode=mark_read_mode, accounts=len(snapshot))
+            started = time.monotonic()
+            await asyncio.gather(*(
+                account_mark_read(i, client, account['name']) for i, (client, account) in enumerate(snapshot)
+            ))
+            event_bus.publish('mark_read_finished', mode=mark_read_mode, accounts=len(snapshot), seconds=round(time.monotonic() - started, 1))
+            
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"定期清除未读标记任务发生错误: {str(e)}", exc_info=True)
+            await asyncio.sleep(60)  # 出错后等待1分钟再继续
+
+# 消息数据结构
+class MessageTask:
+    def __init__(self, chat_id, account=None, text=None, photo=None, trace=None, tenant=DEFAULT_TENANT,
+                 campaign_id=None, campaign_offset=None, photo_url=None, task_id=None, ordered=True):
+        self.task_id = task_id or os.urandom(8).hex()  # 消息ID，用于查询状态
+        self.chat_id = chat_id  # 目标群组ID（可以是整数或字符串，如 @username）
+        self.account = account  # 指定使用哪个账户发送（账户名称，发送时再解析为客户端索引；为None时由分配策略决定）
+        self.text = text  # 文本内容（可选）
+        self.photo = photo  # 图片数据（bytes 或二进制文件对象，可选）
+        self.photo_url = photo_url  # 图片 URL（后台下载完成前 photo 为 None）
+        self.photo_error: Optional[str] = None  # 图片下载失败的原因
+        self.queue_order: Optional[float] = None  # 在队列中的排序键，图片预取按此顺序下载
+        self.trace = trace if trace is not None else Trace('queue')  # 各阶段耗时记录
+        self.tenant = tenant  # 提交消息的租户名称
+        self.campaign_id = campaign_id  # 所属群发任务ID（普通消息为 None）
+        self.campaign_offset = campaign_offset  # 在群发任务目标列表文件中的位置（暂停时据此重新生成消息）
+        self.reroutes = 0  # 因连接断开或请求超时放回队列、改用其他账户发送的次数
+        self.ordered = ordered  # 是否与同一群组的其他有序消息按入队顺序发送（False 时不等待前面的消息）
+        self.chat_seq: Optional[int] = None  # 入队时分配的群组内序号（有序消息）
+
+    def open_photo(self):
+        """返回可供 Pyrogram 上传的图片文件对象（指针位于开头）；图片在临时文件中时返回路径，由 Pyrogram 上传时打开"""
+        if isinstance(self.photo, bytes):
+            # Pyrogram 需要文件对象，将 bytes 转换为 BytesIO
+            return io.BytesIO(self.photo)
+        if isinstance(self.photo, SpooledPhoto):
+            return self.photo.path
+        self.photo.seek(0)
+        return self.photo
+
+    def read_photo(self) -> bytes:
+        """读取完整的图片数据（保存检查点、写入共享队列时使用）"""
+        if isinstance(self.photo, bytes):
+            return self.photo
+        if isinstance(self.photo, SpooledPhoto):
+            return self.photo.read()
+        return self.open_photo().read()
+
+    def to_checkpoint(self) -> dict:
+        """转换为可写入检查点文件的字典（图片使用 base64 编码）"""
+        data = {
+            "task_id": self.task_id, "chat_id": self.chat_id, "account": self.account, "text": self.text,
+            "tenant": self.tenant, "trace": self.trace.to_state(),
+        }
+        if self.campaign_id is not None:
+            data["campaign_id"] = self.campaign_id
+            data["campaign_offset"] = self.campaign_offset
+        if not self.ordered:
+            data["ordered"] = False
+        if self.photo is None and self.photo_url:
+            # 图片还没有下载（或下载失败），恢复后重新下载
+            data["photo_url"] = self.photo_url
+        if self.photo is not None:
+            photo = self.read_photo()
+            data["photo"] = base64.b64encode(photo).decode('ascii')
+        return data
+
+    @classmethod
+    def from_checkpoint(cls, data: dict) -> 'MessageTask':
+        """从检查点文件中的字典恢复消息"""
+        photo = base64.b64decode(data["photo"]) if data.get("photo") else None
+        return cls.from_state(data, photo)
+
+    @classmethod
+    def from_state(cls, data: dict, photo: Optional[bytes] = None) -> 'MessageTask':
+        """从 to_checkpoint 格式的字典（不含图片）和图片数据恢复消息"""
+        trace = Trace.from_state(data["trace"]) if data.get("trace") else Trace('checkpoint')
+        return cls(
+            chat_id=data["chat_id"], account=data.get("account"), text=data.get("text"),
+            photo=photo, trace=trace, tenant=data.get("tenant") or DEFAULT_TENANT,
+            campaign_id=data.get("campaign_id"), campaign_offset=data.get("campaign_offset"),
+            photo_url=data.get("photo_url"), task_id=data.get("task_id"), ordered=data.get("ordered", True)
+        )
+
+    def close(self):
+        """释放图片占用的内存或临时文件"""
+        if self.photo is not None and not isinstance(self.photo, bytes):
+            try:
+                self.photo.close()
+            except Exception:
+                pass
+
+class TaskStatusStore:
+    """最近消息的发送状态（LRU，最多 task_status_max 条），供 GET /api/tasks/{task_id} 查询
+
+    状态: fetching（等待后台下载图片）、queued（排队中）、sending（已取出，正在模拟操作或发送）、sent、failed；
+    群发任务的消息不记录（进度见群发任务本身）
+    """
+
+    def __init__(self, maxsize: int):
+        self.statuses: "LRUDict[str, dict]" = LRUDict(maxsize)
+
+    def set(self, task: MessageTask, status: str, only_from: Optional[str] = None, **fields):
+        """更新消息状态；指定 only_from 时只有当前状态为 only_from 才更新"""
+        if task.campaign_id is not None:
+            return
+        if only_from is not None and (self.statuses.get(task.task_id) or {}).get("status") != only_from:
+            return
+        entry = self.statuses.get_or_create(task.task_id, lambda: {
+            "task_id": task.task_id, "chat_id": task.chat_id, "tenant": task.tenant,
+            "status": None, "created_at": time.time(),
+        })
+        entry["status"] = status
+        entry["updated_at"] = time.time()
+        entry.update(fields)
+
+    def get(self, task_id: str) -> Optional[dict]:
+        return self.statuses.get(task_id)
+
+# 最近消息的发送状态（create_app() 中创建）
+task_status: Optional[TaskStatusStore] = None
+
+def client_available(index: int) -> bool:
+    """账户当前是否可用：已连接、连接检查正常且不在限流等待中"""
+    return clients[index].is_connected and account_health[accounts[index]['name']].is_available()
+
+def account_index(name: Optional[str]) -> Optional[int]:
+    """账户名称对应的客户端索引，账户不存在（已被热重载移除）时返回 None"""
+    if name is None:
+        return None
+    for index, account in enumerate(accounts[:len(clients)]):
+        if account['name'] == name:
+            return index
+    return None
+
+def account_busy(index: int) -> bool:
+    """账户是否正被某个发送任务占用（正在模拟操作、发送或发送后休息）"""
+    lock = account_send_locks.get(accounts[index]['name'])
+    return lock is not None and lock.locked()
+
+def get_client_index_for_chat(chat_id: Union[int, str], avoid_busy: bool = False) -> int:
+    """根据分配策略获取用于发送消息的客户端索引
+
+    avoid_busy 为 True 时（发送任务选择账户）优先选择没有被其他发送任务占用的可用账户，都被占用时按原策略选择并等待；
+    consistent_hash 策略不跳过被占用的账户，等待它空闲，保持同一群组由同一账户发送
+    """
+    is_available = client_available
+    if avoid_busy and router.strategy != 'consistent_hash':
+        idle = {index for index in range(len(clients)) if client_available(index) and not account_busy(index)}
+        if idle:
+            is_available = idle.__contains__
+    return router.select(
+        chat_id,
+        is_available=is_available,
+        score=lambda index: account_health[accounts[index]['name']].score(),
+    )
+
+def reachable_chat_keys() -> set:
+    """本实例已连接的账户能访问的群组（Pyrogram session 中已知的群组和频道的ID和用户名，不含用户和机器人），用于共享队列
+
+    读取整个 peers 表，需要在线程中调用
+    """
+    keys = set()
+    for client in clients:
+        if not client.is_connected:
+            continue
+        try:
+            for peer_id, username in client.storage.conn.execute(
+                "SELECT id, username FROM peers WHERE type IN ('group', 'supergroup', 'channel')"
+            ):
+                keys.add(str(peer_id))
+                if username:
+                    keys.add(username.lower())
+        except Exception as e:
+            logger.warning(f"读取账户 {client.name} 的会话列表失败: {str(e)}")
+    return keys
+
+def get_client_for_chat(chat_id: Union[int, str]) -> Client:
+    """根据分配策略获取用于发送消息的客户端"""
+    return clients[get_client_index_for_chat(chat_id)]
+
+def client_knows_chat(client: Client, chat_id: Union[int, str]) -> bool:
+    """账户的 session 中是否有该会话（已加入或访问过的群组），不发起网络请求"""
+    try:
+        if isinstance(chat_id, int):
+            row = client.storage.conn.execute("SELECT 1 FROM peers WHERE id = ?", (chat_id,)).fetchone()
+        else:
+            row = client.storage.conn.execute("SELECT 1 FROM peers WHERE username = ?", (chat_id.lstrip('@').lower(),)).fetchone()
+        return row is not None
+    except Exception:
+        return False
+
+# ========== 群发任务部分 ==========
+# 一次群发 = 文本模板 + 一张图片（所有群组共用同一份数据）+ 目标列表。目标列表保存在磁盘文件中，
+# 按需逐条读取并生成消息，每个群发任务最多 campaign_window 条消息同时在队列中，内存占用与目标数量无关；
+# 进度保存在 state.json 中，重启后从上次的位置继续
+
+CAMPAIGN_TEMPLATE_PATTERN = re.compile(r'\{(\w+)\}')
+CAMPAIGN_RATE_WINDOW = 600  # 按最近多少秒内的发送数量计算发送速率和预计剩余时间
+CAMPAIGN_ERROR_SAMPLES = 5  # 创建群发任务时最多返回多少条目标列表格式错误
+CAMPAIGN_QUOTA_POLL_INTERVAL = 1.0  # 租户排队的消息达到 max_queued 时，群发任务再次检查的间隔（秒）
+
+def render_template(template: str, variables: dict) -> str:
+    """替换模板中的 {变量名}，没有提供的变量保持原样"""
+    return CAMPAIGN_TEMPLATE_PATTERN.sub(
+        lambda match: str(variables[match.group(1)]) if match.group(1) in variables else match.group(0),
+        template
+    )
+
+def parse_campaign_target(line: str):
+    """解析目标列表中的一行：chat_id、@username，或 JSON 对象（chat_id 之外的字段作为模板变量）
+
+    空行和 # 开头的行返回 None，格式错误时抛出 ValueError
+    """
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    if line.startswith('{'):
+        item = json_loads(line)
+        if not isinstance(item, dict):
+            raise ValueError("必须是 JSON 对象")
+        chat_id = item.pop('chat_id', None)
+        if chat_id is None or chat_id == '' or isinstance(chat_id, bool) or not isinstance(chat_id, (int, str)):
+            raise ValueError("缺少 chat_id，或 chat_id 不是整数/字符串")
+        return normalize_chat_id(chat_id), item
+    return normalize_chat_id(line), {}
+
+class Campaign:
+    """一个群发任务，文件保存在 <campaign_dir>/<id>/ 下：state.json（进度）、targets.jsonl（目标列表）、media（图片）"""
+
+    def __init__(self, campaign_id: str, directory: str, state: dict):
+        self.id = campaign_id
+        self.directory = directory
+        self.name = state.get('name') or campaign_id
+        self.template = state.get('template') or ''
+        self.has_photo = state.get('has_photo', False)
+        self.tenant = state.get('tenant') or DEFAULT_TENANT
+        self.accounts: List[str] = state.get('accounts') or []  # 限定使用的账户名称，为空表示所有账户
+        self.status = state.get('status', 'running')  # running、paused、cancelled、completed
+        self.total = state.get('total', 0)
+        self.cursor = state.get('cursor', 0)  # 下一个未放入队列的目标在 targets.jsonl 中的位置
+        self.held: List[int] = state.get('held', [])  # 暂停时从队列中撤回的目标位置，恢复后优先发送
+        self.queued: List[int] = state.get('queued', [])  # 已放入队列、尚未发送完成的目标位置（异常退出后据此恢复）
+        self.enqueued = state.get('enqueued', 0)
+        self.sent = state.get('sent', 0)
+        self.failed = state.get('failed', 0)
+        self.skipped = state.get('skipped', 0)  # 取消后未发送的消息数
+        self.assigned: Dict[str, int] = state.get('assigned', {})  # 每个账户分配的消息数
+        self.created_at = state.get('created_at')
+        self.finished_at = state.get('finished_at')
+        self.in_queue = 0  # 当前在队列中（包括正在发送）的消息数
+        self.photo: Optional[bytes] = None  # 所有消息共用同一份图片数据
+        self.recent: deque = deque()  # 最近发送完成的时间（monotonic），用于计算发送速率
+        self.started = time.monotonic()
+        self._wake = asyncio.Event()
+        self._dirty = False  # 进度有变化，尚未保存
+        self._saver: Optional[asyncio.Task] = None  # 后台保存进度的任务
+        self._save_lock = asyncio.Lock()  # 保证多次保存按顺序写入
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def to_state(self) -> dict:
+        return {
+            "name": self.name, "template": self.template, "has_photo": self.has_photo, "tenant": self.tenant,
+            "accounts": self.accounts, "status": self.status, "total": self.total, "cursor": self.cursor,
+            "held": self.held, "queued": self.queued, "enqueued": self.enqueued, "sent": self.sent, "failed": self.failed,
+            "skipped": self.skipped, "assigned": self.assigned,
+            "created_at": self.created_at, "finished_at": self.finished_at,
+        }
+
+    def _write_state(self, data: bytes):
+        """写入进度文件（先写临时文件再替换）"""
+        tmp_path = self.path('state.json.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path('state.json'))
+
+    def save(self):
+        """同步保存进度（只在线程中或事件循环启动之前调用）"""
+        self._write_state(json_dumps(self.to_state()))
+
+    async def persist(self):
+        """保存进度：在事件循环中取当前状态的快照，在线程中写入"""
+        self._dirty = False
+        data = json_dumps(self.to_state())
+        async with self._save_lock:
+            await asyncio.to_thread(self._write_state, data)
+
+    def save_later(self):
+        """标记进度需要保存，由后台任务在线程中写入；写入期间的多次变化合并为一次写入"""
+        self._dirty = True
+        if self._saver is None or self._saver.done():
+            self._saver = asyncio.ensure_future(self._save_pending())
+
+    async def _save_pending(self):
+        while self._dirty:
+            try:
+                await self.persist()
+            except OSError as e:
+                self._dirty = True
+                logger.warning(f"保存群发任务 {self.name}（{self.id}）的进度失败: {str(e)}")
+                return
+
+    async def flush(self):
+        """等待后台保存完成，仍有未保存的变化时再保存一次（停止程序时调用）"""
+        if self._saver is not None:
+            await self._saver
+        if self._dirty:
+            await self.persist()
+
+    def iter_targets(self, offset: int):
+        """从 offset 开始逐行读取目标列表，生成 (本行位置, 下一行位置, chat_id, 模板变量)"""
+        with open(self.path('targets.jsonl'), 'rb') as f:
+            f.seek(offset)
+            while True:
+                line = f.readline()
+                if not line:
+                    return
+                chat_id, variables = json_loads(line)
+                yield offset, offset + len(line), chat_id, variables
+                offset += len(line)
+
+    def read_target(self, offset: int) -> tuple:
+        """读取指定位置的目标，返回 (chat_id, 模板变量)"""
+        with open(self.path('targets.jsonl'), 'rb') as f:
+            f.seek(offset)
+            return tuple(json_loads(f.readline()))
+
+    def choose_account(self, chat_id: Union[int, str]) -> Optional[str]:
+        """选择发送账户：优先选择 session 中有该群组的账户，其中分配消息最少的一个，返回账户名称；没有可用账户时返回 None（由分配策略决定）"""
+        candidates = [
+            index for index, account in enumerate(accounts[:len(clients)])
+            if clients[index].is_connected and (not self.accounts or account['name'] in self.accounts)
+        ]
+        if not candidates:
+            return None
+        members = [index for index in candidates if client_knows_chat(clients[index], chat_id)]
+        index = min(members or candidates, key=lambda i: self.assigned.get(accounts[i]['name'], 0))
+        name = accounts[index]['name']
+        self.assigned[name] = self.assigned.get(name, 0) + 1
+        return name
+
+    def make_task(self, offset: int, chat_id: Union[int, str], variables: dict) -> MessageTask:
+        text = render_template(self.template, {**variables, 'chat_id': chat_id}) if self.template else None
+        trace = Trace('campaign')
+        trace.attributes['campaign'] = self.id
+        return MessageTask(
+            chat_id=chat_id, account=self.choose_account(chat_id), text=text, photo=self.photo,
+            trace=trace, tenant=self.tenant, campaign_id=self.id, campaign_offset=offset
+        )
+
+    async def run(self):
+        """按需生成消息放入队列（最多 campaign_window 条同时在队列中，且不超过租户的 max_queued），全部完成后结束"""
+        if self.has_photo and self.photo is None:
+            with open(self.path('media'), 'rb') as f:
+                self.photo = f.read()
+        self.started = time.monotonic()
+        targets = self.iter_targets(self.cursor)
+        try:
+            while self.status in ('running', 'paused'):
+                if self.status == 'paused' or self.in_queue >= campaign_window:
+                    self._wake.clear()
+                    await self._wake.wait()
+                    continue
+                tenant = tenant_registry.get(self.tenant)
+                if tenant.max_queued and message_queue.qsize_of(self.tenant) >= tenant.max_queued:
+                    # 租户排队的消息已达到上限（包括其他接口提交的消息），等队列中的消息发送后再放入
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), CAMPAIGN_QUOTA_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.held:
+                    offset = self.held.pop(0)
+                    chat_id, variables = self.read_target(offset)
+                    self.enqueued -= 1  # 撤回时已计入，重新放入队列不重复计数
+                else:
+                    item = next(targets, None)
+                    if item is None:
+                        if self.in_queue == 0:
+                            self.set_status('completed')
+                            break
+                        # 目标已全部放入队列，等待发送完成
+                        self._wake.clear()
+                        await self._wake.wait()
+                        continue
+                    offset, self.cursor, chat_id, variables = item
+                task = self.make_task(offset, chat_id, variables)
+                self.in_queue += 1
+                self.enqueued += 1
+                self.queued.append(offset)
+                # 先保存进度再放入队列：程序异常退出后，队列中丢失的消息在启动时按 queued 重新放入队列（见 CampaignRegistry.start）
+                await self.persist()
+                await message_queue.put(task)
+                task.trace.enqueued_at = time.perf_counter()
+        finally:
+            targets.close()
+            if self.status in ('completed', 'cancelled'):
+                self.photo = None
+
+    def set_status(self, status: str):
+        self.status = status
+        if status in ('completed', 'cancelled'):
+            self.finished_at = datetime.now().isoformat(timespec='seconds')
+        self.save_later()
+        self._wake.set()
+        event_bus.publish('campaign', tenant=self.tenant, campaign_id=self.id, status=status, sent=self.sent, failed=self.failed, total=self.total)
+        logger.info(f"📣 群发任务 {self.name}（{self.id}）状态: {status}，已发送 {self.sent}/{self.total}，失败 {self.failed}")
+
+    def unqueue(self, task: MessageTask):
+        """消息离开队列（发送完成或撤回）"""
+        self.in_queue -= 1
+        if task.campaign_offset in self.queued:
+            self.queued.remove(task.campaign_offset)
+
+    def task_finished(self, task: MessageTask, ok: bool):
+        """队列中的一条消息发送完成（成功或失败）"""
+        self.unqueue(task)
+        if ok:
+            self.sent += 1
+        else:
+            self.failed += 1
+        now = time.monotonic()
+        self.recent.append(now)
+        while self.recent and self.recent[0] < now - CAMPAIGN_RATE_WINDOW:
+            self.recent.popleft()
+        self.save_later()
+        self._wake.set()
+
+    def withdraw(self, task: MessageTask):
+        """暂停或取消后从队列中取出的消息：暂停时记录目标位置，恢复后重新生成；取消时计入未发送"""
+        self.unqueue(task)
+        if task.account is not None:
+            self.assigned[task.account] = max(0, self.assigned.get(task.account, 0) - 1)
+        if self.status == 'paused':
+            self.held.append(task.campaign_offset)
+        else:
+            self.skipped += 1
+        self.save_later()
+        self._wake.set()
 
-# 自定义文件名格式：将 client_tguserbot.log.YYYY-MM-DD 转换为 client_tguserbot_YYYYMMDD.log
-def namer(name):
-    """自定义日志文件名格式"""
-    # TimedRotatingFileHandler 默认格式是：client_tguserbot.log.YYYY-MM-DD
-    # 我们需要转换为：client_tguserbot_YYYYMMDD.log
-    base_name = os.path.basename(name)
-    dir_name = os.path.dirname(name)
-    
-    if '.' in base_name:
-        parts = base_name.split('.')
-        if len(parts) >= 3:
-            # 提取日期部分（最后一个部分，格式为 YYYY-MM-DD）
-            date_str = parts[-1]
-            # 转换为 YYYYMMDD 格式
-            date_formatted = date_str.replace('-', '')
-            # 返回新格式：client_tguserbot_YYYYMMDD.log
-            return os.path.join(dir_name, f'client_tguserbot_{date_formatted}.log')
-    
-    # 如果格式不符合预期，返回原文件名
-    return name
+    def get_stats(self) -> dict:
+        done = self.sent + self.failed + self.skipped
+        remaining = max(0, self.total - done) if self.status not in ('cancelled', 'completed') else 0
+        now = time.monotonic()
+        elapsed = min(CAMPAIGN_RATE_WINDOW, now - self.started)
+        recent = sum(1 for t in self.recent if t >= now - CAMPAIGN_RATE_WINDOW)
+        rate = recent / elapsed if elapsed > 0 else 0.0
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "tenant": self.tenant,
+            "total": self.total,
+            "enqueued": self.enqueued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "in_queue": self.in_queue,
+            "progress": round(done / self.total, 4) if self.total else 1.0,
+            "rate_per_minute": round(rate * 60, 2),
+            "eta_seconds": round(remaining / rate) if rate > 0 and self.status == 'running' else None,
+            "accounts": self.assigned,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
 
-file_handler.namer = namer
+class CampaignRegistry:
+    """所有群发任务（包括已结束的，用于查询结果）"""
 
-# 创建控制台处理器
-console_handler = logging.StreamHandler(sys.stdout)
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.campaigns: Dict[str, Campaign] = {}
+        self.feeders: Dict[str, asyncio.Task] = {}
 
-# 设置日志格式
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(formatter)
-console_handler.setFormatter(formatter)
+    def load(self):
+        """加载保存的群发任务"""
+        if not os.path.isdir(self.directory):
+            return
+        for campaign_id in sorted(os.listdir(self.directory)):
+            directory = os.path.join(self.directory, campaign_id)
+            try:
+                with open(os.path.join(directory, 'state.json'), 'rb') as f:
+                    state = json_loads(f.read())
+            except (OSError, ValueError) as e:
+                logger.warning(f"无法加载群发任务 {campaign_id}: {str(e)}")
+                continue
+            self.campaigns[campaign_id] = Campaign(campaign_id, directory, state)
 
-# 配置根日志记录器
-root_logger = logging.getLogger()
-root_logger.setLevel(getattr(logging, log_level, logging.INFO))
-root_logger.addHandler(file_handler)
-root_logger.addHandler(console_handler)
+    def start(self):
+        """启动时调用：加载群发任务，统计从检查点恢复到队列中的消息，继续未完成的群发任务
 
-# 获取当前日志文件名（用于显示）
-# 使用当前日期生成日志文件名
-current_log_file = os.path.join(log_dir, f'client_tguserbot_{datetime.now().strftime("%Y%m%d")}.log')
+        程序异常退出时没有保存检查点，已放入队列但不在恢复的队列中的消息重新放入队列
+        （退出时正在发送的消息可能重复发送一次）；已取消的群发任务计入未发送
+        """
+        self.load()
+        if isinstance(message_queue, SharedQueue):
+            queued = message_queue.campaign_offsets()
+        else:
+            queued = defaultdict(list)
+            for task in message_queue.items():
+                if task.campaign_id is not None:
+                    queued[task.campaign_id].append(task.campaign_offset)
+        for campaign_id, campaign in self.campaigns.items():
+            offsets = queued.get(campaign_id, [])
+            restored = set(offsets)
+            lost = [offset for offset in campaign.queued if offset not in restored]
+            campaign.queued = offsets
+            campaign.in_queue = len(offsets)
+            if lost:
+                if campaign.status in ('running', 'paused'):
+                    campaign.held[:0] = lost
+                    logger.warning(f"群发任务 {campaign.name}（{campaign_id}）有 {len(lost)} 条消息在程序异常退出时未发送完成，重新放入队列")
+                else:
+                    campaign.skipped += len(lost)
+                campaign.save_later()
+            if campaign.status in ('running', 'paused'):
+                self.feeders[campaign_id] = asyncio.create_task(campaign.run())
+                logger.info(f"📣 继续群发任务 {campaign.name}（{campaign_id}），状态: {campaign.status}，已发送 {campaign.sent}/{campaign.total}")
 
-logger = logging.getLogger(__name__)
-logger.info(f"日志文件路径: {current_log_file}")
-logger.info(f"配置了 {len(accounts)} 个账户")
-logger.info(f"分配策略: {distribution_strategy}")
+    def create(self, name: str, template: str, photo: Optional[bytes], targets, tenant: str, account_names: List[str]) -> tuple:
+        """保存新的群发任务（在线程中执行）：逐行解析目标列表写入 targets.jsonl，返回 (群发任务, 格式错误的行数, 错误示例)"""
+        campaign_id = f"{datetime.now():%Y%m%d%H%M%S}-{os.urandom(3).hex()}"
+        directory = os.path.join(self.directory, campaign_id)
+        os.makedirs(directory)
+        total = 0
+        invalid = 0
+        errors = []
+        with open(os.path.join(directory, 'targets.jsonl'), 'wb') as out:
+            for line_number, line in enumerate(io.TextIOWrapper(targets, encoding='utf-8-sig', errors='replace'), 1):
+                try:
+                    target = parse_campaign_target(line)
+                except ValueError as e:
+                    invalid += 1
+                    if len(errors) < CAMPAIGN_ERROR_SAMPLES:
+                        errors.append(f"第 {line_number} 行: {str(e)}")
+                    continue
+                if target is not None:
+                    out.write(json_dumps(list(target)) + b'\n')
+                    total += 1
+        if photo is not None:
+            with open(os.path.join(directory, 'media'), 'wb') as f:
+                f.write(photo)
+        campaign = Campaign(campaign_id, directory, {
+            "name": name, "template": template, "has_photo": photo is not None, "tenant": tenant,
+            "accounts": account_names, "total": total, "created_at": datetime.now().isoformat(timespec='seconds'),
+        })
+        campaign.photo = photo
+        campaign.save()
+        return campaign, invalid, errors
 
-# 创建多个 Pyrogram 客户端
-clients: List[Client] = []
-workdir = os.path.dirname(os.path.abspath(__file__))
+    def add(self, campaign: Campaign):
+        """登记新创建的群发任务并开始发送"""
+        self.campaigns[campaign.id] = campaign
+        self.feeders[campaign.id] = asyncio.create_task(campaign.run())
+        event_bus.publish('campaign', tenant=campaign.tenant, campaign_id=campaign.id, status=campaign.status, sent=0, failed=0, total=campaign.total)
+        logger.info(f"📣 已创建群发任务 {campaign.name}（{campaign.id}），目标 {campaign.total} 个群组")
 
-for account in accounts:
-    api_id = account['api_id']
-    api_hash = account['api_hash']
-    name = account['name']
-    session_name = f'session_{name}_{api_id}'
-    
-    client = Client(
-        session_name,
-        api_id=api_id,
-        api_hash=api_hash,
-        workdir=workdir
-    )
-    clients.append(client)
-    logger.info(f"创建客户端: {name} (api_id: {api_id}, session: {session_name})")
+    def get(self, campaign_id: Optional[str]) -> Optional[Campaign]:
+        return self.campaigns.get(campaign_id) if campaign_id is not None else None
 
-# 记录启动时间，用于过滤历史消息
-start_time = None
+    def dequeued(self, task: MessageTask) -> bool:
+        """发送任务取出消息时调用，所属群发任务已暂停或取消时返回 False（本条消息不发送）"""
+        campaign = self.get(task.campaign_id)
+        if campaign is None or campaign.status not in ('paused', 'cancelled'):
+            return True
+        campaign.withdraw(task)
+        return False
+
+    def record(self, task: MessageTask, ok: bool):
+        """群发任务的消息发送完成"""
+        campaign = self.get(task.campaign_id)
+        if campaign is not None:
+            campaign.task_finished(task, ok)
+
+    async def stop(self):
+        """停止放入新消息并保存进度（停止程序时调用）"""
+        for feeder in self.feeders.values():
+            feeder.cancel()
+        for feeder in self.feeders.values():
+            try:
+                await feeder
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.warning(f"停止群发任务时出错: {str(e)}")
+        self.feeders.clear()
+        for campaign in self.campaigns.values():
+            try:
+                if campaign.status in ('running', 'paused'):
+                    await campaign.persist()
+                else:
+                    await campaign.flush()
+            except OSError as e:
+                logger.warning(f"保存群发任务 {campaign.name}（{campaign.id}）的进度失败: {str(e)}")
 
-# 消息队列，用于排队发送
-message_queue = asyncio.Queue()
+    def get_summary(self) -> Dict[str, int]:
+        """各状态的群发任务数量"""
+        summary = defaultdict(int)
+        for campaign in self.campaigns.values():
+            summary[campaign.status] += 1
+        return dict(summary)
 
-# 每个群组的客户端轮询索引（用于 round_robin 策略）
-chat_client_index: Dict[int, int] = defaultdict(int)
+# 群发任务列表（create_app() 中创建）
+campaign_registry: Optional[CampaignRegistry] = None
 
-# 每个群组每个客户端的使用计数（用于 random 策略，确保更均匀的分配）
-chat_client_usage: Dict[int, Dict[int, int]] = defaultdict(lambda: defaultdict(int))
+# ========== 消息发送部分 ==========
+async def upload_photo(client: Client, task: MessageTask, photo_fetch: Optional[asyncio.Task]):
+    """把图片上传到账户（save_file），返回 SendMedia 引用的 InputFile；图片下载失败时返回 None
 
-# 每个群组每个客户端的上次浏览状态（存储最后10个消息ID）
-# key: (client_index, chat_id), value: List[int] (最后10个消息ID，从新到旧)
-chat_browse_state: Dict[tuple, List[int]] = {}
+    选定账户后立即在后台执行，与模拟操作的等待时间重叠，发送时只剩一次 SendMedia 请求
+    """
+    if photo_fetch is not None:
+        await asyncio.shield(photo_fetch)
+    if task.photo is None:
+        return None
+    with task.trace.span('upload'):
+        return await client.save_file(task.open_photo())
 
-# 自动标记消息为已读的任务（定期清除所有群组的未读标记）
-async def auto_mark_read_task():
-    """定期清除所有群组的未读消息标记和被回复标记"""
-    if not auto_mark_read:
-        return
-    
+async def send_uploaded_photo(client: Client, task: MessageTask, file):
+    """用 SendMedia 发送已上传的图片（与 send_photo 相同，只是不再上传），服务器缺少文件分片时补传后重试"""
+    media = raw.types.InputMediaUploadedPhoto(file=file)
     while True:
         try:
-            await asyncio.sleep(mark_read_interval)
-            logger.info(f"开始定期清除所有群组的未读消息标记...")
-            
-            for i, client in enumerate(clients):
-                client_name = accounts[i]['name']
-                try:
-                    # 检查客户端是否连接
-                    if not client.is_connected:
-                        logger.warning(f"[{client_name}] 客户端未连接，跳过清除未读标记")
-                        continue
-                    
-                    # 获取所有对话（包括群组）
-                    processed_chats = set()
-                    chat_count = 0
-                    async for dialog in client.get_dialogs():
-                        chat = dialog.chat
-                        chat_id = chat.id
-                        
-                        # 只处理群组和超级群组，跳过私聊
-                        if chat.type.name not in ['GROUP', 'SUPERGROUP']:
-                            continue
-                        
-                        # 避免重复处理同一个群组
-                        if chat_id in processed_chats:
-                            continue
-                        processed_chats.add(chat_id)
-                        chat_count += 1
-                        
-                        try:
-                            # 检查客户端是否连接
-                            if not client.is_connected:
-                                logger.warning(f"[{client_name}] 客户端未连接，跳过群组 {chat_id}")
-                                continue
-                            
-                            # 1. 获取对话信息，仅用于日志记录（不依赖未读提及数）
-                            unread_count = 0
-                            try:
-                                # 从当前遍历的 dialog 中获取未读数（仅用于日志）
-                                if hasattr(dialog, 'unread_count') and dialog.unread_count:
-                                    unread_count = dialog.unread_count
-                            except Exception as e_dialog:
-                                logger.debug(f"[{client_name}] 获取群组 {chat_id} 未读信息时出错: {str(e_dialog)}")
-                            
-                            # 2. 获取最新消息ID，用于标记所有消息为已读（包括被回复/被提及的消息）
-                            latest_message_id = None
-                            try:
-                                # 方法1：从对话中获取最新消息ID（最可靠）
-                                try:
-                                    async for dialog in client.get_dialogs():
-                                        if dialog.chat.id == chat_id:
-                                            if hasattr(dialog, 'top_message') and dialog.top_message:
-                                                latest_message_id = dialog.top_message.id
-                                                logger.debug(f"[{client_name}] 从对话中获取群组 {chat_id} 最新消息ID: {latest_message_id}")
-                                                break
-                                except Exception as e_dialog:
-                                    logger.debug(f"[{client_name}] 从对话获取最新消息ID失败: {str(e_dialog)}")
-                                
-                                # 方法2：如果方法1失败，尝试从消息历史获取
-                                if latest_message_id is None:
-                                    try:
-                                        async for message in client.get_chat_history(chat_id, limit=1):
-                                            if message:
-                                                latest_message_id = message.id
-                                                logger.debug(f"[{client_name}] 从消息历史获取群组 {chat_id} 最新消息ID: {latest_message_id}")
-                                                break
-                                    except Exception as e_history:
-                                        logger.debug(f"[{client_name}] 从消息历史获取最新消息ID失败: {str(e_history)}")
-                                
-                                # 如果仍然获取失败，记录警告
-                                if latest_message_id is None:
-                                    logger.warning(f"[{client_name}] 无法获取群组 {chat_id} 的最新消息ID，将使用增量浏览方式")
-                                else:
-                                    logger.debug(f"[{client_name}] 群组 {chat_id} 最新消息ID: {latest_message_id}")
-                            except Exception as e_msg:
-                                logger.warning(f"[{client_name}] 获取群组 {chat_id} 最新消息时出错: {str(e_msg)}")
-                            
-                            # 3. 直接模拟点击"Read All"：一次性清除所有未读消息和@标记
-                            # 使用 read_chat_history 不指定 max_id，会标记所有消息为已读（类似"Read All"功能）
-                            try:
-                                # 方法1：直接调用 read_chat_history 不指定 max_id，标记所有消息为已读
-                                await client.read_chat_history(chat_id)
-                                logger.debug(f"[{client_name}] 已调用 read_chat_history 标记群组 {chat_id} 所有消息为已读")
-                                
-                                # 方法2：如果是超级群组，调用 ReadMentions API 清除所有@标记
-                                try:
-                                    from pyrogram.raw.functions.messages import ReadMentions
-                                    from pyrogram.raw.types import InputPeerChannel
-                                    
-                                    peer = await client.resolve_peer(chat_id)
-                                    if isinstance(peer, InputPeerChannel):
-                                        # 调用 ReadMentions 不指定 top_msg_id，清除所有@标记
-                                        await client.invoke(ReadMentions(peer=peer, top_msg_id=None))
-                                        logger.debug(f"[{client_name}] 已调用 ReadMentions API 清除群组 {chat_id} 的所有@标记")
-                                    else:
-                                        # 普通群组，read_chat_history 应该已经清除了@标记
-                                        logger.debug(f"[{client_name}] 群组 {chat_id} 是普通群组，read_chat_history 已清除@标记")
-                                except Exception as e_mentions:
-                                    logger.debug(f"[{client_name}] 调用 ReadMentions API 时出错（不影响主流程）: {str(e_mentions)}")
-                                
-                                if unread_count > 0:
-                                    logger.info(f"[{client_name}] ✓ 已通过'Read All'方式清除群组 {chat_id} 的所有未读消息和@标记（清除 {unread_count} 条未读）")
-                            except Exception as e_read:
-                                logger.warning(f"[{client_name}] 调用'Read All'清除群组 {chat_id} 未读标记时出错: {str(e_read)}")
-                            
-                            # 4. 验证清除结果：等待服务器处理
-                            if unread_count > 0:
-                                try:
-                                    # 等待服务器更新状态
-                                    await asyncio.sleep(1.0)  # 等待1秒，给服务器时间处理
-                                    logger.debug(f"[{client_name}] 已等待服务器处理群组 {chat_id} 的清除操作")
-                                except Exception as e_verify:
-                                    logger.debug(f"[{client_name}] 验证群组 {chat_id} 清除结果时出错: {str(e_verify)}")
-                            
-                            # 注意：如果"Read All"方式失败，可以启用下面的备用方法（模拟浏览）
-                            # 但通常不需要，因为 read_chat_history() 和 ReadMentions 已经足够
-                            use_fallback_browse = False  # 设置为 True 以启用备用浏览方法
-                            if use_fallback_browse:
-                                try:
-                                    max_msg_id = latest_message_id if latest_message_id else 0
-                                    if max_msg_id > 0:
-                                        logger.debug(f"[{client_name}] 开始模拟浏览群组 {chat_id} 信息清除被@标记（备用方法）...")
-                                    
-                                    # 1. 获取群组信息（模拟打开群组）
-                                    try:
-                                        chat_info = await client.get_chat(chat_id)
-                                        chat_title = chat_info.title if hasattr(chat_info, 'title') else 'N/A'
-                                        logger.debug(f"[{client_name}] 已获取群组信息: {chat_title}")
-                                        await asyncio.sleep(0.2)  # 模拟用户打开群组的延迟
-                                    except Exception as e_chat:
-                                        logger.debug(f"[{client_name}] 获取群组信息时出错: {str(e_chat)}")
-                                    
-                                    # 2. 模拟浏览消息历史（增量浏览：从上次浏览位置到最新消息）
-                                    browse_key = (i, chat_id)  # (client_index, chat_id)
-                                    last_browse_ids = chat_browse_state.get(browse_key, [])
-                                    
-                                    # 确定浏览范围
-                                    is_first_browse = len(last_browse_ids) == 0
-                                    
-                                    if last_browse_ids:
-                                        # 有上次浏览记录：从上次的最后10个消息ID中的最小ID开始，到最新消息ID结束
-                                        min_last_id = min(last_browse_ids)
-                                        max_last_id = max(last_browse_ids)
-                                        logger.debug(f"[{client_name}] 群组 {chat_id} 增量浏览：从消息ID {min_last_id} 到 {max_msg_id}（上次保存的最后10个消息ID: {last_browse_ids}）")
-                                    else:
-                                        # 第一次浏览：获取最新的消息
-                                        min_last_id = 0
-                                        max_last_id = 0
-                                        logger.debug(f"[{client_name}] 群组 {chat_id} 首次浏览：获取最新消息")
-                                    
-                                    browse_count = 0
-                                    last_read_id = 0
-                                    current_browse_ids = []  # 本次浏览的消息ID（用于更新状态）
-                                    
-                                    # 浏览消息：从上次的最小ID到最新消息（如果 max_msg_id 存在）
-                                    max_browse_id = max_msg_id if max_msg_id and max_msg_id > 0 else None
-                                    if max_browse_id:
-                                        logger.debug(f"[{client_name}] 浏览范围：从消息ID {min_last_id if last_browse_ids else '最新'} 到 {max_browse_id}")
-                                    else:
-                                        logger.debug(f"[{client_name}] 浏览范围：从消息ID {min_last_id if last_browse_ids else '最新'} 到最新消息（无限制）")
-                                    
-                                    # 第一次浏览时，至少浏览最新的10条消息，确保有消息被处理
-                                    min_browse_count = 10 if is_first_browse else 1
-                                    
-                                    logger.debug(f"[{client_name}] 开始浏览，is_first_browse={is_first_browse}, min_last_id={min_last_id}, min_browse_count={min_browse_count}, max_browse_id={max_browse_id}")
-                                    
-                                    # 增量浏览：从最新消息开始，获取从 min_last_id 到 max_browse_id 之间的消息
-                                    # 使用 offset_id=0 从最新消息开始，然后过滤
-                                    # 模拟客户端慢慢滚动查看消息
-                                    
-                                    async for message in client.get_chat_history(chat_id, limit=0, offset_id=0):
-                                        if message:
-                                            # 如果有上次浏览记录，只处理从上次最小ID开始的消息（增量浏览）
-                                            if last_browse_ids and message.id <= min_last_id:
-                                                # 已经到达上次浏览的最小ID，停止浏览
-                                                logger.debug(f"[{client_name}] 已到达上次最小ID {min_last_id}，停止浏览")
-                                                break
-                                            
-                                            # 如果设置了 max_browse_id 且已经超过，停止浏览
-                                            if max_browse_id and message.id > max_browse_id:
-                                                logger.debug(f"[{client_name}] 消息ID {message.id} 超过 max_browse_id {max_browse_id}，停止浏览")
-                                                break
-                                            
-                                            browse_count += 1
-                                            current_browse_ids.append(message.id)
-                                            logger.debug(f"[{client_name}] 浏览消息ID {message.id}（第 {browse_count} 条）")
-                                            
-                                            # 模拟用户慢慢滚动查看消息：每条消息后添加随机延迟
-                                            scroll_delay = random.uniform(operation_delay_min, operation_delay_max)
-                                            await asyncio.sleep(scroll_delay)
-                                            
-                                            # 每浏览5-10条消息，标记一次为已读（模拟用户停下来查看）
-                                            # 随机选择标记间隔，让行为更像真实用户
-                                            mark_interval = random.randint(5, 10)
-                                            if browse_count % mark_interval == 0:
-                                                try:
-                                                    await client.read_chat_history(chat_id, max_id=message.id)
-                                                    last_read_id = message.id
-                                                    # 标记为已读后，模拟用户停下来查看的延迟
-                                                    view_delay = random.uniform(0.5, 1.5)
-                                                    await asyncio.sleep(view_delay)
-                                                    logger.debug(f"[{client_name}] 已标记消息ID {message.id} 为已读（浏览了 {browse_count} 条）")
-                                                except Exception as e:
-                                                    logger.debug(f"[{client_name}] 标记消息为已读时出错: {str(e)}")
-                                            
-                                            # 随机添加"停下来仔细查看"的延迟（模拟用户对某些消息感兴趣）
-                                            if random.random() < 0.1:  # 10% 的概率
-                                                pause_delay = random.uniform(1.0, 3.0)
-                                                await asyncio.sleep(pause_delay)
-                                                logger.debug(f"[{client_name}] 模拟停下来仔细查看消息（暂停 {pause_delay:.2f} 秒）")
-                                            
-                                            # 如果设置了 max_browse_id 且已经到达，检查是否已经浏览了足够多的消息
-                                            if max_browse_id and message.id >= max_browse_id:
-                                                # 如果还没有浏览足够多的消息，继续浏览（但不会再有消息了，因为已经到达最新）
-                                                if browse_count < min_browse_count:
-                                                    logger.debug(f"[{client_name}] 已到达最新消息ID {max_browse_id}，但还需要浏览 {min_browse_count - browse_count} 条消息")
-                                                    # 继续尝试浏览，虽然可能没有更多消息了
-                                                else:
-                                                    logger.debug(f"[{client_name}] 已到达最新消息ID {max_browse_id}，已浏览 {browse_count} 条，停止浏览")
-                                                    break
-                                            
-                                            # 限制单次浏览数量，避免一次性浏览过多（最多1000条）
-                                            if browse_count >= 1000:
-                                                logger.debug(f"[{client_name}] 已达到单次浏览上限（1000条），停止浏览")
-                                                break
-                                    
-                                    # 如果第一次浏览时没有浏览到任何消息，尝试直接获取最新10条
-                                    if is_first_browse and browse_count == 0:
-                                        logger.debug(f"[{client_name}] 首次浏览未获取到消息，尝试直接获取最新10条消息")
-                                        try:
-                                            async for message in client.get_chat_history(chat_id, limit=10):
-                                                if message:
-                                                    browse_count += 1
-                                                    current_browse_ids.append(message.id)
-                                                    logger.debug(f"[{client_name}] 备用方案浏览消息ID {message.id}（第 {browse_count} 条）")
-                                                    # 模拟用户慢慢滚动查看消息
-                                                    scroll_delay = random.uniform(operation_delay_min, operation_delay_max)
-                                                    await asyncio.sleep(scroll_delay)
-                                                    # 每浏览5-10条消息，标记一次为已读
-                                                    mark_interval = random.randint(5, 10)
-                                                    if browse_count % mark_interval == 0:
-                                                        try:
-                                                            await client.read_chat_history(chat_id, max_id=message.id)
-                                                            last_read_id = message.id
-                                                            view_delay = random.uniform(0.5, 1.5)
-                                                            await asyncio.sleep(view_delay)
-                                                        except Exception:
-                                                            pass
-                                        except Exception as e_fallback:
-                                            logger.warning(f"[{client_name}] 获取最新10条消息失败: {str(e_fallback)}")
-                                    
-                                    # 如果增量浏览时没有浏览到任何消息，记录警告
-                                    if not is_first_browse and browse_count == 0:
-                                        logger.warning(f"[{client_name}] 增量浏览未获取到任何消息（上次保存的ID: {last_browse_ids}, 当前最新ID: {max_browse_id}）")
-                                    
-                                    # 获取最新的10条消息，用于更新浏览状态
-                                    latest_messages = []
-                                    async for message in client.get_chat_history(chat_id, limit=10):
-                                        if message:
-                                            latest_messages.append(message.id)
-                                    
-                                    # 更新浏览状态：保存最新的10条消息ID（从新到旧）
-                                    if latest_messages:
-                                        latest_messages.sort(reverse=True)  # 从新到旧排序
-                                        chat_browse_state[browse_key] = latest_messages[:10]
-                                        logger.debug(f"[{client_name}] 已更新浏览状态：保存最新10个消息ID: {chat_browse_state[browse_key]}")
-                                    
-                                    logger.debug(f"[{client_name}] 已模拟浏览 {browse_count} 条消息，最后标记到消息ID: {last_read_id}")
-                                    await asyncio.sleep(0.3)  # 模拟用户浏览完成后的延迟
-                                    
-                                    # 3. 多次调用 read_chat_history，确保清除所有标记（包括被@标记）
-                                    await client.read_chat_history(chat_id, max_id=max_msg_id)
-                                    await asyncio.sleep(0.1)
-                                    await client.read_chat_history(chat_id, max_id=max_msg_id)
-                                    await asyncio.sleep(0.1)
-                                    await client.read_chat_history(chat_id, max_id=max_msg_id + 1000)
-                                    
-                                    # 4. 如果是超级群组，尝试调用 ReadMentions API 作为额外保障
-                                    try:
-                                        from pyrogram.raw.functions.messages import ReadMentions
-                                        from pyrogram.raw.types import InputPeerChannel
-                                        
-                                        peer = await client.resolve_peer(chat_id)
-                                        if isinstance(peer, InputPeerChannel):
-                                            await client.invoke(
-                                                ReadMentions(
-                                                    peer=peer,
-                                                    top_msg_id=max_msg_id if max_msg_id else None
-                                                )
-                                            )
-                                            logger.debug(f"[{client_name}] 已调用 ReadMentions API 作为额外保障")
-                                            await asyncio.sleep(0.3)
-                                    except Exception as e_read_mentions:
-                                        logger.debug(f"[{client_name}] 调用 ReadMentions API 时出错（不影响主流程）: {str(e_read_mentions)}")
-                                    
-                                        logger.info(f"[{client_name}] ✓ 已通过备用方法（模拟浏览）清除群组 {chat_id} 的被@标记（标记到消息ID: {max_msg_id}，浏览了 {browse_count} 条消息）")
-                                    else:
-                                        logger.debug(f"[{client_name}] 未找到最新消息ID，跳过备用方法")
-                                except Exception as e_mentions:
-                                    logger.warning(f"[{client_name}] 备用方法（模拟浏览）清除群组 {chat_id} 被@标记时出错: {str(e_mentions)}")
-                            
-                            # 添加延迟，避免触发限流
-                            if mark_read_delay > 0:
-                                await asyncio.sleep(mark_read_delay)
-                        except FloodWait as e:
-                            # 处理限流错误，等待指定时间
-                            wait_time = e.value
-                            logger.warning(f"[{client_name}] 触发限流，等待 {wait_time} 秒后继续...")
-                            await asyncio.sleep(wait_time)
-                            # 重试一次
-                            try:
-                                await client.read_chat_history(chat_id)
-                                logger.debug(f"[{client_name}] 重试后已清除群组 {chat_id} 的未读消息标记")
-                            except Exception as e2:
-                                logger.warning(f"[{client_name}] 重试清除群组 {chat_id} 未读标记时出错: {str(e2)}")
-                        except Exception as e:
-                            logger.warning(f"[{client_name}] 清除群组 {chat_id} 未读标记时出错: {str(e)}")
-                    
-                    logger.info(f"[{client_name}] 完成清除未读标记，共处理 {len(processed_chats)} 个群组（遍历了 {chat_count} 个群组）")
-                except Exception as e:
-                    logger.error(f"[{client_name}] 定期清除未读标记任务出错: {str(e)}", exc_info=True)
-            
-        except asyncio.CancelledError:
-            break
-        except Exception as e:
-            logger.error(f"定期清除未读标记任务发生错误: {str(e)}", exc_info=True)
-            await asyncio.sleep(60)  # 出错后等待1分钟再继续
+            r = await client.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await client.resolve_peer(task.chat_id),
+                    media=media,
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, task.text or "", None, None)
+                )
+            )
+        except FilePartMissing as e:
+            await client.save_file(task.open_photo(), file_id=file.id, file_part=e.value)
+        else:
+            for update in r.updates:
+                if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                    return await types.Message._parse(
+                        client, update.message,
+                        {user.id: user for user in r.users},
+                        {chat.id: chat for chat in r.chats}
+                    )
+            return None
 
-# 消息数据结构
-class MessageTask:
-    def __init__(self, chat_id, client_index=None, text=None, photo=None):
-        self.chat_id = chat_id  # 目标群组ID（可以是整数或字符串，如 @username）
-        self.client_index = client_index  # 指定使用哪个客户端发送（如果为None，由分配策略决定）
-        self.text = text  # 文本内容（可选）
-        self.photo = photo  # 图片数据（bytes，可选）
+def skip_photo_failure(task: MessageTask, tenant: Tenant):
+    """图片下载失败的消息：记录为发送失败并结束，不发送"""
+    logger.error(f"✗ 消息 {task.task_id} 的图片下载失败，不发送到群组 {task.chat_id}: {task.photo_error}")
+    event_bus.publish('failed', tenant=task.tenant, chat_id=task.chat_id, account=None, error='PhotoFetchError', message=task.photo_error)
+    trace_recorder.finish(task.trace, 'failed', chat_id=str(task.chat_id), account='', error='PhotoFetchError')
+    tenant.record_sent(False)
+    task_status.set(task, 'failed', error=task.photo_error)
+    send_ledger.record(task, 'failed', None)
+    task.close()
+    message_queue.task_done(task)
 
-def get_client_for_chat(chat_id: int) -> Client:
-    """根据分配策略获取用于发送消息的客户端"""
-    if len(clients) == 0:
-        raise ValueError("没有可用的客户端")
-    
-    if distribution_strategy == 'round_robin':
-        # 轮询策略：每个群组按顺序使用不同的客户端
-        index = chat_client_index[chat_id] % len(clients)
-        chat_client_index[chat_id] += 1
-        selected_client = clients[index]
-        logger.debug(f"轮询分配：群组 {chat_id} 使用客户端 {accounts[index]['name']} (索引: {index})")
-        return selected_client
-    elif distribution_strategy == 'random':
-        # 随机策略：使用加权随机分配，确保更均匀
-        # 优先选择使用次数较少的客户端，但仍然保持随机性
-        usage = chat_client_usage[chat_id]
-        
-        # 计算每个客户端的使用次数
-        usage_counts = [usage.get(i, 0) for i in range(len(clients))]
-        min_usage = min(usage_counts) if usage_counts else 0
-        
-        # 找出使用次数最少的客户端（可能有多个）
-        least_used_indices = [i for i, count in enumerate(usage_counts) if count == min_usage]
-        
-        # 如果有多个使用次数最少的客户端，随机选择一个
-        # 这样可以确保均匀分配，同时保持随机性
-        if len(least_used_indices) > 1:
-            index = random.choice(least_used_indices)
-        else:
-            # 如果只有一个最少使用的，就选它
-            index = least_used_indices[0]
-        
-        # 更新使用计数
-        chat_client_usage[chat_id][index] += 1
-        
-        selected_client = clients[index]
-        logger.debug(f"随机分配（加权）：群组 {chat_id} 使用客户端 {accounts[index]['name']} (索引: {index}, 使用次数: {usage[index]})")
-        return selected_client
-    else:
-        # 默认使用第一个客户端
-        logger.warning(f"未知的分配策略: {distribution_strategy}，使用第一个客户端")
-        return clients[0]
+async def message_sender(worker: str = 'sender'):
+    """消息发送任务，从队列中取出消息并按间隔发送（使用客户端模拟操作）
 
-async def message_sender():
-    """消息发送任务，从队列中取出消息并按间隔发送（使用客户端模拟操作）"""
-    logger.info("消息发送任务已启动，等待队列中的消息...")
+    sender_workers 大于1时同时运行多个发送任务，worker 为任务名称（busy_clients、sender_phases 的键）
+    """
+    logger.info(f"消息发送任务 {worker} 已启动，等待队列中的消息...")
+    photo_upload = None
+    account_lock = None
     while True:
+        task = None
+        send_client_name = None
+        sent_message = None
+        # 上一条消息没有用到的图片上传（发送失败、重新分配账户等）不再需要
+        if photo_upload is not None and not photo_upload.done():
+            photo_upload.cancel()
+        photo_upload = None
+        # 上一条消息（包括发送后的休息时间）已结束，释放占用的账户
+        if account_lock is not None:
+            account_lock.release()
+            account_lock = None
         try:
             # 从队列中获取消息（会阻塞直到有消息）
+            busy_clients.pop(worker, None)
+            sender_phases[worker] = 'idle'
             task = await message_queue.get()
+            sender_phases[worker] = 'pacing'
+            if sender_stopping:
+                raise SenderStopped()
+            trace = task.trace
+            tenant = tenant_registry.get(task.tenant)
+            if trace.enqueued_at is not None:
+                dequeued_at = time.perf_counter()
+                trace.add('queue_wait', trace.enqueued_at, dequeued_at)
+                tenant.record_wait(dequeued_at - trace.enqueued_at)
+            
+            # 所属群发任务已暂停或取消时不发送
+            if task.campaign_id is not None and not campaign_registry.dequeued(task):
+                task.close()
+                message_queue.task_done(task)
+                continue
+            if task.photo_error is not None:
+                skip_photo_failure(task, tenant)
+                continue
+            task_status.set(task, 'sending')
+            # 图片还没下载完成时立即开始下载，与下面的模拟操作等待时间重叠
+            photo_fetch = photo_prefetcher.ensure_started(task)
+            
+            # 取一次节奏参数的引用，热重载时替换的是整个对象，本条消息使用的参数保持一致
+            p = pacing
+            
+            # 所有账户都不可用（连接断开、正在重新连接或限流等待）时先等待，避免消息发送失败
+            if not any(client_available(index) for index in range(len(clients))):
+                logger.warning("没有可用的账户（连接断开或正在限流等待），等待账户恢复后再发送...")
+                with trace.span('wait_client'):
+                    while not any(client_available(index) for index in range(len(clients))):
+                        await asyncio.sleep(1)
             
             # 选择用于发送的客户端（根据分配策略）
-            # 如果指定了 client_index，则使用指定的客户端
-            if task.client_index is not None:
-                send_client_index = task.client_index
-            else:
-                # 使用分配策略选择客户端
-                send_client = get_client_for_chat(task.chat_id)
-                send_client_index = clients.index(send_client)
+            # 如果指定了账户，则使用该账户（账户已被热重载移除或不可用时重新分配）
+            # 选定后占用该账户（账户正被其他发送任务使用时等待），并发只来自不同的账户
+            with trace.span('route'):
+                while True:
+                    pinned_index = account_index(task.account)
+                    if pinned_index is not None and client_available(pinned_index):
+                        send_client_index = pinned_index
+                    else:
+                        # 使用分配策略选择客户端
+                        send_client_index = get_client_index_for_chat(task.chat_id, avoid_busy=True)
+                    lock_name = accounts[send_client_index]['name']
+                    account_lock = account_send_locks.setdefault(lock_name, asyncio.Lock())
+                    await account_lock.acquire()
+                    # 等待期间账户被热重载移除或变为不可用（限流、断开）时重新选择
+                    if (send_client_index < len(accounts) and accounts[send_client_index]['name'] == lock_name
+                            and (client_available(send_client_index) or not any(client_available(index) for index in range(len(clients))))):
+                        break
+                    account_lock.release()
+                    account_lock = None
             
             send_client = clients[send_client_index]
             send_client_name = accounts[send_client_index]['name']
+            health = account_health[send_client_name]
+            # 记录正在使用的客户端，热重载移除账户时等待发送完成后再停止
+            busy_clients[worker] = send_client
+            # 图片消息：选定账户后立即开始上传，与下面的模拟操作等待时间重叠
+            if task.photo is not None or photo_fetch is not None:
+                photo_upload = asyncio.ensure_future(upload_photo(send_client, task, photo_fetch))
+                # 上传失败时由发送步骤处理异常；消息被跳过时不会等待结果，这里取出异常避免未处理异常的警告
+                photo_upload.add_done_callback(lambda f: f.cancelled() or f.exception())
+            event_bus.publish('dispatched', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, queue_size=message_queue.qsize())
             
             # 记录发送信息
             content_desc = []
             if task.text:
                 content_desc.append("文本")
-            if task.photo:
+            if task.photo or task.photo_url:
                 content_desc.append("图片")
             logger.info(f"从队列获取到发送任务，准备发送到群组 {task.chat_id}...")
             logger.info(f"使用客户端 {send_client_name} 发送消息到群组 {task.chat_id}（内容: {', '.join(content_desc) if content_desc else '空'}）")
             
             # ========== 模拟真人操作流程 ==========
-            # 获取队列大小，用于动态调整延迟
+            # 获取队列大小，用于动态调整延迟（计算方法见 PacingConfig.send_delays）
             queue_size = message_queue.qsize()
+            delays = p.send_delays(queue_size)
+            if delays['speed_factor'] < 1.0:
+                logger.debug(f"🚀 队列较大（{queue_size}条），启用加速模式，加速因子: {delays['speed_factor']:.2f}")
             
-            # 当队列数量很大时，动态减少延迟以加快发送速度
-            # 队列阈值：超过100条时开始加速
-            speed_up_threshold = 100
-            if queue_size > speed_up_threshold:
-                # 计算加速因子（队列越大，加速越多，但不会完全取消延迟）
-                # 当队列为100时，加速因子为1.0（不加速）
-                # 当队列为1000时，加速因子约为0.1（加速10倍）
-                speed_factor = max(0.1, 1.0 / (1.0 + (queue_size - speed_up_threshold) / 200.0))
-                logger.debug(f"🚀 队列较大（{queue_size}条），启用加速模式，加速因子: {speed_factor:.2f}")
-            else:
-                speed_factor = 1.0
-            
-            # 1. 思考时间：模拟看到消息后的反应时间（使用正态分布，更自然）
-            # 队列大时减少思考时间
-            adjusted_think_time_min = think_time_min * speed_factor
-            adjusted_think_time_max = think_time_max * speed_factor
-            think_time = max(adjusted_think_time_min, min(adjusted_think_time_max, 
-                random.gauss((adjusted_think_time_min + adjusted_think_time_max) / 2, 
-                           (adjusted_think_time_max - adjusted_think_time_min) / 4)))
-            logger.debug(f"💭 模拟思考时间: {think_time:.2f} 秒...")
-            await asyncio.sleep(think_time)
-            
-            # 2. 基础发送间隔 + 随机抖动（使用更不规律的分布）
-            # 使用 Beta 分布，让延迟更集中在中间值，但偶尔会有较大波动
-            # 队列大时减少发送间隔
-            adjusted_send_interval = send_interval * speed_factor
-            adjusted_send_jitter = send_jitter * speed_factor
-            beta_value = random.betavariate(2, 2)  # Beta(2,2) 分布，集中在中间
-            jitter = adjusted_send_jitter * beta_value
-            base_delay = adjusted_send_interval + jitter
-            
-            # 3. 批量消息额外延迟：如果队列中有多条消息，增加延迟（模拟真人不会立即处理所有消息）
-            # 队列大时，批量延迟设置上限，避免延迟过长
-            if queue_size > speed_up_threshold:
-                # 队列大时，批量延迟有上限（最多增加10秒）
-                max_batch_delay = 10.0
-                batch_delay = min(queue_size * batch_delay_factor * speed_factor, max_batch_delay)
-            else:
-                batch_delay = queue_size * batch_delay_factor
+            # 1. 思考时间：模拟看到消息后的反应时间
+            logger.debug(f"💭 模拟思考时间: {delays['think_time']:.2f} 秒...")
+            with trace.span('think'):
+                await asyncio.sleep(delays['think_time'])
             
+            # 2. 基础发送间隔 + 随机抖动，3. 批量消息额外延迟
             if queue_size > 0:
-                logger.debug(f"📦 队列中有 {queue_size} 条待处理消息，批量延迟: {batch_delay:.2f} 秒")
+                logger.debug(f"📦 队列中有 {queue_size} 条待处理消息，批量延迟: {delays['batch_delay']:.2f} 秒")
             
-            total_delay = base_delay + batch_delay
-            logger.info(f"⏱️  等待 {total_delay:.2f} 秒后发送（基础间隔: {adjusted_send_interval:.2f}秒，抖动: {jitter:.2f}秒，批量延迟: {batch_delay:.2f}秒）...")
+            total_delay = delays['send_interval'] + delays['jitter'] + delays['batch_delay']
+            logger.info(f"⏱️  等待 {total_delay:.2f} 秒后发送（基础间隔: {delays['send_interval']:.2f}秒，抖动: {delays['jitter']:.2f}秒，批量延迟: {delays['batch_delay']:.2f}秒）...")
             
-            # 等待延迟时间
-            await asyncio.sleep(total_delay)
+            # 等待延迟时间（分两段等待，分别记录基础间隔+抖动和批量延迟的耗时）
+            with trace.span('interval'):
+                await asyncio.sleep(delays['send_interval'] + delays['jitter'])
+            if delays['batch_delay'] > 0:
+                with trace.span('batch'):
+                    await asyncio.sleep(delays['batch_delay'])
             
             # 4. 操作前延迟：模拟点击、选择等操作时间
-            # 队列大时减少操作延迟
-            adjusted_operation_delay_min = operation_delay_min * speed_factor
-            adjusted_operation_delay_max = operation_delay_max * speed_factor
-            operation_delay = random.uniform(adjusted_operation_delay_min, adjusted_operation_delay_max)
-            logger.debug(f"👆 模拟操作延迟: {operation_delay:.2f} 秒（点击、选择等）...")
-            await asyncio.sleep(operation_delay)
+            logger.debug(f"👆 模拟操作延迟: {delays['operation_delay']:.2f} 秒（点击、选择等）...")
+            with trace.span('operation'):
+                await asyncio.sleep(delays['operation_delay'])
+            
+            # 等待图片下载完成
+            if photo_fetch is not None:
+                with trace.span('photo_wait'):
+                    await asyncio.shield(photo_fetch)
+                if task.photo_error is not None:
+                    skip_photo_failure(task, tenant)
+                    continue
             
-            # 发送消息
+            # 发送消息（停止程序时不再开始新的发送请求）
+            if sender_stopping:
+                raise SenderStopped()
+            sender_phases[worker] = 'sending'
+            input_file = None
             try:
                 # 检查客户端是否连接
                 if not send_client.is_connected:
@@ -724,9 +3597,15 @@ async def message_sender():
                 # 必须先获取群组信息，这样 Pyrogram 才能解析 chat_id
                 # 如果客户端未加入群组，get_chat 会失败
                 try:
-                    chat = await send_client.get_chat(task.chat_id)
+                    started = time.perf_counter()
+                    with trace.span('get_chat'):
+                        chat = await send_client.get_chat(task.chat_id)
+                    # get_chat 的耗时与消息内容无关，用作账户请求耗时的样本
+                    health.record_latency(time.perf_counter() - started)
                     chat_title = chat.title if hasattr(chat, 'title') and chat.title else 'N/A'
                     logger.info(f"✓ 验证群组 {task.chat_id} 存在，标题: {chat_title}")
+                except (ConnectionError, TimeoutError, asyncio.TimeoutError, FloodWait):
+                    raise
                 except Exception as e:
                     error_msg = str(e)
                     logger.error(f"✗ 无法获取群组 {task.chat_id} 信息: {error_msg}")
@@ -735,30 +3614,36 @@ async def message_sender():
                     logger.error(f"     1. 确保客户端 {send_client_name} 已加入群组 {task.chat_id}")
                     logger.error(f"     2. 如果使用数字 ID，确保格式正确（群组 ID 通常是负数）")
                     logger.error(f"     3. 可以尝试使用群组用户名（如 @groupname）代替数字 ID")
+                    event_bus.publish('failed', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, error=type(e).__name__, message=error_msg)
+                    trace_recorder.finish(trace, 'failed', chat_id=str(task.chat_id), account=send_client_name, error=type(e).__name__)
+                    tenant.record_sent(False)
+                    task_status.set(task, 'failed', account=send_client_name, error=error_msg)
+                    send_ledger.record(task, 'failed', send_client_name)
+                    campaign_registry.record(task, False)
                     # 不抛出异常，记录错误后继续处理下一条消息
-                    message_queue.task_done()
+                    task.close()
+                    message_queue.task_done(task)
                     continue
                 
                 sent_message = None
                 if task.photo:
                     # 发送图片（可以带说明文字）
-                    if isinstance(task.photo, bytes):
-                        # Pyrogram 需要文件对象，将 bytes 转换为 BytesIO
-                        photo_file = io.BytesIO(task.photo)
-                        sent_message = await send_client.send_photo(
-                            chat_id=task.chat_id,
-                            photo=photo_file,
-                            caption=task.text if task.text else None
-                        )
+                    if isinstance(task.photo, (bytes, SpooledPhoto)) or hasattr(task.photo, 'read'):
+                        # 图片在模拟操作期间已开始上传，这里等待上传完成后只发送 SendMedia
+                        with trace.span('upload_wait'):
+                            input_file = await photo_upload
+                        with trace.span('send'):
+                            sent_message = await send_uploaded_photo(send_client, task, input_file)
                     else:
-                        logger.error(f"图片内容格式错误，应为 bytes 类型")
+                        logger.error(f"图片内容格式错误，应为 bytes 或文件对象")
                         raise ValueError("图片内容格式错误")
                 elif task.text:
                     # 只发送文本消息
-                    sent_message = await send_client.send_message(
-                        chat_id=task.chat_id,
-                        text=task.text
-                    )
+                    with trace.span('send'):
+                        sent_message = await send_client.send_message(
+                            chat_id=task.chat_id,
+                            text=task.text
+                        )
                 else:
                     logger.error(f"消息内容为空，必须提供文本或图片")
                     raise ValueError("消息内容为空")
@@ -766,31 +3651,59 @@ async def message_sender():
                 if sent_message:
                     msg_type = "图片" if task.photo else "文本"
                     logger.info(f"✓ 已通过客户端 {send_client_name} 发送{msg_type}消息到群组 {task.chat_id} (消息ID: {sent_message.id})")
+                    event_bus.publish('sent', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, message_id=sent_message.id)
                 else:
                     logger.warning(f"⚠ 客户端 {send_client_name} 发送消息返回 None")
             
+            except (ConnectionError, TimeoutError, asyncio.TimeoutError) as e:
+                # 连接断开或请求超时：标记账户不可用并通知连接监控尽快检查，消息放回队列改用其他账户发送
+                health.record_result(False, f"{type(e).__name__}: {e}")
+                health.alive = False
+                health.next_check = 0.0
+                task.reroutes += 1
+                if task.reroutes > SENDER_MAX_REROUTES:
+                    logger.error(f"✗ 发送到群组 {task.chat_id} 的消息已重新分配 {SENDER_MAX_REROUTES} 次仍失败，放弃发送")
+                    raise
+                logger.warning(f"✗ 客户端 {send_client_name} 连接异常（{type(e).__name__}: {e}），消息放回队列重新分配账户")
+                event_bus.publish('rerouted', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, error=type(e).__name__)
+                send_ledger.record(task, 'rerouted', send_client_name)
+                task.account = None
+                task.trace.enqueued_at = time.perf_counter()
+                task_status.set(task, 'queued')
+                message_queue.requeue(task)
+                continue
             except FloodWait as e:
                 # 处理限流错误
                 wait_time = e.value
+                health.record_flood(wait_time)
                 logger.warning(f"✗ 客户端 {send_client_name} 触发限流，需要等待 {wait_time} 秒")
-                await asyncio.sleep(wait_time)
+                event_bus.publish('flood_wait_start', source='sender', account=send_client_name, chat_id=task.chat_id, seconds=wait_time)
+                with trace.span('flood_wait'):
+                    await asyncio.sleep(wait_time)
+                event_bus.publish('flood_wait_end', source='sender', account=send_client_name, chat_id=task.chat_id, seconds=wait_time)
+                send_ledger.record(task, 'flood_wait', send_client_name, flood_wait=wait_time)
                 # 重试一次
                 try:
-                    if task.photo:
-                        # Pyrogram 需要文件对象，将 bytes 转换为 BytesIO
-                        photo_file = io.BytesIO(task.photo)
-                        sent_message = await send_client.send_photo(
-                            chat_id=task.chat_id,
-                            photo=photo_file,
-                            caption=task.text if task.text else None
-                        )
-                    elif task.text:
-                        sent_message = await send_client.send_message(
-                            chat_id=task.chat_id,
-                            text=task.text
-                        )
+                    with trace.span('retry_send'):
+                        if task.photo:
+                            # 限流发生在发送之前的步骤（如 get_chat）时，后台上传仍在进行或已完成，复用其结果；
+                            # 上传本身失败（如上传期间触发限流）时才重新上传；已上传的文件过期时 send_uploaded_photo 会补传
+                            if input_file is None and photo_upload is not None and not photo_upload.cancelled():
+                                try:
+                                    input_file = await photo_upload
+                                except Exception:
+                                    input_file = None
+                            if input_file is None:
+                                input_file = await send_client.save_file(task.open_photo())
+                            sent_message = await send_uploaded_photo(send_client, task, input_file)
+                        elif task.text:
+                            sent_message = await send_client.send_message(
+                                chat_id=task.chat_id,
+                                text=task.text
+                            )
                     if sent_message:
                         logger.info(f"✓ 重试后已通过客户端 {send_client_name} 发送消息到群组 {task.chat_id} (消息ID: {sent_message.id})")
+                        event_bus.publish('sent', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, message_id=sent_message.id)
                 except Exception as e_retry:
                     logger.error(f"✗ 客户端 {send_client_name} 重试发送消息也失败: {str(e_retry)}", exc_info=True)
                     raise e_retry
@@ -801,6 +3714,11 @@ async def message_sender():
                     logger.error(f"✗ 客户端 {send_client_name} 无法发送消息到群组 {task.chat_id}: 客户端可能未加入该群组，或 chat_id 格式不正确")
                     logger.error(f"   提示：请确保客户端 {send_client_name} 已加入群组 {task.chat_id}")
                     logger.error(f"   提示：如果使用用户名，请使用 @username 格式；如果使用数字 ID，请确保格式正确")
+                    event_bus.publish('failed', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, error=type(e).__name__, message=error_msg)
+                    trace_recorder.finish(trace, 'failed', chat_id=str(task.chat_id), account=send_client_name, error=type(e).__name__)
+                    tenant.record_sent(False)
+                    task_status.set(task, 'failed', account=send_client_name, error=error_msg)
+                    send_ledger.record(task, 'failed', send_client_name)
                     # 不抛出异常，记录错误后继续处理下一条消息
                 else:
                     logger.error(f"✗ 客户端 {send_client_name} 发送消息到群组 {task.chat_id} 时发生错误: {error_msg}", exc_info=True)
@@ -812,41 +3730,1255 @@ async def message_sender():
                     logger.error(f"✗ 客户端 {send_client_name} 无法发送消息到群组 {task.chat_id}: 客户端可能未加入该群组，或 chat_id 格式不正确")
                     logger.error(f"   提示：请确保客户端 {send_client_name} 已加入群组 {task.chat_id}")
                     logger.error(f"   提示：如果使用用户名，请使用 @username 格式；如果使用数字 ID，请确保格式正确")
+                    event_bus.publish('failed', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, error=type(e).__name__, message=error_msg)
+                    trace_recorder.finish(trace, 'failed', chat_id=str(task.chat_id), account=send_client_name, error=type(e).__name__)
+                    tenant.record_sent(False)
+                    task_status.set(task, 'failed', account=send_client_name, error=error_msg)
+                    send_ledger.record(task, 'failed', send_client_name)
                     # 不抛出异常，记录错误后继续处理下一条消息
                 else:
                     logger.error(f"✗ 客户端 {send_client_name} 发送消息到群组 {task.chat_id} 时发生错误: {error_msg}", exc_info=True)
                     raise
             
             # 标记任务完成
-            message_queue.task_done()
+            if trace.end is None:
+                # 发送失败（未加入群组等）的消息已在上面结束追踪并计入失败数
+                tenant.record_sent(True)
+                health.record_result(True)
+                task_status.set(task, 'sent', account=send_client_name, message_id=sent_message.id if sent_message else 0)
+                send_ledger.record(task, 'sent', send_client_name, sent_message.id if sent_message else 0)
+            campaign_registry.record(task, trace.end is None)
+            task.close()
+            message_queue.task_done(task)
+            sender_phases[worker] = 'rest'
+            busy_clients.pop(worker, None)
             queue_size = message_queue.qsize()
             logger.info(f"✅ 消息发送完成，当前队列剩余: {queue_size} 条")
             
             # 5. 偶尔的休息时间：模拟真人不会一直盯着屏幕（随机休息）
-            if random.random() < rest_probability:
-                rest_time = random.uniform(rest_time_min, rest_time_max)
+            rest_time = p.rest_time()
+            if rest_time > 0:
                 logger.info(f"😴 模拟休息时间: {rest_time:.1f} 秒（随机休息，模拟真人行为）...")
-                await asyncio.sleep(rest_time)
+                with trace.span('rest'):
+                    await asyncio.sleep(rest_time)
+            trace_recorder.finish(
+                trace, 'sent', chat_id=str(task.chat_id), account=send_client_name,
+                message_id=sent_message.id if sent_message else 0, has_photo=task.photo is not None
+            )
+            
+        except (asyncio.CancelledError, SenderStopped):
+            if photo_upload is not None:
+                photo_upload.cancel()
+            if account_lock is not None:
+                account_lock.release()
+                account_lock = None
+            phase = sender_phases.get(worker)
+            if task is not None and phase in ('pacing', 'sending'):
+                # 取消时本条消息尚未完成，放回队列，停止程序时会保存到检查点文件
+                if phase == 'sending':
+                    logger.warning(f"发送到群组 {task.chat_id} 的请求被中断，消息已放回队列（如果实际已发送，重启后会重复发送）")
+                task_status.set(task, 'queued')
+                message_queue.requeue(task)
+            sender_phases[worker] = 'idle'
+            logger.info(f"消息发送任务 {worker} 已停止")
+            break
+        except Exception as e:
+            logger.error(f"消息发送任务发生错误: {str(e)}", exc_info=True)
+            if send_client_name is not None and sender_phases.get(worker) == 'sending':
+                account_health[send_client_name].record_result(False, f"{type(e).__name__}: {e}")
+            if task is not None:
+                event_bus.publish('failed', tenant=task.tenant, chat_id=task.chat_id, account=send_client_name, error=type(e).__name__, message=str(e))
+                trace_recorder.finish(task.trace, 'failed', chat_id=str(task.chat_id), account=send_client_name or '', error=type(e).__name__)
+                tenant_registry.get(task.tenant).record_sent(False)
+                task.close()
+                if sender_phases.get(worker) != 'rest':
+                    task_status.set(task, 'failed', account=send_client_name, error=str(e) or type(e).__name__)
+                    send_ledger.record(task, 'failed', send_client_name)
+                    campaign_registry.record(task, False)
+                    message_queue.task_done(task)
+            if account_lock is not None:
+                account_lock.release()
+                account_lock = None
+            await asyncio.sleep(1)  # 出错后等待1秒再继续
+
+# 已移除消息监听功能，现在只通过 HTTP API 发送消息
+
+# 启动消息发送任务的辅助函数
+async def start_sender():
+    """启动消息发送任务（sender_workers 个，同一群组的消息由队列保证按入队顺序发送）"""
+    global sender_stopping
+    sender_stopping = False
+    if sender_workers == 1:
+        await message_sender()
+    else:
+        await asyncio.gather(*(message_sender(f"sender{i + 1}") for i in range(sender_workers)))
+
+# ========== 图片预处理部分 ==========
+# 图片在进程池中处理，不阻塞事件循环；处理结果按内容哈希缓存
+
+# 预处理进程池（首次使用时创建）
+image_executor: Optional[ProcessPoolExecutor] = None
+
+# 预处理结果缓存，key: 原图 sha256，value: 处理后的图片数据（LRU，最多 image_cache_size 条）
+image_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+# 预处理统计信息（各阶段耗时单位为秒）
+image_metrics = {
+    'processed': 0,
+    'cache_hits': 0,
+    'failed': 0,
+    'bytes_in': 0,
+    'bytes_out': 0,
+    'stages': {},
+}
+
+def _preprocess_image_worker(data: bytes, max_side: int, target_bytes: int):
+    """在子进程中执行：校验真实图片格式、缩放到 Telegram 限制内并重新编码
+
+    返回 (图片数据, 处理信息, 各阶段耗时)，图片无效时抛出 ValueError
+    """
+    from PIL import Image, ImageOps
+
+    timings = {}
+
+    # 1. 解码并校验：根据文件内容识别格式，而不是信任 content_type
+    stage_start = time.perf_counter()
+    try:
+        with Image.open(io.BytesIO(data)) as probe:
+            probe.verify()
+        image = Image.open(io.BytesIO(data))
+        image_format = image.format
+        image.load()
+    except Exception:
+        raise ValueError("文件内容不是可识别的图片格式")
+    timings['decode'] = time.perf_counter() - stage_start
+
+    width, height = image.size
+    info = {
+        'format': image_format,
+        'original_size': len(data),
+        'original_width': width,
+        'original_height': height,
+    }
+    if max(width, height) / max(1, min(width, height)) > TELEGRAM_PHOTO_MAX_RATIO:
+        raise ValueError(f"图片宽高比超过 Telegram 限制（{width}x{height}）")
+
+    scale = min(1.0, max_side / max(width, height), TELEGRAM_PHOTO_MAX_DIMENSION_SUM / (width + height))
+    original_fits = scale >= 1.0 and len(data) <= TELEGRAM_PHOTO_MAX_BYTES and image_format in ('JPEG', 'PNG', 'WEBP')
+
+    # 已满足尺寸和大小要求的 JPEG 原样返回，避免重复压缩损失画质
+    if original_fits and image_format == 'JPEG' and len(data) <= target_bytes:
+        timings['resize'] = 0.0
+        timings['encode'] = 0.0
+        info.update(width=width, height=height, size=len(data), reencoded=False)
+        return data, info, timings
+
+    # 2. 缩放：按 EXIF 方向旋转后等比缩小，透明背景合成到白底（JPEG 不支持透明通道）
+    stage_start = time.perf_counter()
+    image = ImageOps.exif_transpose(image)
+    width, height = image.size
+    scale = min(1.0, max_side / max(width, height), TELEGRAM_PHOTO_MAX_DIMENSION_SUM / (width + height))
+    if scale < 1.0:
+        image = image.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.LANCZOS)
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.split()[-1])
+        image = background
+    elif image.mode != 'RGB':
+        image = image.convert('RGB')
+    timings['resize'] = time.perf_counter() - stage_start
+
+    # 3. 重新编码为 JPEG：逐步降低质量，仍超过目标大小时再缩小尺寸
+    stage_start = time.perf_counter()
+    encoded = b''
+    for _ in range(4):
+        for quality in (90, 85, 80, 75, 65, 55):
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=quality, optimize=True, progressive=True)
+            encoded = buffer.getvalue()
+            if len(encoded) <= target_bytes:
+                break
+        if len(encoded) <= target_bytes:
+            break
+        image = image.resize((max(1, int(image.width * 0.75)), max(1, int(image.height * 0.75))), Image.LANCZOS)
+    timings['encode'] = time.perf_counter() - stage_start
+
+    # 原图本身已符合限制且更小（例如小尺寸 PNG），则保留原图
+    if original_fits and len(data) <= len(encoded):
+        info.update(width=info['original_width'], height=info['original_height'], size=len(data), reencoded=False)
+        return data, info, timings
+    if len(encoded) > TELEGRAM_PHOTO_MAX_BYTES:
+        raise ValueError(f"图片重新编码后仍超过 Telegram 大小限制（{len(encoded)} 字节）")
+
+    info.update(width=image.width, height=image.height, size=len(encoded), reencoded=True)
+    return encoded, info, timings
+
+def _record_image_stage(stage: str, seconds: float):
+    """记录图片预处理某个阶段的耗时"""
+    stats = image_metrics['stages'].setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0})
+    stats['count'] += 1
+    stats['total'] += seconds
+    stats['max'] = max(stats['max'], seconds)
+
+def get_image_metrics() -> dict:
+    """获取图片预处理统计信息（耗时单位转换为毫秒）"""
+    stages = {}
+    for stage, stats in image_metrics['stages'].items():
+        stages[stage] = {
+            'count': stats['count'],
+            'avg_ms': round(stats['total'] / stats['count'] * 1000, 2) if stats['count'] else 0.0,
+            'max_ms': round(stats['max'] * 1000, 2),
+        }
+    return {
+        'processed': image_metrics['processed'],
+        'cache_hits': image_metrics['cache_hits'],
+        'failed': image_metrics['failed'],
+        'cache_entries': len(image_cache),
+        'bytes_in': image_metrics['bytes_in'],
+        'bytes_out': image_metrics['bytes_out'],
+        'stages': stages,
+    }
+
+async def preprocess_photo(data: bytes, digest: Optional[str] = None) -> bytes:
+    """预处理待发送的图片（未启用时原样返回）
+
+    digest 为调用方已计算好的 sha256（流式接收时边收边算），为空时在此计算。
+    图片无效时抛出 ValueError；进程池异常时记录警告并返回原图
+    """
+    global image_executor
+
+    if not image_preprocess:
+        return data
+
+    total_start = time.perf_counter()
+    if digest is None:
+        digest = hashlib.sha256(data).hexdigest()
+        _record_image_stage('hash', time.perf_counter() - total_start)
+
+    cached = image_cache.get(digest)
+    if cached is not None:
+        image_cache.move_to_end(digest)
+        image_metrics['cache_hits'] += 1
+        logger.debug(f"图片预处理命中缓存: {digest[:12]}，大小: {len(cached)} 字节")
+        return cached
+
+    if image_executor is None:
+        image_executor = ProcessPoolExecutor(max_workers=image_preprocess_workers)
+        logger.info(f"图片预处理进程池已创建，进程数: {image_preprocess_workers}")
+
+    loop = asyncio.get_running_loop()
+    try:
+        result, info, timings = await loop.run_in_executor(
+            image_executor, _preprocess_image_worker, data, image_max_side, image_target_bytes
+        )
+    except ValueError:
+        image_metrics['failed'] += 1
+        raise
+    except Exception as e:
+        image_metrics['failed'] += 1
+        logger.warning(f"图片预处理失败，将发送原图: {str(e)}")
+        return data
+
+    for stage, seconds in timings.items():
+        _record_image_stage(stage, seconds)
+    _record_image_stage('total', time.perf_counter() - total_start)
+    image_metrics['processed'] += 1
+    image_metrics['bytes_in'] += len(data)
+    image_metrics['bytes_out'] += len(result)
+
+    if image_cache_size > 0:
+        image_cache[digest] = result
+        while len(image_cache) > image_cache_size:
+            image_cache.popitem(last=False)
+
+    logger.info(
+        f"🖼️ 图片预处理完成: {info['format']} {info['original_width']}x{info['original_height']} "
+        f"{info['original_size']} 字节 -> {info['width']}x{info['height']} {info['size']} 字节"
+        f"（{'已重新编码' if info['reencoded'] else '保留原图'}，耗时 {(time.perf_counter() - total_start) * 1000:.0f} 毫秒）"
+    )
+    return result
+
+# ========== 流式表单解析部分 ==========
+# /api/send 的请求体按块解析：图片边接收边写入，单个请求占用的内存只与缓冲块大小和 upload_spool_threshold 有关
+
+# 普通表单字段（chat_id、text、photo URL）的最大长度（字节）
+MAX_FORM_FIELD_SIZE = 64 * 1024
+
+# 从 URL 下载图片时每次读取的块大小（字节）
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+class SpooledPhoto:
+    """已转存到临时文件的图片：只保存路径，不占用文件描述符（上传时由 Pyrogram 打开），close() 时删除临时文件"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+
+    def read(self) -> bytes:
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def close(self):
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+class PhotoSpool:
+    """流式接收的图片数据：小于 upload_spool_threshold 时保存在内存中，超过后转存到临时文件，同时计算 sha256
+
+    放入队列时用 finish_photo() 关闭临时文件，消息只保存路径，大量图片消息排队时不会耗尽文件描述符
+    """
+
+    def __init__(self, filename: Optional[str] = None, content_type: Optional[str] = None):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.file = io.BytesIO()
+        self._sha256 = hashlib.sha256()
+        self._path = None
+
+    def write(self, chunk: bytes):
+        """追加一块数据，超过阈值时转存到磁盘"""
+        if isinstance(self.file, io.BytesIO) and self.size + len(chunk) > upload_spool_threshold:
+            suffix = os.path.splitext(self.filename or '')[1] or '.jpg'
+            fd, self._path = tempfile.mkstemp(prefix='tgupload_', suffix=suffix)
+            disk_file = os.fdopen(fd, 'w+b')
+            disk_file.write(self.file.getvalue())
+            self.file = disk_file
+        self.file.write(chunk)
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+
+    def hexdigest(self) -> str:
+        """已接收数据的 sha256"""
+        return self._sha256.hexdigest()
+
+    def finish(self):
+        """结束写入，返回可供 Pyrogram 上传的文件对象（指针位于开头）"""
+        self.file.seek(0)
+        return self.file
+
+    def finish_photo(self):
+        """结束写入，返回放入队列的图片：数据在内存中时返回文件对象，在临时文件中时关闭文件并返回 SpooledPhoto"""
+        if self._path is None:
+            return self.finish()
+        self.file.close()
+        photo = SpooledPhoto(self._path, self.size)
+        self._path = None  # 临时文件由 SpooledPhoto 负责删除
+        return photo
+
+    def read_all(self) -> bytes:
+        """读取全部数据（仅在需要完整数据时使用，例如图片预处理）"""
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        """释放内存或临时文件"""
+        try:
+            self.file.close()
+        finally:
+            if self._path:
+                try:
+                    os.unlink(self._path)
+                except OSError:
+                    pass
+                self._path = None
+
+class StreamingSendForm:
+    """/api/send 的流式 multipart 解析器，photo 文件字段写入 PhotoSpool，其他字段保存为字符串
+
+    file_fields 中的其他文件字段（如群发任务的 targets）同样写入 PhotoSpool，保存在 files 中
+    """
+
+    def __init__(self, boundary: bytes, file_fields: tuple = ('photo',)):
+        self.fields: Dict[str, str] = {}
+        self.photo: Optional[PhotoSpool] = None
+        self.files: Dict[str, PhotoSpool] = {}
+        self.file_fields = file_fields
+        self.received = 0
+        self._header_field = b''
+        self._header_value = b''
+        self._disposition = b''
+        self._content_type = b''
+        self._field_name = None
+        self._field_data = None
+        self._part_spool = None
+        self._parser = MultipartParser(boundary, {
+            'on_part_begin': self._on_part_begin,
+            'on_part_data': self._on_part_data,
+            'on_part_end': self._on_part_end,
+            'on_header_field': self._on_header_field,
+            'on_header_value': self._on_header_value,
+            'on_header_end': self._on_header_end,
+            'on_headers_finished': self._on_headers_finished,
+        })
+
+    def _on_part_begin(self):
+        self._disposition = b''
+        self._content_type = b''
+        self._field_name = None
+        self._field_data = None
+        self._part_spool = None
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        field = self._header_field.lower()
+        if field == b'content-disposition':
+            self._disposition = self._header_value
+        elif field == b'content-type':
+            self._content_type = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b'name' not in options:
+            raise HTTPException(status_code=400, detail="表单字段缺少 name")
+        self._field_name = options[b'name'].decode('utf-8', errors='replace')
+        if b'filename' in options:
+            # 只接收 file_fields 中的文件字段（默认只有 photo），其他文件字段的数据直接丢弃
+            if self._field_name in self.file_fields:
+                if self._field_name in self.files:
+                    raise HTTPException(status_code=400, detail=f"只能上传一个 {self._field_name} 文件")
+                filename = options[b'filename'].decode('utf-8', errors='replace')
+                content_type = self._content_type.decode('latin-1') if self._content_type else None
+                self._part_spool = PhotoSpool(os.path.basename(filename), content_type)
+                self.files[self._field_name] = self._part_spool
+                if self._field_name == 'photo':
+                    self.photo = self._part_spool
+        else:
+            self._field_data = bytearray()
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if self._part_spool is not None:
+            self._part_spool.write(data[start:end])
+        elif self._field_data is not None:
+            if len(self._field_data) + (end - start) > MAX_FORM_FIELD_SIZE:
+                raise HTTPException(status_code=413, detail=f"表单字段 {self._field_name} 超过 {MAX_FORM_FIELD_SIZE} 字节")
+            self._field_data.extend(data[start:end])
+
+    def _on_part_end(self):
+        if self._field_data is not None:
+            self.fields[self._field_name] = self._field_data.decode('utf-8', errors='replace')
+        self._field_data = None
+        self._part_spool = None
+
+    async def parse(self, request: Request):
+        """边接收边解析请求体，累计大小超过 max_upload_size 时立即返回 413"""
+        async for chunk in request.stream():
+            self.received += len(chunk)
+            if self.received > max_upload_size:
+                raise HTTPException(status_code=413, detail=f"请求体超过 {max_upload_size} 字节限制")
+            self._parser.write(chunk)
+        self._parser.finalize()
+
+    def close(self):
+        """释放已接收的图片数据"""
+        for spool in self.files.values():
+            spool.close()
+        self.files.clear()
+        self.photo = None
+
+async def parse_send_form(request: Request, file_fields: tuple = ('photo',)) -> StreamingSendForm:
+    """解析 /api/send 的请求体（multipart/form-data 流式解析，也兼容 application/x-www-form-urlencoded）"""
+    # 根据 Content-Length 提前拒绝过大的请求，不读取请求体
+    content_length = request.headers.get('content-length')
+    if content_length and content_length.isdigit() and int(content_length) > max_upload_size:
+        raise HTTPException(status_code=413, detail=f"请求体超过 {max_upload_size} 字节限制")
+    
+    content_type, options = parse_options_header(request.headers.get('content-type'))
+    if content_type == b'multipart/form-data':
+        boundary = options.get(b'boundary')
+        if not boundary:
+            raise HTTPException(status_code=400, detail="multipart/form-data 请求缺少 boundary")
+        form = StreamingSendForm(boundary, file_fields)
+        try:
+            await form.parse(request)
+        except HTTPException:
+            form.close()
+            raise
+        except Exception as e:
+            form.close()
+            raise HTTPException(status_code=400, detail=f"解析表单失败: {str(e)}")
+        return form
+    
+    if content_type == b'application/x-www-form-urlencoded':
+        # 只包含文本字段，数据量很小，直接使用 Starlette 解析
+        form = StreamingSendForm(b'-')
+        parsed = await request.form()
+        for key, value in parsed.items():
+            if isinstance(value, str):
+                form.fields[key] = value
+        return form
+    
+    raise HTTPException(status_code=415, detail="Content-Type 必须是 multipart/form-data 或 application/x-www-form-urlencoded")
+
+async def download_photo(url: str) -> PhotoSpool:
+    """从 URL 下载图片到 PhotoSpool，超过 max_upload_size 时立即中止"""
+    import aiohttp
+    spool = PhotoSpool(os.path.basename(urlparse(url).path) or None)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url, timeout=aiohttp.ClientTimeout(total=30)) as response:
+                if response.status != 200:
+                    raise HTTPException(status_code=400, detail=f"下载图片失败，HTTP 状态码: {response.status}")
+                
+                if response.content_length and response.content_length > max_upload_size:
+                    raise HTTPException(status_code=400, detail=f"图片超过 {max_upload_size} 字节限制")
+                
+                # 验证内容类型
+                content_type = response.headers.get('Content-Type', '')
+                spool.content_type = content_type or None
+                if content_type and not content_type.startswith('image/'):
+                    logger.warning(f"从 URL 下载的文件可能不是图片: {content_type}")
+                
+                async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    if spool.size + len(chunk) > max_upload_size:
+                        raise HTTPException(status_code=400, detail=f"图片超过 {max_upload_size} 字节限制")
+                    spool.write(chunk)
+                
+                if spool.size == 0:
+                    raise HTTPException(status_code=400, detail="从 URL 下载的图片为空")
+        return spool
+    except BaseException:
+        spool.close()
+        raise
+
+# ========== 图片预取部分 ==========
+# /api/send 收到图片 URL 时不在请求中下载：消息立即以 fetching 状态放入队列，后台按队列顺序（先发送的先下载）
+# 提前下载；发送任务取到图片还没下载的消息时立即开始下载，与模拟操作的等待时间重叠。
+# 下载失败的消息标记为 failed，轮到它时直接跳过。共享队列中的消息由领取它的实例在发送时下载
+
+class PhotoPrefetcher:
+    """后台下载图片 URL，最多 workers 个同时下载（发送任务等待的下载不受此限制）"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._heap: List[tuple] = []  # (队列排序键, 序号, 消息)
+        self._seq = 0
+        self._fetches: Dict[str, asyncio.Task] = {}  # 正在下载的消息，key: task_id
+        self._not_empty = asyncio.Event()
+        self.fetched = 0
+        self.failed = 0
+
+    def submit(self, task: MessageTask):
+        """登记需要下载图片的消息（消息已放入队列）"""
+        order = task.queue_order if task.queue_order is not None else float('inf')
+        heapq.heappush(self._heap, (order, self._seq, task))
+        self._seq += 1
+        self._not_empty.set()
+
+    def ensure_started(self, task: MessageTask) -> Optional[asyncio.Task]:
+        """发送任务取出消息时调用：图片需要下载时返回下载任务（尚未开始时立即开始），否则返回 None"""
+        if task.photo is not None or not task.photo_url or task.photo_error is not None:
+            return None
+        return self._fetches.get(task.task_id) or self._start(task)
+
+    def _start(self, task: MessageTask) -> asyncio.Task:
+        fetch = asyncio.ensure_future(self._fetch(task))
+        self._fetches[task.task_id] = fetch
+        fetch.add_done_callback(lambda _: self._fetches.pop(task.task_id, None))
+        return fetch
+
+    async def _fetch(self, task: MessageTask):
+        """下载并（启用时）预处理图片，结果保存在 task.photo，失败原因保存在 task.photo_error"""
+        spool = None
+        try:
+            with task.trace.span('download'):
+                spool = await download_photo(task.photo_url)
+            size = spool.size
+            if image_preprocess:
+                with task.trace.span('preprocess'):
+                    task.photo = await preprocess_photo(spool.read_all(), digest=spool.hexdigest())
+                size = len(task.photo)
+            else:
+                task.photo = spool.finish_photo()
+                spool = None
+            self.fetched += 1
+            logger.info(f"✓ 已下载消息 {task.task_id} 的图片（群组 {task.chat_id}），大小: {size} 字节")
+            task_status.set(task, 'queued', only_from='fetching', photo_size=size)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if isinstance(e, HTTPException):
+                task.photo_error = e.detail
+            elif isinstance(e, ValueError):
+                task.photo_error = f"图片无效: {str(e)}"
+            else:
+                task.photo_error = f"下载图片失败: {str(e) or type(e).__name__}"
+            self.failed += 1
+            logger.warning(f"✗ 消息 {task.task_id}（群组 {task.chat_id}）的图片下载失败: {task.photo_error}")
+            task_status.set(task, 'failed', error=task.photo_error)
+        finally:
+            if spool is not None:
+                spool.close()
+
+    async def _worker(self):
+        while True:
+            while not self._heap:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            _, _, task = heapq.heappop(self._heap)
+            # 发送任务已经开始下载（或已发送）的消息跳过
+            if task.task_id in self._fetches or task.photo is not None or task.photo_error is not None:
+                continue
+            try:
+                await self._start(task)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"图片预取出错: {str(e)}", exc_info=True)
+
+    async def run(self):
+        """启动 workers 个下载任务（取消时同时取消正在进行的下载）"""
+        try:
+            await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+        finally:
+            for fetch in list(self._fetches.values()):
+                fetch.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            "waiting": len(self._heap),
+            "active": len(self._fetches),
+            "fetched": self.fetched,
+            "failed": self.failed,
+        }
+
+# 图片预取（create_app() 中创建）
+photo_prefetcher: Optional[PhotoPrefetcher] = None
+
+# ========== 配置热重载部分 ==========
+# 需要重启才能生效的配置项（热重载时只记录警告）
+RESTART_REQUIRED_KEYS = (
+    'log_dir', 'http_port', 'use_uvloop', 'auto_mark_read', 'mark_read_mode', 'mark_read_fallback_browse', 'mark_read_rpc_rate',
+    'browse_state_file', 'config_watch_interval',
+    'routing_state_max_chats', 'consistent_hash_vnodes', 'supervisor_interval', 'supervisor_ping_timeout',
+    'image_preprocess', 'image_preprocess_workers', 'image_max_side', 'image_target_bytes', 'image_cache_size',
+    'max_upload_size', 'upload_spool_threshold', 'photo_prefetch_workers', 'task_status_max', 'event_buffer_size',
+    'sender_workers', 'chat_order_window',
+    'admin_token', 'loop_lag_monitor', 'loop_lag_threshold', 'trace_buffer_size', 'trace_export_file',
+    'ledger_dir', 'ledger_flush_interval',
+    'checkpoint_file', 'campaign_dir', 'campaign_window', 'shared_queue_file', 'instance_name', 'shared_queue_lease', 'shared_queue_poll_interval',
+)
+
+# 防止多次热重载同时进行（首次使用时创建，需要在事件循环中创建）
+config_reload_lock: Optional[asyncio.Lock] = None
+
+def _account_key(account: dict) -> tuple:
+    """账户的唯一标识（name 和 api_id 都相同才视为同一个账户）"""
+    return (account['name'], account['api_id'])
+
+def _config_mtime() -> Optional[float]:
+    """配置文件的修改时间，文件不存在时返回 None"""
+    try:
+        return os.path.getmtime(CONFIG_PATH)
+    except OSError:
+        return None
+
+async def retire_client(client: Client, account: dict):
+    """停止被移除的客户端：等待正在进行的发送完成后再断开连接"""
+    name = account['name']
+    while any(busy is client for busy in busy_clients.values()):
+        logger.info(f"[{name}] 账户已从配置中移除，等待当前发送完成后停止...")
+        await asyncio.sleep(1)
+    try:
+        if client.is_connected:
+            await client.stop()
+        logger.info(f"✓ [{name}] 账户已移除，Telegram 客户端已断开连接")
+    except Exception as e:
+        logger.warning(f"停止已移除的客户端 {name} 时出错: {str(e)}")
+    if not any(current['name'] == name for current in accounts):
+        account_health.pop(name, None)
+
+async def reload_config(reason: str) -> bool:
+    """重新加载 config.json 并在不重启、不暂停接收消息的情况下应用
+
+    - 节奏参数：整体替换 pacing 对象，发送任务从下一条消息开始使用新参数
+    - 分配策略、日志级别：立即生效
+    - 账户：启动新增的账户（需要已有 session 文件），移除的账户等当前发送完成后停止
+    配置无效时保留当前配置，返回 False
+    """
+    global config, accounts, clients, pacing, distribution_strategy, config_reload_lock
+    
+    if config_reload_lock is None:
+        config_reload_lock = asyncio.Lock()
+    
+    async with config_reload_lock:
+        logger.info(f"🔄 开始热重载配置（{reason}）...")
+        try:
+            new_config = read_config(CONFIG_PATH)
+        except ConfigError as e:
+            logger.error(f"✗ 配置热重载失败，继续使用当前配置: {str(e)}")
+            return False
+        
+        # 1. 节奏参数：构造新对象后整体替换
+        new_pacing = PacingConfig.from_config(new_config)
+        changes = pacing.diff(new_pacing)
+        pacing = new_pacing
+        for name, (old_value, new_value) in changes.items():
+            logger.info(f"   {name}: {old_value} -> {new_value}")
+        
+        # 2. 分配策略
+        new_strategy = get_distribution_strategy(new_config)
+        if new_strategy != distribution_strategy:
+            logger.info(f"   distribution_strategy: {distribution_strategy} -> {new_strategy}")
+            distribution_strategy = new_strategy
+            router.strategy = new_strategy
+        
+        # 3. 日志级别
+        new_log_level = new_config.get('log_level', 'INFO').upper()
+        if new_log_level != config.get('log_level', 'INFO').upper():
+            logging.getLogger().setLevel(getattr(logging, new_log_level, logging.INFO))
+            logger.info(f"   log_level: {config.get('log_level', 'INFO').upper()} -> {new_log_level}")
+        
+        # 4. 账户：保留未变化的客户端，启动新增的客户端
+        current = {_account_key(account): (client, account) for client, account in zip(clients, accounts)}
+        new_clients: List[Client] = []
+        new_accounts: List[dict] = []
+        for account in new_config['accounts']:
+            key = _account_key(account)
+            if key in current:
+                new_clients.append(current[key][0])
+                new_accounts.append(current[key][1])
+                continue
             
+            # 新增账户：热重载时无法交互式登录，必须已有 session 文件
+            session_file = os.path.join(workdir, f'session_{account["name"]}_{account["api_id"]}.session')
+            if not os.path.exists(session_file):
+                logger.error(f"✗ [{account['name']}] 新增账户没有 session 文件，请先手动运行一次完成登录，已跳过")
+                continue
+            client = create_client(account)
+            try:
+                await client.start()
+            except Exception as e:
+                logger.error(f"✗ [{account['name']}] 新增账户启动失败，已跳过: {str(e)}", exc_info=True)
+                continue
+            new_clients.append(client)
+            new_accounts.append(account)
+            logger.info(f"✓ [{account['name']}] 新增账户已启动")
+        
+        if not new_clients:
+            logger.error("✗ 新配置中没有可用的账户，保留当前账户列表")
+            new_clients, new_accounts = list(clients), list(accounts)
+        
+        new_keys = {_account_key(account) for account in new_accounts}
+        removed = [(client, account) for key, (client, account) in current.items() if key not in new_keys]
+        accounts_changed = [account['name'] for account in new_accounts] != [account['name'] for account in accounts]
+        
+        # 一次性替换客户端和账户列表（中间没有 await，发送任务不会看到不一致的状态）
+        clients = new_clients
+        accounts = new_accounts
+        if accounts_changed:
+            router.set_accounts([account['name'] for account in accounts])
+        for client, account in removed:
+            asyncio.create_task(retire_client(client, account))
+        
+        # 5. 租户：API Key、权重、速率限制和排队上限立即生效，统计数据保留
+        if new_config.get('tenants') != config.get('tenants'):
+            tenant_registry.load(new_config)
+            logger.info(f"   tenants: 已更新，当前共 {len(tenant_registry.by_key)} 个租户")
+        
+        # 6. 需要重启才能生效的配置项
+        for key in RESTART_REQUIRED_KEYS:
+            if new_config.get(key) != config.get(key):
+                logger.warning(f"   {key} 已修改，需要重启程序才能生效")
+        
+        config = new_config
+        logger.info(
+            f"✓ 配置热重载完成：{len(changes)} 个节奏参数变化，"
+            f"新增 {len([a for a in accounts if _account_key(a) not in current])} 个账户，移除 {len(removed)} 个账户，当前共 {len(clients)} 个账户"
+        )
+        return True
+
+def request_config_reload(reason: str):
+    """在事件循环中安排一次热重载（用于信号处理）"""
+    asyncio.ensure_future(reload_config(reason))
+
+async def config_watch_task():
+    """定期检查配置文件的修改时间，变化时自动热重载"""
+    last_mtime = _config_mtime()
+    while True:
+        try:
+            await asyncio.sleep(config_watch_interval)
+            mtime = _config_mtime()
+            if mtime is not None and mtime != last_mtime:
+                last_mtime = mtime
+                await reload_config("检测到配置文件修改")
         except asyncio.CancelledError:
-            logger.info("消息发送任务已取消")
             break
         except Exception as e:
-            logger.error(f"消息发送任务发生错误: {str(e)}", exc_info=True)
-            await asyncio.sleep(1)  # 出错后等待1秒再继续
+            logger.error(f"检查配置文件修改时出错: {str(e)}", exc_info=True)
 
-# 已移除消息监听功能，现在只通过 HTTP API 发送消息
+# ========== 连接监控部分 ==========
+# 后台定期 Ping 每个账户：连续失败时标记为不可用（分配策略跳过），连接断开时按指数退避重新连接；
+# 发送时遇到连接异常会把 next_check 设为0，让连接监控立即检查该账户
 
-# 启动消息发送任务的辅助函数
-async def start_sender():
-    """启动消息发送任务"""
-    await message_sender()
+async def check_client(client: Client, name: str):
+    """检查一个账户的连接，必要时重新连接"""
+    health = account_health[name]
+    now = time.monotonic()
+    if client.is_connected and health.failures < SUPERVISOR_FAILURE_THRESHOLD:
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(client.invoke(raw.functions.Ping(ping_id=random.getrandbits(63))), supervisor_ping_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            health.failures += 1
+            health.last_error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+            logger.warning(f"[{name}] 连接检查失败（连续 {health.failures} 次）: {health.last_error}")
+            if health.failures >= SUPERVISOR_FAILURE_THRESHOLD and health.alive:
+                health.alive = False
+                logger.error(f"✗ [{name}] 连接不可用，暂停向该账户分配消息")
+                event_bus.publish('client_down', account=name, error=health.last_error)
+            health.next_check = time.monotonic() + SUPERVISOR_MIN_BACKOFF
+            return
+        health.record_latency(time.perf_counter() - started)
+        health.failures = 0
+        if not health.alive:
+            health.alive = True
+            logger.info(f"✓ [{name}] 连接检查恢复正常，重新参与消息分配")
+        health.next_check = time.monotonic() + supervisor_interval
+        return
+    
+    # 连接已断开或连续检查失败：重新连接（正在发送时等发送结束，避免中断请求）
+    if health.alive:
+        health.alive = False
+        event_bus.publish('client_down', account=name, error=health.last_error or '连接已断开')
+    if any(busy is client for busy in busy_clients.values()):
+        health.next_check = now + 1
+        return
+    logger.warning(f"[{name}] 正在重新连接 Telegram...")
+    try:
+        if client.is_connected:
+            try:
+                await asyncio.wait_for(client.stop(), SUPERVISOR_CONNECT_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug(f"[{name}] 断开旧连接时出错: {str(e)}")
+        await asyncio.wait_for(client.start(), SUPERVISOR_CONNECT_TIMEOUT)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        health.backoff = min(SUPERVISOR_MAX_BACKOFF, max(SUPERVISOR_MIN_BACKOFF, health.backoff * 2))
+        health.next_check = time.monotonic() + health.backoff
+        health.last_error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        logger.error(f"✗ [{name}] 重新连接失败: {health.last_error}，{health.backoff:.0f} 秒后重试")
+        event_bus.publish('client_reconnect_failed', account=name, error=health.last_error, retry_in=health.backoff)
+        return
+    if not any(current is client for current in clients):
+        # 重新连接期间账户已通过热重载移除
+        await client.stop()
+        return
+    health.alive = True
+    health.failures = 0
+    health.backoff = 0.0
+    health.reconnects += 1
+    health.next_check = time.monotonic() + supervisor_interval
+    logger.info(f"✓ [{name}] 已重新连接 Telegram（累计重连 {health.reconnects} 次）")
+    event_bus.publish('client_reconnected', account=name, reconnects=health.reconnects)
+
+async def client_supervisor():
+    """连接监控任务：每秒检查一次哪些账户到了检查时间，并发检查这些账户"""
+    while True:
+        try:
+            now = time.monotonic()
+            due = [
+                check_client(client, account['name'])
+                for client, account in list(zip(clients, accounts))
+                if now >= account_health[account['name']].next_check
+            ]
+            if due:
+                await asyncio.gather(*due)
+            await asyncio.sleep(1)
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            logger.error(f"连接监控出错: {str(e)}", exc_info=True)
+            await asyncio.sleep(supervisor_interval)
+
+# ========== 停止与恢复部分 ==========
+# 停止程序时：停止接收新消息（返回 503）→ 等待正在进行的接收请求和发送请求完成 → 剩余消息和分配状态写入检查点文件；
+# 下次启动时从检查点文件恢复队列，重启过程中不丢失消息
+
+# 是否接收新消息（停止程序时设为 False）
+accepting_messages = True
+# 正在处理的发送接口请求数
+ingest_in_flight = 0
+
+def begin_ingest():
+    """发送接口开始处理请求：停止中返回 503，否则计入正在处理的请求数（处理完成后必须调用 end_ingest）"""
+    global ingest_in_flight
+    if not accepting_messages:
+        raise HTTPException(status_code=503, detail="服务正在停止，暂不接收新消息，请稍后重试", headers={"Retry-After": "5"})
+    ingest_in_flight += 1
+
+def end_ingest():
+    global ingest_in_flight
+    ingest_in_flight -= 1
+
+def save_checkpoint() -> int:
+    """把队列中剩余的消息和分配状态写入检查点文件（先写临时文件再替换），返回保存的消息数"""
+    tasks = message_queue.items()
+    data = {
+        "version": 1,
+        "saved_at": datetime.now().isoformat(timespec='seconds'),
+        "messages": [task.to_checkpoint() for task in tasks],
+        "router": router.export_state(),
+    }
+    tmp_path = f"{checkpoint_file}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(json_dumps(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_file)
+    # 已保存的消息从队列中移除，避免重复保存
+    while not message_queue.empty():
+        task = message_queue.get_nowait()
+        task.close()
+        message_queue.task_done(task)
+    return len(tasks)
+
+def restore_checkpoint() -> int:
+    """启动时从检查点文件恢复队列和分配状态，恢复后删除文件，返回恢复的消息数
+
+    文件无法读取时重命名为 .bad 保留（不会重复尝试），不影响启动
+    """
+    if not os.path.exists(checkpoint_file):
+        return 0
+    try:
+        with open(checkpoint_file, 'rb') as f:
+            data = json_loads(f.read())
+        tasks = [MessageTask.from_checkpoint(item) for item in data.get("messages", [])]
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        bad_path = f"{checkpoint_file}.bad"
+        os.replace(checkpoint_file, bad_path)
+        logger.error(f"✗ 检查点文件无法读取，已重命名为 {bad_path}: {str(e)}")
+        return 0
+    
+    router_state = data.get("router") or {}
+    if router_state.get("strategy") == router.strategy:
+        router.import_state(router_state)
+    for task in tasks:
+        task_status.set(task, 'fetching' if task.photo_url and task.photo is None else 'queued')
+        message_queue.put_nowait(task)
+        if task.trace.enqueued_at is None:
+            task.trace.enqueued_at = time.perf_counter()
+        if task.photo_url and task.photo is None and not isinstance(message_queue, SharedQueue):
+            photo_prefetcher.submit(task)
+        tenant_registry.get(task.tenant).enqueued += 1
+    os.remove(checkpoint_file)
+    logger.info(f"✓ 已从检查点文件恢复 {len(tasks)} 条消息（保存于 {data.get('saved_at')}）")
+    return len(tasks)
+
+async def drain_and_checkpoint(sender_task: asyncio.Task):
+    """停止接收新消息，在 shutdown_drain_timeout 秒内等待正在进行的请求完成，然后保存检查点"""
+    global accepting_messages, sender_stopping
+    accepting_messages = False
+    # 先停止派发：发送任务不再开始新消息，下面只等待已经开始的发送请求
+    sender_stopping = True
+    await campaign_registry.stop()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + shutdown_drain_timeout
+    logger.info(f"已停止接收新消息，等待正在进行的请求完成（最多 {shutdown_drain_timeout} 秒）...")
+    
+    # 1. 等待正在处理的发送接口请求把消息放入队列
+    while ingest_in_flight > 0 and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    
+    # 2. 等待已经开始的发送请求完成（不会有新的发送开始）；还在模拟延迟的消息直接放回队列
+    while 'sending' in sender_phases.values() and not sender_task.done() and loop.time() < deadline:
+        await asyncio.sleep(0.05)
+    sender_task.cancel()
+    try:
+        await sender_task
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        logger.warning(f"取消发送任务时出错: {str(e)}")
+    
+    # 3. 保存剩余消息（共享队列的消息本来就保存在数据库中，被中断的消息已释放租约）
+    if isinstance(message_queue, SharedQueue):
+        logger.info("使用共享队列，剩余消息由其他实例或下次启动后继续发送")
+        return
+    if message_queue.empty():
+        logger.info("队列已清空，无需保存检查点")
+        return
+    try:
+        count = save_checkpoint()
+        logger.info(f"✓ 队列中剩余的 {count} 条消息已保存到检查点文件 {checkpoint_file}，下次启动时继续发送")
+    except Exception as e:
+        logger.error(f"✗ 保存检查点失败，队列中的 {message_queue.qsize()} 条消息将丢失: {str(e)}", exc_info=True)
+
+# ========== 诊断部分 ==========
+# CPU 采样、内存分配快照、事件循环延迟和队列内存统计，只在调用诊断接口（或启用 loop_lag_monitor）时运行
+
+def _format_frame(code) -> str:
+    """函数的显示名称：函数名 (文件名:首行号)"""
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def _thread_stack(thread_id: int, limit: int = 64) -> List[str]:
+    """获取指定线程当前的调用栈（从外到内，显示当前执行的行号）"""
+    frame = sys._current_frames().get(thread_id)
+    stack = []
+    while frame is not None and len(stack) < limit:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+class StackSampler(threading.Thread):
+    """采样式 CPU 分析：后台线程每隔 interval 秒记录一次事件循环线程的调用栈
+
+    不需要修改被分析的代码，开销只与采样频率有关；结果中 selectors 的 select/poll
+    占比表示事件循环空闲的时间
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = 0
+        self.stacks: Dict[tuple, int] = defaultdict(int)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_format_frame(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[tuple(stack)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def report(self, limit: int) -> dict:
+        """按函数统计采样结果：self 为位于栈顶的次数，total 为出现在栈中的次数"""
+        self_counts: Dict[str, int] = defaultdict(int)
+        total_counts: Dict[str, int] = defaultdict(int)
+        for stack, count in self.stacks.items():
+            if stack:
+                self_counts[stack[-1]] += count
+            for name in set(stack):
+                total_counts[name] += count
+        samples = max(self.samples, 1)
+
+        def top(counts):
+            items = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+            return [{"function": name, "samples": count, "percent": round(count * 100 / samples, 2)} for name, count in items]
+
+        return {"samples": self.samples, "top_self": top(self_counts), "top_total": top(total_counts)}
+
+    def collapsed(self) -> str:
+        """折叠栈格式（每行: 栈;栈;栈 次数），可直接用 flamegraph.pl 或 speedscope 生成火焰图"""
+        return "\n".join(f"{';'.join(stack)} {count}" for stack, count in self.stacks.items()) + "\n"
+
+# 同一时间只允许一个 CPU 采样
+profile_lock = asyncio.Lock()
+
+# tracemalloc 上一次的快照，用于计算两次快照之间的差异
+tracemalloc_baseline: Optional[tracemalloc.Snapshot] = None
+
+def _take_tracemalloc_snapshot(limit: int) -> dict:
+    """获取内存分配快照，返回分配最多的代码行和与上一次快照的差异（在线程中运行）"""
+    global tracemalloc_baseline
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<unknown>"),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+    result = {
+        "traced_bytes": current,
+        "peak_bytes": peak,
+        "top": [
+            {"location": str(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in snapshot.statistics('lineno')[:limit]
+        ],
+    }
+    if tracemalloc_baseline is not None:
+        result["diff"] = [
+            {"location": str(stat.traceback), "size_diff": stat.size_diff, "size": stat.size, "count_diff": stat.count_diff}
+            for stat in snapshot.compare_to(tracemalloc_baseline, 'lineno')[:limit]
+        ]
+    tracemalloc_baseline = snapshot
+    return result
+
+class LoopLagMonitor:
+    """事件循环延迟监控
+
+    协程每隔 interval 秒睡眠一次，实际唤醒时间与预期的差值即事件循环延迟；
+    同时由后台线程检查心跳，事件循环被阻塞超过 threshold 秒时记录事件循环线程当时的调用栈，
+    用于定位阻塞事件循环的同步调用（如同步日志、大文件读写）
+    """
+
+    def __init__(self, interval: float, threshold: float, history: int = 600):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags: "deque[float]" = deque(maxlen=history)
+        self.slow_callbacks: "deque[dict]" = deque(maxlen=50)
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.count = 0
+        self._heartbeat = time.monotonic()
+        self._thread_id: Optional[int] = None
+        self._stop_event = threading.Event()
+
+    def _watchdog(self):
+        """后台线程：心跳超时说明事件循环正被某个调用阻塞，记录一次调用栈"""
+        captured = None
+        while not self._stop_event.wait(self.threshold / 2):
+            heartbeat = self._heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked > self.threshold and captured != heartbeat:
+                captured = heartbeat
+                self.slow_callbacks.append({
+                    "time": datetime.now().isoformat(timespec='seconds'),
+                    "blocked_seconds": round(blocked, 3),
+                    "stack": _thread_stack(self._thread_id),
+                })
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._stop_event.clear()
+        watchdog = threading.Thread(target=self._watchdog, name="loop-watchdog", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                self._heartbeat = time.monotonic()
+                start = loop.time()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, loop.time() - start - self.interval)
+                self.lags.append(lag)
+                self.count += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+        finally:
+            self._stop_event.set()
+
+    def get_stats(self) -> dict:
+        recent = sorted(self.lags)
+        return {
+            "samples": self.count,
+            "avg_lag_ms": round(self.total_lag / self.count * 1000, 3) if self.count else 0.0,
+            "max_lag_ms": round(self.max_lag * 1000, 3),
+            "recent_p50_ms": round(recent[len(recent) // 2] * 1000, 3) if recent else 0.0,
+            "recent_p99_ms": round(recent[min(len(recent) - 1, int(len(recent) * 0.99))] * 1000, 3) if recent else 0.0,
+            "threshold_ms": self.threshold * 1000,
+            "slow_callbacks": list(self.slow_callbacks),
+        }
+
+# 事件循环延迟监控（启用 loop_lag_monitor 时在 create_app() 中创建，在 main() 中启动）
+loop_monitor: Optional[LoopLagMonitor] = None
+
+def _payload_size(photo) -> tuple:
+    """返回 (图片类型, 字节数)"""
+    if isinstance(photo, bytes):
+        return "photo_bytes", len(photo)
+    if isinstance(photo, io.BytesIO):
+        return "photo_memory", photo.getbuffer().nbytes
+    if isinstance(photo, SpooledPhoto):
+        return "photo_disk", photo.size
+    try:
+        return "photo_disk", os.fstat(photo.fileno()).st_size
+    except (OSError, ValueError, AttributeError):
+        return "photo_other", 0
+
+def get_queue_memory() -> dict:
+    """按消息内容类型统计队列中待发送消息占用的内存（temp 文件中的图片单独统计，不占内存）"""
+    stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"count": 0, "bytes": 0})
+    for task in message_queue.items():
+        if task.photo is not None:
+            kind, size = _payload_size(task.photo)
+            stats[kind]["count"] += 1
+            stats[kind]["bytes"] += size
+        if task.text:
+            stats["text"]["count"] += 1
+            stats["text"]["bytes"] += len(task.text.encode('utf-8'))
+    return dict(stats)
+
+def get_process_memory() -> dict:
+    """进程内存占用（Linux 读取 /proc/self/status，其他平台使用 resource 模块的峰值）"""
+    result = {}
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    result['rss_bytes' if key == 'VmRSS' else 'peak_rss_bytes'] = int(value.split()[0]) * 1024
+    except OSError:
+        try:
+            import resource
+            # macOS 单位为字节，Linux 为 KB
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            result['peak_rss_bytes'] = peak if sys.platform == 'darwin' else peak * 1024
+        except ImportError:
+            pass
+    return result
 
 # ========== HTTP API 部分 ==========
-# 创建 FastAPI 应用
-app = FastAPI(title="Telegram Client User Bot API", version="1.0.0")
+class FastJSONResponse(JSONResponse):
+    """JSON 响应：安装了 orjson 时使用 orjson 序列化，否则使用标准库 json"""
 
-@app.get("/")
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        return super().render(content)
+
+# FastAPI 应用（create_app() 中创建）
+app = None
+
+# 路由表：导入模块时只登记处理函数，创建应用时再注册到 FastAPI（build_app）
+routes: List[tuple] = []
+
+def route(method: str, path: str):
+    """登记 HTTP API 处理函数"""
+    def decorator(func):
+        routes.append((method, path, func))
+        return func
+    return decorator
+
+def build_app():
+    """创建 FastAPI 应用并注册路由表中的所有处理函数"""
+    from fastapi import FastAPI
+    new_app = FastAPI(title="Telegram Client User Bot API", version="1.0.0", default_response_class=FastJSONResponse)
+    for method, path, func in routes:
+        new_app.add_api_route(path, func, methods=[method])
+    return new_app
+
+def normalize_chat_id(chat_id: Union[int, str]) -> Union[int, str]:
+    """处理 chat_id：支持整数、数字字符串、@username 和不带 @ 的用户名"""
+    if isinstance(chat_id, str):
+        # 如果是 @username 格式，保持原样
+        if chat_id.startswith('@'):
+            return chat_id
+        # 尝试转换为整数
+        try:
+            return int(chat_id)
+        except ValueError:
+            # 如果无法转换，添加 @ 前缀（可能是用户名，不带@）
+            return f"@{chat_id}"
+    return chat_id
+
+@route("GET", "/")
 async def root():
     """API 根路径"""
     return {
@@ -855,27 +4987,253 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "send": "/api/send",
+            "send_json": "/api/send_json",
+            "tasks": "/api/tasks/{task_id}",
+            "campaigns": "/api/campaigns",
+            "events": "/api/events",
             "health": "/api/health"
         }
     }
 
-@app.get("/api/health")
+@route("GET", "/api/health")
 async def health():
     """健康检查"""
     connected_clients = sum(1 for client in clients if client.is_connected)
-    return {
+    result = {
         "status": "ok",
         "connected_clients": connected_clients,
         "total_clients": len(clients),
-        "queue_size": message_queue.qsize()
+        "queue_size": message_queue.qsize(),
+        "accepting": accepting_messages
+    }
+    result["routing"] = router.get_stats()
+    result["accounts"] = {
+        account['name']: {"connected": client.is_connected, **account_health[account['name']].get_stats()}
+        for client, account in zip(clients, accounts)
+    }
+    result["events"] = event_bus.get_stats()
+    result["tenants"] = tenant_registry.get_stats()
+    result["campaigns"] = campaign_registry.get_summary()
+    result["photo_prefetch"] = photo_prefetcher.get_stats()
+    result["ordering"] = {"sender_workers": sender_workers, **message_queue.get_order_stats()}
+    if auto_mark_read:
+        result["mark_read"] = mark_read_rpc_budget.get_stats()
+    if send_ledger.enabled:
+        result["ledger"] = send_ledger.get_stats()
+    result["startup_ms"] = startup_timings
+    if isinstance(message_queue, SharedQueue):
+        result["shared_queue"] = message_queue.get_stats()
+    if image_preprocess:
+        result["image_preprocess"] = get_image_metrics()
+    return result
+
+def check_admin(request: Request):
+    """验证诊断接口的访问令牌，未配置 admin_token 时诊断接口不可用（404）"""
+    if not admin_token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get('x-admin-token')
+    if token is None:
+        authorization = request.headers.get('authorization', '')
+        if authorization.lower().startswith('bearer '):
+            token = authorization[7:].strip()
+    if not token or not hmac.compare_digest(token.encode('utf-8'), admin_token.encode('utf-8')):
+        raise HTTPException(status_code=401, detail="需要有效的管理令牌（X-Admin-Token 或 Authorization: Bearer）")
+
+@route("GET", "/api/admin/profile")
+async def admin_profile(request: Request, seconds: float = 5.0, interval: float = 0.005, limit: int = 30, format: str = "json"):
+    """CPU 采样分析：在接下来的 seconds 秒内每隔 interval 秒采样一次事件循环线程的调用栈
+    
+    format=collapsed 时返回折叠栈文本，可用于生成火焰图
+    """
+    check_admin(request)
+    if not 0 < seconds <= 60:
+        raise HTTPException(status_code=400, detail="seconds 必须在 0-60 之间")
+    if not 0.001 <= interval <= 1:
+        raise HTTPException(status_code=400, detail="interval 必须在 0.001-1 之间")
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="正在进行另一个 CPU 采样，请稍后再试")
+    async with profile_lock:
+        sampler = StackSampler(threading.get_ident(), interval)
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            await asyncio.to_thread(sampler.stop)
+    logger.info(f"CPU 采样完成：{seconds} 秒，{sampler.samples} 个样本")
+    if format == "collapsed":
+        return PlainTextResponse(sampler.collapsed())
+    result = sampler.report(limit)
+    result["seconds"] = seconds
+    result["interval"] = interval
+    return result
+
+@route("GET", "/api/admin/tracemalloc")
+async def admin_tracemalloc(request: Request, limit: int = 25, frames: int = 1):
+    """内存分配快照：第一次调用开始跟踪，之后每次调用返回分配最多的代码行以及与上一次快照的差异"""
+    check_admin(request)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, min(frames, 50)))
+        logger.info("tracemalloc 已开始跟踪内存分配")
+        return {"status": "started", "message": "已开始跟踪内存分配，再次调用获取快照"}
+    return await asyncio.to_thread(_take_tracemalloc_snapshot, max(1, limit))
+
+@route("DELETE", "/api/admin/tracemalloc")
+async def admin_tracemalloc_stop(request: Request):
+    """停止跟踪内存分配，释放跟踪数据"""
+    global tracemalloc_baseline
+    check_admin(request)
+    tracemalloc.stop()
+    tracemalloc_baseline = None
+    logger.info("tracemalloc 已停止跟踪内存分配")
+    return {"status": "stopped"}
+
+@route("GET", "/api/admin/loop")
+async def admin_loop(request: Request):
+    """事件循环延迟和阻塞事件循环的调用栈（需要启用 loop_lag_monitor）"""
+    check_admin(request)
+    if loop_monitor is None:
+        raise HTTPException(status_code=400, detail="未启用 loop_lag_monitor")
+    return loop_monitor.get_stats()
+
+@route("GET", "/api/admin/memory")
+async def admin_memory(request: Request):
+    """进程内存、队列中各类消息内容占用的内存，以及各内部数据结构的大小"""
+    check_admin(request)
+    return {
+        "process": get_process_memory(),
+        "queue": {"size": message_queue.qsize(), "payload": get_queue_memory()},
+        "routing": router.get_stats(),
+        "image_cache": {"entries": len(image_cache), "bytes": sum(len(data) for data in image_cache.values())},
+        "events": event_bus.get_stats(),
+        "mark_read_state": {name: len(state) for name, state in chat_read_state.items()},
+        "mark_read_peers": {name: len(peers) for name, peers in chat_input_peers.items()},
+        "asyncio_tasks": len(asyncio.all_tasks()),
+        "gc": {"counts": gc.get_count(), "objects": len(gc.get_objects())},
+        "tracemalloc": tracemalloc.is_tracing(),
+    }
+
+@route("GET", "/api/admin/traces")
+async def admin_traces(request: Request, limit: int = 20, order: str = "slowest"):
+    """最近完成的消息的各阶段耗时
+    
+    参数说明:
+    - limit: 返回的记录数，默认20
+    - order: slowest（按总耗时从长到短，默认）或 recent（按完成时间从新到旧）
+    """
+    check_admin(request)
+    if order not in ('slowest', 'recent'):
+        raise HTTPException(status_code=400, detail="order 必须是 slowest 或 recent")
+    return {
+        "buffered": len(trace_recorder.traces),
+        "stages": trace_recorder.stage_summary(),
+        "traces": trace_recorder.query(max(1, limit), order),
+    }
+
+def parse_ledger_day(value: str, name: str) -> str:
+    """解析日期参数（YYYY-MM-DD 或 YYYYMMDD），返回 YYYYMMDD"""
+    try:
+        return datetime.strptime(value.replace('-', ''), '%Y%m%d').strftime('%Y%m%d')
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} 必须是日期（YYYY-MM-DD）")
+
+@route("GET", "/api/admin/ledger")
+async def admin_ledger(request: Request, days: int = 7, since: Optional[str] = None, until: Optional[str] = None,
+                       account: Optional[str] = None, chat_id: Optional[str] = None, group_by: str = "account"):
+    """发送记录统计：各结果（sent / failed / flood_wait / rerouted）的次数、限流等待时间和成功发送的平均耗时
+    
+    参数说明:
+    - days: 统计最近几天（含今天），默认7；也可以用 since / until（YYYY-MM-DD）指定日期范围
+    - account / chat_id: 只统计指定的账户 / 群组
+    - group_by: 分组方式，account（默认）、chat、day 或 outcome
+    """
+    check_admin(request)
+    if not send_ledger.enabled:
+        raise HTTPException(status_code=404, detail="发送记录未启用（ledger_dir 为空）")
+    if group_by not in LEDGER_GROUPS:
+        raise HTTPException(status_code=400, detail=f"group_by 必须是 {' / '.join(LEDGER_GROUPS)} 之一")
+    until_day = parse_ledger_day(until, 'until') if until else datetime.now().strftime('%Y%m%d')
+    if since:
+        since_day = parse_ledger_day(since, 'since')
+    else:
+        since_day = (datetime.strptime(until_day, '%Y%m%d') - timedelta(days=max(1, days) - 1)).strftime('%Y%m%d')
+    started = time.perf_counter()
+    groups = send_ledger.stats(since_day, until_day, account, normalize_chat_id(chat_id) if chat_id else None, group_by)
+    return {
+        "since": f"{since_day[:4]}-{since_day[4:6]}-{since_day[6:]}",
+        "until": f"{until_day[:4]}-{until_day[4:6]}-{until_day[6:]}",
+        "group_by": group_by,
+        "groups": groups,
+        "query_ms": round((time.perf_counter() - started) * 1000, 3),
     }
 
-@app.post("/api/send")
-async def send(
-    request: Request,
-    chat_id: Union[int, str] = Form(...),
-    text: Optional[str] = Form(None)
-):
+@route("GET", "/api/admin/ledger/records")
+async def admin_ledger_records(request: Request, date: Optional[str] = None, account: Optional[str] = None,
+                               chat_id: Optional[str] = None, outcome: Optional[str] = None, limit: int = 100):
+    """某一天的发送记录明细（从新到旧）
+    
+    参数说明:
+    - date: 日期（YYYY-MM-DD），默认今天
+    - account / chat_id / outcome: 只返回指定的账户 / 群组 / 结果的记录
+    - limit: 最多返回的记录数，默认100
+    """
+    check_admin(request)
+    if not send_ledger.enabled:
+        raise HTTPException(status_code=404, detail="发送记录未启用（ledger_dir 为空）")
+    if outcome is not None and outcome not in LEDGER_OUTCOMES:
+        raise HTTPException(status_code=400, detail=f"outcome 必须是 {' / '.join(LEDGER_OUTCOMES)} 之一")
+    day = parse_ledger_day(date, 'date') if date else datetime.now().strftime('%Y%m%d')
+    records = await send_ledger.records(day, account, normalize_chat_id(chat_id) if chat_id else None, outcome, max(1, limit))
+    return {"date": f"{day[:4]}-{day[4:6]}-{day[6:]}", "records": records}
+
+@route("GET", "/api/events")
+async def events(request: Request, since: Optional[int] = None, types: Optional[str] = None):
+    """实时事件流（Server-Sent Events）
+    
+    参数说明:
+    - since: 从指定事件ID开始读取（可选，默认只推送新事件）；断线重连时浏览器会自动带上 Last-Event-ID 请求头
+    - types: 只推送指定类型的事件，逗号分隔（可选），如 sent,failed
+    
+    事件类型: enqueued, dispatched, sent, failed, flood_wait_start, flood_wait_end,
+    mark_read_started, mark_read_progress, mark_read_finished；落后太多时收到 dropped 事件
+    
+    认证: 使用管理令牌时推送所有事件；否则与发送接口相同使用 API Key，配置了租户时只推送本租户的消息和群发任务的事件
+    """
+    try:
+        check_admin(request)
+        tenant_filter = None
+    except HTTPException:
+        tenant = tenant_registry.authenticate(request)
+        tenant_filter = tenant.name if tenant_registry.enabled else None
+    last_event_id = request.headers.get('last-event-id')
+    if last_event_id and last_event_id.isdigit():
+        offset = int(last_event_id) + 1
+    elif since is not None:
+        offset = since
+    else:
+        offset = event_bus.next_id
+    type_filter = {item.strip() for item in types.split(',') if item.strip()} if types else None
+    return StreamingResponse(
+        event_bus.stream(offset, type_filter, tenant_filter),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # 禁用 Nginx 缓冲，事件立即推送
+        },
+    )
+
+def parse_ordered(value: Optional[str]) -> bool:
+    """表单字段 ordered：未提供时为 True，true/1/false/0（不区分大小写）之外的值返回 400"""
+    if value is None or value == '':
+        return True
+    normalized = value.strip().lower()
+    if normalized in ('true', '1'):
+        return True
+    if normalized in ('false', '0'):
+        return False
+    raise HTTPException(status_code=400, detail="ordered 必须是 true 或 false")
+
+@route("POST", "/api/send")
+async def send(request: Request):
     """发送消息（支持文本和图片，可以同时发送）
     
     参数说明:
@@ -884,131 +5242,138 @@ async def send(
     - photo: 图片文件或图片 URL（字符串），可选
        - 如果传入文件：使用 multipart/form-data 文件上传，参数名为 photo
        - 如果传入 URL：使用 multipart/form-data 文本字段，参数名为 photo，值为 URL 字符串
-       API 会自动判断是文件还是 URL
+       API 会自动判断是文件还是 URL；URL 图片不在请求中下载，消息以 fetching 状态放入队列，由后台预取下载
+    - ordered: 是否与同一群组的其他消息按入队顺序发送（可选，默认 true）；false/0 表示不等待前面的消息，
+       并发发送时吞吐量更高，但可能比先入队的消息先到达
+    
+    请求体以流式方式解析：图片边接收边计算哈希并写入内存或临时文件，超过 max_upload_size 时立即返回 413
+    返回的 task_id 可用于 GET /api/tasks/{task_id} 查询发送状态
     """
+    photo_spool = None
+    trace = Trace('/api/send')
+    begin_ingest()
     try:
-        # 从请求中获取 photo 字段（可能是文件或字符串）
-        form = await request.form()
-        photo = form.get("photo")
+        # 认证和准入检查在解析请求体之前进行，被拒绝的请求不会占用上传带宽
+        tenant = tenant_registry.authenticate(request)
+        tenant_registry.admit(tenant)
+        # 流式解析请求体（不会一次性把整个请求体读入内存）
+        with trace.span('parse'):
+            form = await parse_send_form(request)
+        photo_spool = form.photo
+        chat_id = form.fields.get("chat_id")
+        text = form.fields.get("text")
+        photo_url_value = form.fields.get("photo") if photo_spool is None else None
+        ordered = parse_ordered(form.fields.get("ordered"))
+        
+        if not chat_id:
+            raise HTTPException(status_code=422, detail="缺少必需参数 chat_id")
         
         # 验证至少提供一种内容
-        if not text and not photo:
+        if not text and not photo_spool and not photo_url_value:
             raise HTTPException(status_code=400, detail="必须提供 text 或 photo 至少一种内容")
         
         # 处理 chat_id：支持整数或字符串格式
-        processed_chat_id = chat_id
-        if isinstance(chat_id, str):
-            # 如果是 @username 格式，保持原样
-            if chat_id.startswith('@'):
-                processed_chat_id = chat_id
-            else:
-                # 尝试转换为整数
-                try:
-                    processed_chat_id = int(chat_id)
-                except ValueError:
-                    # 如果无法转换，添加 @ 前缀（可能是用户名，不带@）
-                    processed_chat_id = f"@{chat_id}"
-        elif isinstance(chat_id, int):
-            processed_chat_id = chat_id
+        processed_chat_id = normalize_chat_id(chat_id)
         
         photo_data = None
+        photo_size = 0
         photo_source = None
         photo_filename = None
-        photo_url_value = None
         
-        if photo:
-            # 判断 photo 是文件上传还是 URL 字符串
-            # 检查是否有 filename 和 read 方法（文件上传的特征）
-            if hasattr(photo, 'filename') and hasattr(photo, 'read'):
-                # 文件上传方式
-                try:
-                    photo_data = await photo.read()
-                    photo_source = "文件上传"
-                    photo_filename = getattr(photo, 'filename', 'image.jpg')
-                    
-                    if not photo_data:
-                        raise HTTPException(status_code=400, detail="图片文件为空")
-                    
-                    # 验证是否为图片格式（简单检查）
-                    content_type = getattr(photo, 'content_type', '')
-                    if content_type and not content_type.startswith('image/'):
-                        logger.warning(f"上传的文件可能不是图片: {content_type}")
-                except Exception as e:
-                    logger.error(f"读取上传文件时出错: {str(e)}", exc_info=True)
-                    raise HTTPException(status_code=400, detail=f"读取上传文件失败: {str(e)}")
-            elif isinstance(photo, str):
-                # URL 字符串方式
-                photo_url_value = photo
-                photo_source = "URL"
-                
-                # 验证 URL 格式
-                if not (photo_url_value.startswith('http://') or photo_url_value.startswith('https://')):
-                    raise HTTPException(status_code=400, detail="photo URL 必须以 http:// 或 https:// 开头")
-                
-                # 从 URL 下载图片
+        if photo_spool is not None:
+            # 文件上传方式（已在解析请求体时写入 photo_spool）
+            photo_source = "文件上传"
+            photo_filename = photo_spool.filename or 'image.jpg'
+            
+            if photo_spool.size == 0:
+                raise HTTPException(status_code=400, detail="图片文件为空")
+            
+            # 验证是否为图片格式（简单检查）
+            content_type = photo_spool.content_type or ''
+            if content_type and not content_type.startswith('image/'):
+                logger.warning(f"上传的文件可能不是图片: {content_type}")
+        elif photo_url_value:
+            # URL 字符串方式
+            photo_source = "URL"
+            
+            # 验证 URL 格式（图片由后台预取下载，请求不等待图片服务器）
+            if not (photo_url_value.startswith('http://') or photo_url_value.startswith('https://')):
+                raise HTTPException(status_code=400, detail="photo URL 必须以 http:// 或 https:// 开头")
+            
+            # 从 URL 提取文件名
+            parsed_url = urlparse(photo_url_value)
+            photo_filename = os.path.basename(parsed_url.path) or 'image.jpg'
+        
+        if photo_spool is not None:
+            photo_digest = photo_spool.hexdigest()
+            if image_preprocess:
+                # 图片预处理（校验真实格式、缩放、重新编码），需要完整数据
                 try:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(photo_url_value, timeout=aiohttp.ClientTimeout(total=30)) as response:
-                            if response.status != 200:
-                                raise HTTPException(status_code=400, detail=f"下载图片失败，HTTP 状态码: {response.status}")
-                            
-                            photo_data = await response.read()
-                            if not photo_data:
-                                raise HTTPException(status_code=400, detail="从 URL 下载的图片为空")
-                            
-                            # 验证内容类型
-                            content_type = response.headers.get('Content-Type', '')
-                            if content_type and not content_type.startswith('image/'):
-                                logger.warning(f"从 URL 下载的文件可能不是图片: {content_type}")
-                            
-                            # 从 URL 提取文件名
-                            parsed_url = urlparse(photo_url_value)
-                            photo_filename = os.path.basename(parsed_url.path) or 'image.jpg'
-                            
-                            logger.info(f"✓ 成功从 URL 下载图片，大小: {len(photo_data)} 字节")
-                except aiohttp.ClientError as e:
-                    raise HTTPException(status_code=400, detail=f"下载图片失败: {str(e)}")
-                except Exception as e:
-                    raise HTTPException(status_code=400, detail=f"处理图片 URL 时出错: {str(e)}")
+                    with trace.span('preprocess'):
+                        photo_data = await preprocess_photo(photo_spool.read_all(), digest=photo_digest)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"图片无效: {str(e)}")
+                finally:
+                    photo_spool.close()
+                photo_size = len(photo_data)
             else:
-                # 添加调试信息
-                logger.error(f"photo 类型错误: type={type(photo)}, value={photo}")
-                raise HTTPException(status_code=400, detail=f"photo 参数必须是文件或 URL 字符串，当前类型: {type(photo).__name__}")
+                # 未启用预处理时直接把文件对象（或临时文件路径）放入队列，避免再复制一份到内存
+                photo_data = photo_spool.finish_photo()
+                photo_size = photo_spool.size
+            photo_spool = None
         
         # 创建任务
         task = MessageTask(
             chat_id=processed_chat_id,
             text=text,
-            photo=photo_data
+            photo=photo_data,
+            trace=trace,
+            tenant=tenant.name,
+            photo_url=photo_url_value if photo_source == "URL" else None,
+            ordered=ordered
         )
-        await message_queue.put(task)
+        status = 'fetching' if task.photo_url else 'queued'
+        task_status.set(task, status)
+        with trace.span('enqueue'):
+            await message_queue.put(task)
+        tenant.enqueued += 1
+        trace.enqueued_at = time.perf_counter()
+        if task.photo_url and not isinstance(message_queue, SharedQueue):
+            photo_prefetcher.submit(task)
+        event_bus.publish('enqueued', tenant=tenant.name, chat_id=processed_chat_id, has_text=bool(text), has_photo=photo_source is not None, queue_size=message_queue.qsize())
         
         # 记录日志
         content_desc = []
         if text:
             content_desc.append(f"文本({len(text)}字符)")
         if photo_data:
-            content_desc.append(f"图片({len(photo_data)}字节, 来源: {photo_source})")
+            content_desc.append(f"图片({photo_size}字节, 来源: {photo_source})")
+        elif task.photo_url:
+            content_desc.append("图片(来源: URL, 后台下载)")
         logger.info(f"📥 HTTP API: 收到发送请求，chat_id={processed_chat_id}, 内容={', '.join(content_desc)}, 队列长度={message_queue.qsize()}")
         
         # 返回响应
         response = {
             "status": "success",
             "message": "消息已加入队列",
+            "task_id": task.task_id,
+            "task_status": status,
             "chat_id": processed_chat_id,
             "queue_size": message_queue.qsize()
         }
         if text:
             response["has_text"] = True
-        if photo_data:
+        if photo_source:
             response["has_photo"] = True
-            response["photo_size"] = len(photo_data)
             response["photo_source"] = photo_source
             if photo_filename:
                 response["photo_filename"] = photo_filename
-            # 如果是 URL 方式，也返回 URL
-            if photo_source == "URL" and photo_url_value:
-                response["photo_url"] = photo_url_value
+        if photo_data:
+            response["photo_size"] = photo_size
+            response["photo_sha256"] = photo_digest
+        elif task.photo_url:
+            # URL 图片还没有下载，大小和哈希未知
+            response["photo_url"] = photo_url_value
         
         return response
     
@@ -1017,9 +5382,211 @@ async def send(
     except Exception as e:
         logger.error(f"处理发送请求时出错: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
+    finally:
+        # 请求失败时释放已接收的图片数据
+        if photo_spool is not None:
+            photo_spool.close()
+        end_ingest()
+
+@route("POST", "/api/send_json")
+async def send_json(request: Request):
+    """发送纯文本消息（JSON 请求体，跳过 multipart 解析和 Pydantic 校验）
+    
+    请求体: {"chat_id": -1001234567890, "text": "Hello"}，可选 "ordered": false（不等待同一群组前面的消息）
+    发送图片请使用 /api/send
+    """
+    trace = Trace('/api/send_json')
+    begin_ingest()
+    try:
+        tenant = tenant_registry.authenticate(request)
+        # 文本消息的请求体很小，超过限制直接拒绝
+        content_length = request.headers.get('content-length')
+        if content_length and content_length.isdigit() and int(content_length) > MAX_FORM_FIELD_SIZE:
+            raise HTTPException(status_code=413, detail=f"请求体超过 {MAX_FORM_FIELD_SIZE} 字节限制")
+        with trace.span('parse'):
+            # 边接收边累计大小（没有 Content-Length 的分块请求体同样受限制）
+            chunks = []
+            received = 0
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > MAX_FORM_FIELD_SIZE:
+                    raise HTTPException(status_code=413, detail=f"请求体超过 {MAX_FORM_FIELD_SIZE} 字节限制")
+                chunks.append(chunk)
+            body = b''.join(chunks)
+            
+            try:
+                payload = json_loads(body)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"JSON 格式错误: {str(e)}")
+        if not isinstance(payload, dict):
+            raise HTTPException(status_code=400, detail="请求体必须是 JSON 对象")
+            
+        chat_id = payload.get("chat_id")
+        text = payload.get("text")
+        if chat_id is None or chat_id == "" or isinstance(chat_id, bool) or not isinstance(chat_id, (int, str)):
+            raise HTTPException(status_code=422, detail="缺少必需参数 chat_id，或 chat_id 不是整数/字符串")
+        if "photo" in payload:
+            raise HTTPException(status_code=400, detail="/api/send_json 只支持文本消息，发送图片请使用 /api/send")
+        if not text or not isinstance(text, str):
+            raise HTTPException(status_code=400, detail="必须提供非空的 text 字符串")
+        ordered = payload.get("ordered", True)
+        if not isinstance(ordered, bool):
+            raise HTTPException(status_code=400, detail="ordered 必须是 true 或 false")
+        
+        # 准入检查在校验请求体之后进行，格式错误的请求不消耗租户的速率限制
+        tenant_registry.admit(tenant)
+        processed_chat_id = normalize_chat_id(chat_id)
+        task = MessageTask(chat_id=processed_chat_id, text=text, trace=trace, tenant=tenant.name, ordered=ordered)
+        task_status.set(task, 'queued')
+        with trace.span('enqueue'):
+            await message_queue.put(task)
+        tenant.enqueued += 1
+        trace.enqueued_at = time.perf_counter()
+        
+        queue_size = message_queue.qsize()
+        event_bus.publish('enqueued', tenant=tenant.name, chat_id=processed_chat_id, has_text=True, has_photo=False, queue_size=queue_size)
+        logger.info(f"📥 HTTP API(JSON): 收到发送请求，chat_id={processed_chat_id}, 内容=文本({len(text)}字符), 队列长度={queue_size}")
+        
+        return FastJSONResponse({
+            "status": "success",
+            "message": "消息已加入队列",
+            "task_id": task.task_id,
+            "task_status": "queued",
+            "chat_id": processed_chat_id,
+            "queue_size": queue_size,
+            "has_text": True
+        })
+    finally:
+        end_ingest()
+
+@route("POST", "/api/campaigns")
+async def create_campaign(request: Request):
+    """创建群发任务（multipart/form-data）
+    
+    参数说明:
+    - targets: 目标列表（文件或文本字段，必需），每行一个 chat_id / @username，
+      或一个 JSON 对象 {"chat_id": ..., "变量名": "值"}
+    - text: 文本模板（可选），{变量名} 替换为目标中的同名字段，{chat_id} 替换为群组ID
+    - photo: 图片文件或图片 URL（可选），所有群组共用
+    - name: 群发任务名称（可选）
+    - accounts: 只使用这些账户发送（可选，逗号分隔的账户名称）
+    """
+    begin_ingest()
+    form = None
+    try:
+        # 认证和准入检查在解析请求体之前进行，与 /api/send 相同
+        tenant = tenant_registry.authenticate(request)
+        tenant_registry.admit(tenant)
+        form = await parse_send_form(request, file_fields=('photo', 'targets'))
+        text = form.fields.get("text") or ''
+        photo_url_value = form.fields.get("photo") if form.photo is None else None
+        if not text and form.photo is None and not photo_url_value:
+            raise HTTPException(status_code=400, detail="必须提供 text 或 photo 至少一种内容")
+        
+        targets_spool = form.files.get("targets")
+        if targets_spool is not None:
+            targets = targets_spool.finish()
+        elif form.fields.get("targets"):
+            targets = io.BytesIO(form.fields["targets"].encode('utf-8'))
+        else:
+            raise HTTPException(status_code=400, detail="缺少必需参数 targets")
+        
+        account_names = [name.strip() for name in form.fields.get("accounts", '').split(',') if name.strip()]
+        unknown = [name for name in account_names if name not in {account['name'] for account in accounts}]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"未知的账户: {', '.join(unknown)}")
+        
+        # 图片只读取一次，所有群组共用
+        photo = None
+        if form.photo is not None:
+            if form.photo.size == 0:
+                raise HTTPException(status_code=400, detail="图片文件为空")
+            photo = form.photo.read_all()
+        elif photo_url_value:
+            if not (photo_url_value.startswith('http://') or photo_url_value.startswith('https://')):
+                raise HTTPException(status_code=400, detail="photo URL 必须以 http:// 或 https:// 开头")
+            import aiohttp
+            try:
+                spool = await download_photo(photo_url_value)
+            except aiohttp.ClientError as e:
+                raise HTTPException(status_code=400, detail=f"下载图片失败: {str(e)}")
+            try:
+                photo = spool.read_all()
+            finally:
+                spool.close()
+        if photo is not None and image_preprocess:
+            try:
+                photo = await preprocess_photo(photo)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"图片无效: {str(e)}")
+        
+        # 目标列表逐行写入磁盘（在线程中执行，不阻塞事件循环）
+        campaign, invalid, errors = await asyncio.to_thread(
+            campaign_registry.create, form.fields.get("name") or '', text, photo, targets, tenant.name, account_names
+        )
+        if campaign.total == 0:
+            await asyncio.to_thread(shutil.rmtree, campaign.directory, True)
+            raise HTTPException(status_code=400, detail=f"目标列表中没有有效的群组（格式错误 {invalid} 行）: {'; '.join(errors)}")
+        campaign_registry.add(campaign)
+        return {**campaign.get_stats(), "invalid": invalid, "errors": errors}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"创建群发任务时出错: {str(e)}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"服务器内部错误: {str(e)}")
+    finally:
+        if form is not None:
+            form.close()
+        end_ingest()
+
+@route("GET", "/api/tasks/{task_id}")
+async def get_task_status(request: Request, task_id: str):
+    """消息的发送状态（fetching / queued / sending / sent / failed），配置了租户时只能查询本租户的消息"""
+    tenant = tenant_registry.authenticate(request)
+    entry = task_status.get(task_id)
+    if entry is None or (tenant_registry.enabled and entry["tenant"] != tenant.name):
+        raise HTTPException(status_code=404, detail=f"消息 {task_id} 不存在或状态已过期")
+    return entry
+
+def get_campaign_for_request(request: Request, campaign_id: str) -> Campaign:
+    """按ID获取群发任务，配置了租户时只能访问本租户创建的群发任务"""
+    tenant = tenant_registry.authenticate(request)
+    campaign = campaign_registry.get(campaign_id)
+    if campaign is None or (tenant_registry.enabled and campaign.tenant != tenant.name):
+        raise HTTPException(status_code=404, detail=f"群发任务 {campaign_id} 不存在")
+    return campaign
+
+@route("GET", "/api/campaigns")
+async def list_campaigns(request: Request):
+    """所有群发任务的进度"""
+    tenant = tenant_registry.authenticate(request)
+    return {"campaigns": [
+        campaign.get_stats() for campaign in campaign_registry.campaigns.values()
+        if not tenant_registry.enabled or campaign.tenant == tenant.name
+    ]}
+
+@route("GET", "/api/campaigns/{campaign_id}")
+async def get_campaign(request: Request, campaign_id: str):
+    """群发任务的进度和预计剩余时间"""
+    return get_campaign_for_request(request, campaign_id).get_stats()
+
+@route("POST", "/api/campaigns/{campaign_id}/{action}")
+async def control_campaign(request: Request, campaign_id: str, action: str):
+    """暂停（pause）、继续（resume）或取消（cancel）群发任务"""
+    campaign = get_campaign_for_request(request, campaign_id)
+    transitions = {'pause': ('running', 'paused'), 'resume': ('paused', 'running'), 'cancel': (None, 'cancelled')}
+    if action not in transitions:
+        raise HTTPException(status_code=404, detail=f"未知的操作: {action}")
+    required, status = transitions[action]
+    if campaign.status in ('completed', 'cancelled') or (required and campaign.status != required):
+        raise HTTPException(status_code=409, detail=f"群发任务当前状态为 {campaign.status}，无法执行 {action}")
+    campaign.set_status(status)
+    return campaign.get_stats()
 
 async def start_http_server():
     """启动HTTP服务器（在后台运行）"""
+    import uvicorn
     try:
         config_uvicorn = uvicorn.Config(
             app=app,
@@ -1033,7 +5600,15 @@ async def start_http_server():
         logger.info(f"📡 API 端点:")
         logger.info(f"   - POST /api/send - 发送消息（支持文本和图片，可同时发送）")
         logger.info(f"     参数: chat_id (必需), text (可选), photo (可选), photo_url (可选)")
+        logger.info(f"   - POST /api/send_json - 发送纯文本消息（JSON 请求体）")
+        logger.info(f"     参数: chat_id (必需), text (必需)")
+        logger.info(f"   - GET  /api/tasks/{{task_id}} - 查询消息发送状态")
+        logger.info(f"   - POST /api/campaigns - 创建群发任务（模板 + 图片 + 目标列表）")
+        logger.info(f"   - GET  /api/campaigns[/{{id}}] - 群发任务进度，POST /api/campaigns/{{id}}/pause|resume|cancel - 暂停/继续/取消")
+        logger.info(f"   - GET  /api/events - 实时事件流（SSE）")
         logger.info(f"   - GET  /api/health - 健康检查")
+        if admin_token:
+            logger.info(f"   - GET  /api/admin/profile|tracemalloc|loop|memory|traces|ledger - 诊断接口（需要 admin_token）")
         await server.serve()
     except asyncio.CancelledError:
         logger.info("HTTP API 服务器已停止")
@@ -1041,6 +5616,68 @@ async def start_http_server():
     except Exception as e:
         logger.error(f"HTTP API 服务器启动失败: {str(e)}", exc_info=True)
 
+# ========== 应用工厂部分 ==========
+# 启动各阶段的耗时（毫秒）：import 导入模块，configure 读取配置和创建运行状态，app 创建 FastAPI 应用，
+# clients 创建 Telegram 客户端（/api/health 中返回）
+startup_timings: Dict[str, float] = {}
+
+# new_instance() 创建的模块副本数量（用于生成模块名）
+instance_count = 0
+
+def create_app(config_path: Optional[str] = None, settings: Optional[dict] = None):
+    """应用工厂：读取配置，创建消息队列、分配器、事件流等运行状态和 FastAPI 应用，返回 FastAPI 应用
+
+    settings 为 None 时读取 config_path（默认为程序目录下的 config.json），否则直接使用 settings；
+    不配置日志文件、不创建 Telegram 客户端（由 run() 完成）。每个模块只应调用一次，
+    同一进程中需要多个互相独立的实例时使用 new_instance()
+    """
+    global CONFIG_PATH, message_queue, tenant_registry, router, event_bus, trace_recorder, send_ledger, browse_store
+    global task_status, campaign_registry, photo_prefetcher, mark_read_rpc_budget, loop_monitor, app
+    started = time.perf_counter()
+    if config_path is not None:
+        CONFIG_PATH = os.path.abspath(config_path)
+    apply_config(load_config() if settings is None else validate_config(settings))
+    
+    if shared_queue_file:
+        message_queue = SharedQueue(shared_queue_file, instance_name, shared_queue_lease, shared_queue_poll_interval, chat_order_window)
+    else:
+        message_queue = FairQueue(chat_order_window)
+    tenant_registry = TenantRegistry(config, message_queue)
+    router = ChatRouter(distribution_strategy, [account['name'] for account in accounts], routing_state_max_chats, consistent_hash_vnodes)
+    event_bus = EventBus(event_buffer_size)
+    trace_recorder = TraceRecorder(trace_buffer_size, trace_export_file)
+    send_ledger = SendLedger(ledger_dir, ledger_flush_interval)
+    browse_store = BrowseStateStore(browse_state_file)
+    task_status = TaskStatusStore(task_status_max)
+    campaign_registry = CampaignRegistry(campaign_dir)
+    photo_prefetcher = PhotoPrefetcher(photo_prefetch_workers)
+    mark_read_rpc_budget = MarkReadRpcBudget(mark_read_rpc_rate)
+    # 采样间隔取阈值的一半（最多0.5秒），保证超过阈值的阻塞都能被检测到
+    loop_monitor = LoopLagMonitor(min(0.5, loop_lag_threshold / 2), loop_lag_threshold) if loop_lag_monitor else None
+    configured = time.perf_counter()
+    
+    app = build_app()
+    startup_timings['configure'] = round((configured - started) * 1000, 1)
+    startup_timings['app'] = round((time.perf_counter() - configured) * 1000, 1)
+    return app
+
+def new_instance(config_path: Optional[str] = None, settings: Optional[dict] = None):
+    """在同一进程中创建一个独立的实例：加载本模块的一个新副本并调用其 create_app()，返回该模块副本
+
+    每个副本有自己的配置、消息队列、分配器、发送状态和 FastAPI 应用（副本的 app 属性），
+    测试和性能测试脚本可以在一个进程中创建多个互不影响的实例
+    """
+    global instance_count
+    instance_count += 1
+    name = f"{__name__}_instance{instance_count}"
+    spec = importlib.util.spec_from_file_location(name, os.path.abspath(__file__))
+    module = importlib.util.module_from_spec(spec)
+    # 图片预处理子进程按模块名查找函数，需要登记到 sys.modules
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    module.create_app(config_path, settings)
+    return module
+
 async def main():
     """主函数"""
     try:
@@ -1070,13 +5707,45 @@ async def main():
         
         logger.info("=" * 60)
         logger.info(f"✓ 所有 {len(started_clients)} 个客户端已启动")
-        logger.info(f"发送间隔: {send_interval}秒，抖动时间: 0-{send_jitter}秒")
+        logger.info(f"发送间隔: {pacing.send_interval}秒，抖动时间: 0-{pacing.send_jitter}秒")
         logger.info(f"分配策略: {distribution_strategy}")
         logger.info("=" * 60)
         logger.info("📢 程序已启动，等待 HTTP API 请求...")
         logger.info("📢 通过 HTTP API 发送的消息将按配置的策略分配给不同客户端")
         logger.info("=" * 60)
         
+        # 恢复上次停止时保存的队列（在发送任务启动之前）
+        try:
+            restore_checkpoint()
+        except Exception as e:
+            logger.error(f"✗ 恢复检查点失败: {str(e)}", exc_info=True)
+        # 继续未完成的群发任务（需要在恢复检查点之后，统计已在队列中的消息）
+        campaign_registry.start()
+        
+        # 发送记录：加载各分段的汇总后再启动发送任务，之后每 ledger_flush_interval 秒批量写入一次
+        ledger_task = None
+        if send_ledger.enabled:
+            await asyncio.to_thread(send_ledger.load)
+            ledger_task = asyncio.create_task(send_ledger.run())
+        # 追踪记录导出：每 TRACE_EXPORT_INTERVAL 秒批量写入一次
+        trace_task = asyncio.create_task(trace_recorder.run()) if trace_recorder.export_path else None
+        
+        # 共享队列：登记本实例可访问的群组并定期续约（需要在发送任务领取消息之前登记）
+        shared_queue_task = None
+        if isinstance(message_queue, SharedQueue):
+            await message_queue.set_chats(await asyncio.to_thread(reachable_chat_keys))
+            shared_queue_task = asyncio.create_task(message_queue.run(reachable_chat_keys))
+            logger.info(f"共享队列已启用: {shared_queue_file}，实例名称: {instance_name}")
+        
+        # 连接监控：定期检查每个账户的连接，断开时自动重新连接
+        supervisor_task = None
+        if supervisor_interval > 0:
+            supervisor_task = asyncio.create_task(client_supervisor())
+            logger.info(f"连接监控已启动，每 {supervisor_interval} 秒检查一次账户连接")
+        
+        # 图片预取：后台下载 /api/send 收到的图片 URL
+        prefetch_task = asyncio.create_task(photo_prefetcher.run())
+        
         # 在客户端启动后，启动消息发送任务和自动标记已读任务
         sender_task = asyncio.create_task(start_sender())
         mark_read_task = None
@@ -1085,6 +5754,21 @@ async def main():
             logger.info("自动标记已读任务已启动...")
         logger.info("消息队列发送任务已启动，等待消息...")
         
+        # 配置热重载：SIGHUP 信号（systemctl reload），以及可选的配置文件修改检查
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, request_config_reload, "收到 SIGHUP 信号")
+            logger.info("配置热重载已启用：发送 SIGHUP 信号（kill -HUP 或 systemctl reload）即可重新加载 config.json")
+        except (NotImplementedError, AttributeError, RuntimeError):
+            logger.info("当前平台不支持 SIGHUP 信号，配置热重载仅支持 config_watch_interval 方式")
+        monitor_task = None
+        if loop_monitor is not None:
+            monitor_task = asyncio.create_task(loop_monitor.run())
+            logger.info(f"事件循环延迟监控已启动，阻塞超过 {loop_lag_threshold} 秒时记录调用栈")
+        watch_task = None
+        if config_watch_interval > 0:
+            watch_task = asyncio.create_task(config_watch_task())
+            logger.info(f"配置文件修改检查已启动，每 {config_watch_interval} 秒检查一次")
+        
         # 启动HTTP服务器
         http_task = asyncio.create_task(start_http_server())
         logger.info("HTTP API 服务器任务已启动...")
@@ -1099,20 +5783,41 @@ async def main():
         except KeyboardInterrupt:
             logger.info("收到中断信号，正在关闭...")
         finally:
+            # 停止接收新消息，等待正在进行的发送完成，剩余消息保存到检查点文件
+            # （HTTP 服务器在这之后才停止，停止期间新请求会收到 503）
+            await drain_and_checkpoint(sender_task)
+            
             # 取消所有任务
-            sender_task.cancel()
+            if supervisor_task:
+                supervisor_task.cancel()
+                try:
+                    await supervisor_task
+                except asyncio.CancelledError:
+                    pass
+            prefetch_task.cancel()
+            if ledger_task:
+                send_ledger.stopping = True
+                try:
+                    await ledger_task
+                except Exception as e:
+                    logger.warning(f"写入剩余的发送记录时出错: {str(e)}")
+            if trace_task:
+                trace_recorder.stopping = True
+                try:
+                    await trace_task
+                except Exception as e:
+                    logger.warning(f"写入剩余的追踪记录时出错: {str(e)}")
+            if watch_task:
+                watch_task.cancel()
+            if shared_queue_task:
+                shared_queue_task.cancel()
+            if monitor_task:
+                monitor_task.cancel()
             if mark_read_task:
                 mark_read_task.cancel()
             if http_task:
                 http_task.cancel()
             
-            try:
-                await sender_task
-            except asyncio.CancelledError:
-                pass
-            except Exception as e:
-                logger.warning(f"取消发送任务时出错: {str(e)}")
-            
             if mark_read_task:
                 try:
                     await mark_read_task
@@ -1129,21 +5834,26 @@ async def main():
                 except Exception as e:
                     logger.warning(f"取消HTTP服务器任务时出错: {str(e)}")
             
-            # 等待队列中的消息发送完成（最多等待30秒）
-            if not message_queue.empty():
-                logger.info(f"等待队列中的 {message_queue.qsize()} 条消息发送完成...")
-                try:
-                    await asyncio.wait_for(message_queue.join(), timeout=30.0)
-                except asyncio.TimeoutError:
-                    logger.warning("等待消息发送超时，强制关闭")
-            
-            # 停止所有客户端
-            for i, client in enumerate(started_clients):
+            # 停止所有客户端（热重载后客户端列表可能已变化，按当前列表停止）
+            for client, account in list(zip(clients, accounts)):
+                if not client.is_connected:
+                    continue
                 try:
                     await client.stop()
-                    logger.info(f"✓ [{accounts[i]['name']}] Telegram 客户端已断开连接")
+                    logger.info(f"✓ [{account['name']}] Telegram 客户端已断开连接")
                 except Exception as e:
-                    logger.warning(f"停止客户端 {accounts[i]['name']} 时出错: {str(e)}")
+                    logger.warning(f"停止客户端 {account['name']} 时出错: {str(e)}")
+            
+            # 关闭图片预处理进程池
+            if image_executor is not None:
+                image_executor.shutdown(wait=False, cancel_futures=True)
+            
+            # 关闭浏览进度数据库和追踪记录导出文件
+            browse_store.close()
+            trace_recorder.close()
+            if isinstance(message_queue, SharedQueue):
+                await message_queue.flush()
+                message_queue.close()
             
     except SessionPasswordNeeded:
         logger.error("需要两步验证密码，请在交互式环境中运行一次以完成登录")
@@ -1152,8 +5862,21 @@ async def main():
         logger.error(f"程序启动失败: {str(e)}", exc_info=True)
         raise
 
-if __name__ == '__main__':
+def run():
+    """命令行入口：创建应用、配置日志和事件循环、创建 Telegram 客户端，然后运行直到程序停止"""
     try:
+        create_app()
+        setup_logging()
+        setup_event_loop()
+        logger.info(f"事件循环: {'uvloop' if use_uvloop else 'asyncio'}，JSON 编码: {'orjson' if orjson is not None else 'json'}")
+        started = time.perf_counter()
+        create_clients()
+        startup_timings['clients'] = round((time.perf_counter() - started) * 1000, 1)
+        logger.info(
+            f"启动耗时: 导入 {startup_timings['import']}ms，读取配置 {startup_timings['configure']}ms，"
+            f"创建应用 {startup_timings['app']}ms，创建客户端 {startup_timings['clients']}ms"
+        )
+        
         # 检查所有 session 文件
         logger.info("检查 session 文件状态...")
         for account in accounts:
@@ -1187,3 +5910,9 @@ if __name__ == '__main__':
     except Exception as e:
         logger.error(f"程序运行失败: {str(e)}", exc_info=True)
         sys.exit(1)
+
+# 导入模块的耗时（不包括 create_app() 和创建客户端）
+startup_timings['import'] = round((time.perf_counter() - _module_load_started) * 1000, 1)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,287 @@
+"""发送节奏模拟器（容量规划）
+
+用虚拟时钟（离散事件模拟）重放消息到达序列，使用与发送任务相同的节奏参数计算
+（PacingConfig.send_delays / rest_time）和分配策略（ChatRouter），不连接 Telegram、不真正等待，
+用于离线评估一组配置的发送能力：
+  - 吞吐量和清空队列所需时间
+  - 每条消息的排队等待时间、从到达到发送完成的总耗时分位数
+  - 并发发送（sender_workers）和群组内顺序（chat_order_window）对吞吐量的影响
+  - 每个账户的发送数量、发送速率和相邻两次发送间隔的分位数
+
+到达序列可以是合成的（一次性积压或泊松到达），也可以从文件重放：
+  - 服务日志（client_tguserbot_YYYYMMDD.log），按"收到发送请求"的时间和 chat_id 重放
+  - CSV（每行: 相对秒数,chat_id）或 JSON Lines（每行: {"t": 相对秒数, "chat_id": ...}）
+
+注意：需要导入 main.py，程序目录下需要有 config.json（与运行服务时相同）。
+
+用法:
+    python simulate.py -n 500                       # 500 条消息同时到达（积压），多久能发完
+    python simulate.py -n 2000 --rate 0.5 --chats 20  # 平均每秒0.5条，分布在20个群组
+    python simulate.py --log logs/client_tguserbot_20250101.log
+    python simulate.py -n 500 --set send_interval=1.0 --set batch_delay_factor=0.2 --runs 5
+    python simulate.py -n 2000 --chats 5 --set sender_workers=4 --accounts 4   # 4个发送任务并发
+    python simulate.py -n 2000 --chats 5 --set sender_workers=4 --unordered    # 消息都不要求顺序（ordered=false）
+"""
+import argparse
+import csv
+import heapq
+import json
+import logging
+import random
+import re
+from collections import defaultdict
+from datetime import datetime
+
+# 服务日志中 HTTP API 收到发送请求的行（/api/send 和 /api/send_json）
+LOG_LINE_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}) .*收到发送请求，chat_id=([^,，\s]+)'
+)
+
+
+def percentile(sorted_values, percent):
+    """计算分位数（输入需已排序）"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(percent / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def parse_chat_id(value):
+    """chat_id 为数字时转换为 int，否则保留字符串（如 @username）"""
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def load_log_trace(path):
+    """从服务日志中读取到达序列，返回 [(相对秒数, chat_id)]"""
+    trace = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = LOG_LINE_PATTERN.match(line)
+            if match:
+                timestamp = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp()
+                trace.append((timestamp, parse_chat_id(match.group(2))))
+    if trace:
+        start = trace[0][0]
+        trace = [(timestamp - start, chat_id) for timestamp, chat_id in trace]
+    return trace
+
+
+def load_file_trace(path):
+    """从 CSV 或 JSON Lines 文件读取到达序列，返回 [(相对秒数, chat_id)]"""
+    trace = []
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl') or path.endswith('.json'):
+            for line in f:
+                line = line.strip()
+                if line:
+                    item = json.loads(line)
+                    trace.append((float(item['t']), parse_chat_id(str(item['chat_id']))))
+        else:
+            for row in csv.reader(f):
+                if not row or row[0].startswith('#'):
+                    continue
+                trace.append((float(row[0]), parse_chat_id(row[1].strip())))
+    trace.sort(key=lambda item: item[0])
+    return trace
+
+
+def synthetic_trace(count, rate, chats, rng):
+    """合成到达序列：rate 为0时所有消息在0秒同时到达，否则按泊松过程到达（平均每秒 rate 条）"""
+    chat_ids = [-1000000000000 - i for i in range(chats)]
+    trace = []
+    now = 0.0
+    for _ in range(count):
+        if rate > 0:
+            now += rng.expovariate(rate)
+        trace.append((now, rng.choice(chat_ids)))
+    return trace
+
+
+def simulate(trace, pacing, router, account_names, send_latency, rng, workers=1, order_window=1):
+    """离散事件模拟：workers 个发送任务并发处理消息，返回每条消息的记录
+
+    与实际发送任务相同：
+      - 空闲的发送任务按到达顺序取消息，同一群组正在发送的消息已有 order_window 条时跳过该群组的消息
+        （order_window 为 0 表示不保持群组内的顺序）
+      - 选择账户时优先选择没有被其他发送任务占用的账户（consistent_hash 策略除外），
+        选中的账户正被占用时等待它空闲；账户从模拟操作开始占用到发送后的休息结束
+      - 群组内的下一条消息在本条消息发送完成后（休息之前）就可以开始
+
+    事件按 (时间, 类型, 序号) 排序，同一时刻先处理到达事件（类型0），再处理发送完成（类型1）和发送任务空闲事件（类型2），
+    与实际发送任务取出消息时 message_queue.qsize() 的取值一致
+    """
+    ARRIVAL, SENT, READY = 0, 1, 2
+    events = [(arrival, ARRIVAL, seq, chat_id) for seq, (arrival, chat_id) in enumerate(trace)]
+    heapq.heapify(events)
+    event_seq = len(events)
+    queue = []  # 已到达、等待发送的消息 (到达时间, chat_id)
+    in_flight = defaultdict(int)  # 群组 -> 正在发送的消息数
+    account_free_at = [0.0] * len(account_names)  # 账户被占用到的时间
+    idle_workers = workers
+    records = []
+
+    def push(at, kind, chat_id=None):
+        nonlocal event_seq
+        event_seq += 1
+        heapq.heappush(events, (at, kind, event_seq, chat_id))
+
+    def select_account(chat_id, now):
+        idle = {i for i in range(len(account_names)) if account_free_at[i] <= now}
+        if router.strategy != 'consistent_hash' and idle:
+            return router.select(chat_id, is_available=idle.__contains__)
+        return router.select(chat_id)
+
+    def dispatch(now):
+        nonlocal idle_workers
+        while idle_workers and queue:
+            position = next(
+                (i for i, (_, chat_id) in enumerate(queue) if not order_window or in_flight[chat_id] < order_window), None
+            )
+            if position is None:
+                return
+            arrival, chat_id = queue.pop(position)
+            idle_workers -= 1
+            remaining = len(queue)  # 取出本条消息后队列中剩余的消息数
+            delays = pacing.send_delays(remaining, rng)
+            index = select_account(chat_id, now)
+            started = max(now, account_free_at[index])
+            sent_at = (started + delays['think_time'] + delays['send_interval'] + delays['jitter']
+                       + delays['batch_delay'] + delays['operation_delay'] + send_latency)
+            account_free_at[index] = sent_at + pacing.rest_time(rng)
+            in_flight[chat_id] += 1
+            records.append({
+                'arrival': arrival,
+                'dispatched': now,
+                'sent': sent_at,
+                'account': account_names[index],
+                'chat_id': chat_id,
+            })
+            push(sent_at, SENT, chat_id)
+            push(account_free_at[index], READY)
+
+    while events:
+        now, kind, _, chat_id = heapq.heappop(events)
+        if kind == ARRIVAL:
+            queue.append((now, chat_id))
+        elif kind == SENT:
+            in_flight[chat_id] -= 1
+        else:
+            idle_workers += 1
+        dispatch(now)
+    return records
+
+
+def format_seconds(value):
+    """秒数格式化为易读的时长"""
+    if value >= 3600:
+        return f"{value / 3600:.2f} 小时"
+    if value >= 60:
+        return f"{value / 60:.1f} 分钟"
+    return f"{value:.1f} 秒"
+
+
+def report(all_records, runs, account_names):
+    """打印模拟结果"""
+    waits = sorted(r['dispatched'] - r['arrival'] for records in all_records for r in records)
+    latencies = sorted(r['sent'] - r['arrival'] for records in all_records for r in records)
+    drain_times = sorted(max(r['sent'] for r in records) - min(r['arrival'] for r in records) for records in all_records if records)
+    total = sum(len(records) for records in all_records)
+    if not total:
+        print("到达序列为空，没有可模拟的消息")
+        return
+
+    drain = sum(drain_times) / len(drain_times)
+    print(f"模拟次数: {runs}，每次消息数: {total // runs}，账户数: {len(account_names)}")
+    print(f"清空耗时: 平均 {format_seconds(drain)}，最短 {format_seconds(drain_times[0])}，最长 {format_seconds(drain_times[-1])}")
+    print(f"吞吐量: {total / runs / drain * 60:.2f} 条/分钟（{total / runs / drain * 3600:.0f} 条/小时）")
+    print(
+        f"排队等待: p50={format_seconds(percentile(waits, 50))} p90={format_seconds(percentile(waits, 90))} "
+        f"p99={format_seconds(percentile(waits, 99))} max={format_seconds(waits[-1])}"
+    )
+    print(
+        f"到达到发送完成: p50={format_seconds(percentile(latencies, 50))} p90={format_seconds(percentile(latencies, 90))} "
+        f"p99={format_seconds(percentile(latencies, 99))} max={format_seconds(latencies[-1])}"
+    )
+
+    # 每个账户的发送数量、速率（在整个清空时间内平均）和相邻两次发送的间隔
+    print("各账户发送情况:")
+    for name in account_names:
+        count = 0
+        gaps = []
+        for records in all_records:
+            sent_times = sorted(r['sent'] for r in records if r['account'] == name)
+            count += len(sent_times)
+            gaps.extend(b - a for a, b in zip(sent_times, sent_times[1:]))
+        gaps.sort()
+        print(
+            f"  {name}: {count / runs:.1f} 条，{count / runs / drain * 60:.2f} 条/分钟，"
+            f"发送间隔 p10={percentile(gaps, 10):.1f}s p50={percentile(gaps, 50):.1f}s p90={percentile(gaps, 90):.1f}s"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='发送节奏模拟器（容量规划）')
+    parser.add_argument('--config', help='配置文件路径，默认使用程序目录下的 config.json')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='覆盖配置项（值按 JSON 解析），可多次使用，如 --set send_interval=1.5')
+    parser.add_argument('--accounts', type=int, help='模拟的账户数（默认使用配置中的账户）')
+    parser.add_argument('--log', help='从服务日志重放到达序列')
+    parser.add_argument('--trace', help='从 CSV（相对秒数,chat_id）或 JSON Lines 文件重放到达序列')
+    parser.add_argument('-n', '--messages', type=int, default=500, help='合成序列的消息数，默认500')
+    parser.add_argument('--rate', type=float, default=0.0, help='合成序列的平均到达速率（条/秒），默认0表示同时到达')
+    parser.add_argument('--chats', type=int, default=10, help='合成序列的群组数，默认10')
+    parser.add_argument('--send-latency', type=float, default=0.5,
+                        help='每条消息 get_chat + 发送请求本身的耗时（秒），默认0.5')
+    parser.add_argument('--runs', type=int, default=1, help='模拟次数（每次使用不同的随机种子），默认1')
+    parser.add_argument('--seed', type=int, default=1, help='随机种子，默认1')
+    parser.add_argument('--unordered', action='store_true',
+                        help='所有消息都不要求群组内的顺序（相当于发送请求中 ordered=false）')
+    args = parser.parse_args()
+
+    import main as bot
+    # 模拟过程中只显示警告（配置值无效等）
+    logging.getLogger().setLevel(logging.WARNING)
+
+    config = bot.read_config(args.config) if args.config else bot.load_config()
+    for item in args.set:
+        key, _, value = item.partition('=')
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    pacing = bot.PacingConfig.from_config(config)
+    workers = config.get('sender_workers', 1)
+    order_window = 0 if args.unordered else config.get('chat_order_window', 1)
+    strategy = bot.get_distribution_strategy(config)
+    if args.accounts:
+        account_names = [f"sim{i + 1}" for i in range(args.accounts)]
+    else:
+        account_names = [account['name'] for account in config['accounts']]
+
+    all_records = []
+    for run in range(args.runs):
+        rng = random.Random(args.seed + run)
+        random.seed(args.seed + run)  # random 分配策略使用全局随机数
+        if args.log:
+            trace = load_log_trace(args.log)
+        elif args.trace:
+            trace = load_file_trace(args.trace)
+        else:
+            trace = synthetic_trace(args.messages, args.rate, args.chats, rng)
+        router = bot.ChatRouter(
+            strategy, account_names,
+            config.get('routing_state_max_chats', 10000), config.get('consistent_hash_vnodes', 160)
+        )
+        all_records.append(simulate(trace, pacing, router, account_names, args.send_latency, rng, workers, order_window))
+
+    print(f"分配策略: {strategy}，发送间隔: {pacing.send_interval}s + 抖动 {pacing.send_jitter}s，"
+          f"批量延迟因子: {pacing.batch_delay_factor}，休息概率: {pacing.rest_probability}")
+    print(f"发送任务数: {workers}，群组内顺序: {'不保持' if not order_window else f'最多同时发送 {order_window} 条'}")
+    report(all_records, args.runs, account_names)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""消息队列（FairQueue / SharedQueue）的顺序发送、放回队列和租约过期测试
+
+运行: python -m pytest -q
+"""
+import asyncio
+import time
+
+import pytest
+
+from main import FairQueue, MessageTask, SharedQueue
+
+
+def make_tasks(chat_id, count, prefix=''):
+    return [MessageTask(chat_id, text=f'{prefix}{i}') for i in range(count)]
+
+
+def drain(queue):
+    """取出当前可以取出的所有消息"""
+    tasks = []
+    while True:
+        try:
+            tasks.append(queue.get_nowait())
+        except asyncio.QueueEmpty:
+            return tasks
+
+
+# ========== FairQueue 部分 ==========
+
+def test_fair_queue_order_window_releases_in_order():
+    queue = FairQueue(order_window=2)
+    tasks = make_tasks(-1, 5)
+    for task in tasks:
+        queue.put_nowait(task)
+    assert [task.chat_seq for task in tasks] == [0, 1, 2, 3, 4]
+
+    # 同一群组最多同时取出 2 条，其余暂存
+    assert [task.text for task in drain(queue)] == ['0', '1']
+    assert queue.qsize() == 3
+    assert queue.get_order_stats()['parked'] == 3
+
+    # 第二条先完成：第一条仍未完成，只放行一条
+    queue.task_done(tasks[1])
+    assert [task.text for task in drain(queue)] == ['2']
+    queue.task_done(tasks[0])
+    assert [task.text for task in drain(queue)] == ['3']
+    queue.task_done(tasks[2])
+    queue.task_done(tasks[3])
+    assert [task.text for task in drain(queue)] == ['4']
+    queue.task_done(tasks[4])
+    assert queue.empty()
+    assert queue.get_order_stats()['chats'] == 0
+
+
+def test_fair_queue_other_chats_not_blocked():
+    queue = FairQueue(order_window=1)
+    first = make_tasks(-1, 3, 'a')
+    second = make_tasks(-2, 1, 'b')
+    unordered = MessageTask(-1, text='u', ordered=False)
+    for task in first + second + [unordered]:
+        queue.put_nowait(task)
+    assert unordered.chat_seq is None
+    assert [task.text for task in drain(queue)] == ['a0', 'b0', 'u']
+
+
+def test_fair_queue_requeue_keeps_chat_seq():
+    queue = FairQueue(order_window=1)
+    tasks = make_tasks(-1, 3)
+    for task in tasks:
+        queue.put_nowait(task)
+    task = queue.get_nowait()
+    assert task.chat_seq == 0
+    queue.requeue(task)
+    assert queue.qsize() == 3
+
+    again = queue.get_nowait()
+    assert again is task
+    assert again.chat_seq == 0
+    # 放回队列不改变序号，后面的消息仍要等它完成
+    assert drain(queue) == []
+    queue.task_done(again)
+    assert queue.get_nowait() is tasks[1]
+
+
+def test_fair_queue_items_in_chat_order():
+    queue = FairQueue(order_window=2)
+    tasks = make_tasks(-1, 4)
+    other = MessageTask(-2, text='b0')
+    for task in tasks[:2] + [other] + tasks[2:]:
+        queue.put_nowait(task)
+    # 取出前两条后按相反的顺序放回，后两条被暂存：队列中的位置与序号不再一致
+    assert [task.text for task in drain(queue)] == ['0', '1', 'b0']
+    queue.requeue(other)
+    queue.requeue(tasks[0])
+    queue.requeue(tasks[1])
+    raw = [task for q in queue._queues.values() for _, task in q]
+    assert [task.text for task in raw] == ['1', '0', 'b0']
+
+    # 检查点按群组内的序号保存，恢复后仍按原来的顺序发送
+    items = queue.items()
+    assert len(items) == 5
+    assert [task.text for task in items if task.chat_id == -1] == ['0', '1', '2', '3']
+
+    restored = FairQueue(order_window=1)
+    for data in [task.to_checkpoint() for task in items]:
+        restored.put_nowait(MessageTask.from_checkpoint(data))
+    sent = []
+    while not restored.empty():
+        for task in drain(restored):
+            sent.append(task.text)
+            restored.task_done(task)
+    assert [text for text in sent if text != 'b0'] == ['0', '1', '2', '3']
+
+
+# ========== SharedQueue 部分 ==========
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / 'shared_queue.db')
+
+
+def test_shared_queue_order_window_and_requeue(queue_path):
+    async def run():
+        queue = SharedQueue(queue_path, 'instance-a', lease=60, poll_interval=0.05, order_window=1)
+        try:
+            for task in make_tasks(-1, 2) + make_tasks(-2, 1, 'b'):
+                queue.put_nowait(task)
+            first = queue.get_nowait()
+            assert first.text == '0'
+            assert first.chat_seq == first.queue_id
+            # 同一群组的第二条要等第一条完成，其他群组不受影响
+            assert queue.get_nowait().text == 'b0'
+            with pytest.raises(asyncio.QueueEmpty):
+                queue.get_nowait()
+
+            # 放回队列：保留原来的消息ID（序号），仍排在第二条之前
+            queue.requeue(first)
+            await queue.flush()
+            again = queue.get_nowait()
+            assert (again.queue_id, again.chat_seq, again.text) == (first.queue_id, first.chat_seq, '0')
+
+            queue.task_done(again)
+            second = await asyncio.wait_for(queue.get(), 2)
+            assert second.text == '1'
+            assert second.chat_seq > again.chat_seq
+        finally:
+            await queue.flush()
+            queue.close()
+
+    asyncio.run(run())
+
+
+def test_shared_queue_lease_expiry(queue_path):
+    async def run():
+        first = SharedQueue(queue_path, 'instance-a', lease=0.2, poll_interval=0.05)
+        second = SharedQueue(queue_path, 'instance-b', lease=60, poll_interval=0.05)
+        try:
+            first.put_nowait(MessageTask(-1, text='x'))
+            claimed = first.get_nowait()
+            with pytest.raises(asyncio.QueueEmpty):
+                second.get_nowait()
+
+            # 实例 A 不再续约，租约过期后由实例 B 重新领取
+            time.sleep(0.3)
+            reclaimed = await asyncio.wait_for(second.get(), 2)
+            assert reclaimed.queue_id == claimed.queue_id
+            assert reclaimed.text == 'x'
+
+            # 租约已属于实例 B：实例 A 的 task_done 不会删除消息
+            first.task_done(claimed)
+            await first.flush()
+            assert second.qsize_of('default') == 0
+            with first._lock:
+                (count,) = first._db.execute("SELECT COUNT(*) FROM messages").fetchone()
+            assert count == 1
+
+            second.task_done(reclaimed)
+            await second.flush()
+            with second._lock:
+                (count,) = second._db.execute("SELECT COUNT(*) FROM messages").fetchone()
+            assert count == 0
+        finally:
+            await first.flush()
+            await second.flush()
+            first.close()
+            second.close()
+
+    asyncio.run(run())